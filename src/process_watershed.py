@@ -22,8 +22,14 @@
 #
 
 from datetime import datetime
+import os
+import sys
 import appconfig
 
+#shared modules (stream_network etc.) are imported directly by the 
+#processing scripts so they can also be run on their own
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "processing_scripts"))
+
 from processing_scripts import load_parameters
 from processing_scripts import preprocess_watershed
 from processing_scripts import load_and_snap_barriers_cabd
@@ -34,40 +40,115 @@ from processing_scripts import assign_raw_z
 from processing_scripts import smooth_z
 from processing_scripts import compute_vertex_gradient
 from processing_scripts import compute_segment_gradient
+from processing_scripts import compute_elevations
 from processing_scripts import break_streams_at_barriers
 from processing_scripts import load_and_snap_fishobservation
 from processing_scripts import compute_gradient_accessibility
 from processing_scripts import compute_updown_barriers_fish
 from processing_scripts import compute_habitat_models
 from processing_scripts import compute_barriers_upstream_values
+from processing_scripts import species_parameters
+from processing_scripts import stage_scheduler
+from processing_scripts import stage_context
+from processing_scripts import stage_checkpoint
+
+#run the elevation stages in memory (see compute_elevations)
+fusedElevation = appconfig.config['ELEVATION_PROCESSING'].getboolean('fused_pipeline', False)
+
+#number of independent processing scripts run at the same time
+stageWorkers = int(appconfig.config['PROCESSING'].get('stage_workers', '1'))
+
+#only run the processing scripts whose inputs changed since they last 
+#completed (see stage_checkpoint)
+stageCheckpoints = appconfig.config['PROCESSING'].getboolean('stage_checkpoints', False)
+
+#
+# processing scripts for the watershed in order; scripts that don't depend 
+# on each other (see stage_scheduler) are run at the same time when 
+# stageWorkers > 1. The species parameters are only loaded when parameters
+# is true.
+#
+def watershedStages(context, parameters = True):
+    
+    stages = []
+    
+    if parameters:
+        stages.append(stage_scheduler.moduleStage(load_parameters, context))
+    
+    stages.extend([
+        stage_scheduler.moduleStage(preprocess_watershed, context),
+        stage_scheduler.moduleStage(load_and_snap_barriers_cabd, context),
+        stage_scheduler.moduleStage(load_and_snap_fishobservation, context),
+        stage_scheduler.moduleStage(compute_modelled_crossings, context),
+        stage_scheduler.moduleStage(load_assessment_data, context),
+        stage_scheduler.moduleStage(compute_mainstems, context),
+    ])
+    
+    if fusedElevation:
+        stages.append(stage_scheduler.moduleStage(compute_elevations, context, 
+            run = lambda: compute_elevations.run(context, vertexgradient = True, segmentgradient = False)))
+    else:
+        stages.extend([
+            stage_scheduler.moduleStage(assign_raw_z, context),
+            stage_scheduler.moduleStage(smooth_z, context),
+            stage_scheduler.moduleStage(compute_vertex_gradient, context),
+        ])
+    
+    stages.append(stage_scheduler.moduleStage(break_streams_at_barriers, context))
+    
+    #re-assign elevations to broken streams
+    if fusedElevation:
+        stages.append(stage_scheduler.moduleStage(compute_elevations, context, name = "compute_elevations_broken",
+            run = lambda: compute_elevations.run(context, vertexgradient = False, segmentgradient = True)))
+    else:
+        stages.extend([
+            stage_scheduler.moduleStage(assign_raw_z, context, name = "assign_raw_z_broken"),
+            stage_scheduler.moduleStage(smooth_z, context, name = "smooth_z_broken"),
+            stage_scheduler.moduleStage(compute_segment_gradient, context),
+        ])
+    
+    stages.extend([
+        stage_scheduler.moduleStage(compute_updown_barriers_fish, context),
+        stage_scheduler.moduleStage(compute_gradient_accessibility, context),
+        stage_scheduler.moduleStage(compute_habitat_models, context),
+        stage_scheduler.moduleStage(compute_barriers_upstream_values, context),
+        #the parameters the species columns were computed with (see refresh_parameters)
+        stage_scheduler.moduleStage(species_parameters, context),
+    ])
+    
+    return stages
 
-startTime = datetime.now()
+def processWatershed(context, parameters = True):
+    
+    stages = watershedStages(context, parameters)
+    
+    if stageCheckpoints:
+        stages = stage_checkpoint.checkpointStages(stages, context)
+    
+    stage_scheduler.runStages(stages, stageWorkers)
 
-iniSection = appconfig.args.args[0]
 
-workingWatershedId = appconfig.config[iniSection]['watershed_id']
+def main():
+    
+    startTime = datetime.now()
+    
+    context = stage_context.fromArgs()
+    
+    print ("Processing: " + context.watershedId)
+    
+    #forking dem worker processes while stages run in other threads can
+    #deadlock, so dem files are sampled one at a time (see assign_raw_z)
+    if stageWorkers > 1 and assign_raw_z.demWorkers > 1:
+        print("WARNING: dem_workers is ignored when stage_workers is more than 1; dem files are sampled one at a time")
+    
 
-print ("Processing: " + workingWatershedId)
+    #the species parameters are shared by all watersheds; when processing
+    #multiple watersheds they are loaded once up front (see process_watersheds)
+    processWatershed(context, not appconfig.args.noparameters)
+    
+    print ("Processing Complete: " + context.watershedId)
+    print("Runtime: " + str((datetime.now() - startTime)))
 
-load_parameters.main()
-preprocess_watershed.main()
-load_and_snap_barriers_cabd.main()
-load_and_snap_fishobservation.main()
-compute_modelled_crossings.main()
-load_assessment_data.main()
-compute_mainstems.main()
-assign_raw_z.main()
-smooth_z.main()
-compute_vertex_gradient.main()
-break_streams_at_barriers.main()
-#re-assign elevations to broken streams
-assign_raw_z.main()
-smooth_z.main()
-compute_segment_gradient.main()
-compute_updown_barriers_fish.main()
-compute_gradient_accessibility.main()
-compute_habitat_models.main()
-compute_barriers_upstream_values.main()
 
-print ("Processing Complete: " + workingWatershedId)
-print("Runtime: " + str((datetime.now() - startTime)))
+if __name__ == "__main__":
+    main()
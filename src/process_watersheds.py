@@ -0,0 +1,100 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+#
+# Processes multiple watersheds, running process_watershed for each 
+# watershed section in its own process with up to watershed_workers
+# (PROCESSING config section) watersheds processed at the same time. 
+# Each watershed writes to its own output schema so they are independent;
+# the fish species parameters shared by all watersheds are loaded once 
+# before any of the watersheds are processed.
+#
+# process_watersheds.py -c config.ini [watershedid ...] -user [username] -password [password]
+#
+# If no watershed ids are given all config sections with a watershed_id
+# are processed. Output from each watershed is prefixed with its id.
+#
+
+from datetime import datetime
+import os
+import sys
+import subprocess
+import concurrent.futures
+import appconfig
+
+#shared modules are imported directly by the processing scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "processing_scripts"))
+
+from processing_scripts import load_parameters
+from processing_scripts import stage_context
+
+#maximum number of watersheds processed at the same time
+watershedWorkers = int(appconfig.config['PROCESSING'].get('watershed_workers', '1'))
+
+processScript = os.path.join(os.path.dirname(os.path.abspath(__file__)), "process_watershed.py")
+
+def getSections():
+    if len(appconfig.args.args) > 0:
+        return appconfig.args.args
+    return [section for section in appconfig.config.sections() if 'watershed_id' in appconfig.config[section]]
+
+#
+# runs process_watershed for the section returning the process exit code;
+# credentials are passed on in the environment (not the command line where
+# they would be visible to other users) so the process doesn't prompt for them
+#
+def processWatershed(section):
+    
+    command = [sys.executable, processScript, section, "-noparameters"]
+    if appconfig.args.c:
+        command.extend(["-c", appconfig.args.c])
+    
+    env = dict(os.environ, PGUSER = appconfig.dbUser, PGPASSWORD = appconfig.dbPassword)
+    
+    with subprocess.Popen(command, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, 
+                          stdin = subprocess.DEVNULL, env = env, text = True) as process:
+
+        for line in process.stdout:
+            print("[" + section + "] " + line, end = "", flush = True)
+    
+    return process.returncode
+
+
+def main():
+    
+    startTime = datetime.now()
+    
+    sections = getSections()
+    load_parameters.run(stage_context.StageContext(None))
+    
+    print("Processing " + str(len(sections)) + " watersheds with " + str(watershedWorkers) + " workers: " + ", ".join(sections))
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers = watershedWorkers) as pool:
+        results = list(pool.map(processWatershed, sections))
+    
+    failed = [section for section, result in zip(sections, results) if result != 0]
+    
+    for section, result in zip(sections, results):
+        print("  " + section + ": " + ("complete" if result == 0 else "FAILED (exit code " + str(result) + ")"))
+    print("Runtime: " + str((datetime.now() - startTime)))
+    
+    if len(failed) > 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -33,6 +33,7 @@ parser = argparse.ArgumentParser(description='Process habitat modelling for wate
 parser.add_argument('-c', type=str, help='the configuration file', required=False)
 parser.add_argument('-user', type=str, help='the username to access the database')
 parser.add_argument('-password', type=str, help='the password to access the database')
+parser.add_argument('-noparameters', action='store_true', help='do not reload the fish species parameters')
 parser.add_argument('args', type=str, nargs='*')
 args = parser.parse_args()
 
@@ -50,8 +51,21 @@ gdalsrsinfo = config['OGR']['gdalsrsinfo']
 dbHost = config['DATABASE']['host']
 dbPort = config['DATABASE']['port']
 dbName = config['DATABASE']['name']
-dbUser = input(f"""Enter username to access {dbName}:\n""")
-dbPassword = getpass.getpass(f"""Enter password to access {dbName}:\n""")
+#credentials are prompted for unless given on the command line or in the
+#PGUSER and PGPASSWORD environment variables
+if args.user:
+    dbUser = args.user
+elif os.environ.get("PGUSER"):
+    dbUser = os.environ["PGUSER"]
+else:
+    dbUser = input(f"""Enter username to access {dbName}:\n""")
+if args.password:
+    dbPassword = args.password
+elif os.environ.get("PGPASSWORD"):
+    dbPassword = os.environ["PGPASSWORD"]
+else:
+    dbPassword = getpass.getpass(f"""Enter password to access {dbName}:\n""")
+
 
 dataSchema = config['DATABASE']['data_schema']
 streamTable = config['DATABASE']['stream_table']
@@ -25,21 +25,42 @@ import appconfig
 import os
 import numpy
 import tifffile as tif
+from dem_raster import DemRaster
 import shapely.wkb
 import shapely.geometry
-from math import floor
 import json
-import psycopg2.extras
+import tempfile
+import bulk_writer
+import multiprocessing
+import threading
+import concurrent.futures
+from collections import OrderedDict
+import stage_context
 
-iniSection = appconfig.args.args[0]
-watershed_id = appconfig.config[iniSection]['watershed_id']
-dbTargetSchema = appconfig.config[iniSection]['output_schema']
 dbTargetTable = appconfig.config['PROCESSING']['stream_table']
 
 dbTargetGeom = appconfig.config['ELEVATION_PROCESSING']['3dgeometry_field']
 demDir = appconfig.config['ELEVATION_PROCESSING']['dem_directory'];
+#cache of dem file details so files are only inspected when they change
+demCatalogue = appconfig.config['ELEVATION_PROCESSING'].get('dem_catalogue', os.path.join(demDir, "dem_catalogue.json"))
 
-demfiles = []
+#maximum number of dem files kept open at once
+demCacheSize = 16
+
+#number of worker processes used to sample dem files; 1 processes 
+#the dem files one at a time in this process
+demWorkers = int(appconfig.config['ELEVATION_PROCESSING'].get('dem_workers', '1'))
+
+#tables read and written by this script (see stage_scheduler)
+def stageInputs(context):
+    return [f"{context.targetSchema}.{dbTargetTable}"]
+
+def stageOutputs(context):
+    return [f"{context.targetSchema}.{dbTargetTable}"]
+
+#files read by this script (see stage_checkpoint)
+def stageFiles(context):
+    return sorted(demFiles())
 
 class DEMFile:
     def __init__(self, filename, xmin, ymin, xmax, ymax, xcellsize, ycellsize, xcnt, ycnt, srid, nodata):
@@ -54,14 +75,53 @@ class DEMFile:
         self.ycnt = ycnt
         self.srid = srid
         self.nodata = nodata
+
+
+#
+# the dem files (see indexDem) with a cache of the open rasters so 
+# files are opened once instead of for every lookup. Each run creates 
+# its own index so runs at the same time don't share open files.
+#
+class DemIndex:
+    
+    def __init__(self, demfiles):
+        self.files = demfiles
+        #bounding boxes (xmin, ymin, xmax, ymax) of files, one row per file
+        self.extents = numpy.array([[d.xmin, d.ymin, d.xmax, d.ymax] for d in demfiles], dtype=numpy.float64).reshape(-1, 4)
+        #open dem rasters by filename, least recently used first
+        self.rasters = OrderedDict()
+    
+    #open rasters are not copied to worker processes
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['rasters'] = OrderedDict()
+        return state
+    
+    #
+    # returns the open raster for the dem file
+    #
+    def openRaster(self, demfile):
+        raster = self.rasters.pop(demfile.filename, None)
+        if raster is None:
+            raster = DemRaster(demfile.filename)
+            if len(self.rasters) >= demCacheSize:
+                self.rasters.popitem(last=False)[1].close()
+        self.rasters[demfile.filename] = raster
+        return raster
+    
+    def closeRasters(self):
+        while len(self.rasters) > 0:
+            self.rasters.popitem()[1].close()
         
 
-def prepareOutput(conn):
+def prepareOutput(conn, context):
+    
+    dbTargetSchema = context.targetSchema
     
     #see comment below - st_force3d with custom z value
     #is only supported in newer postgis so I wrote my own
     #for now but this could be replaced if newer postgis used
-    force3dfunction = f"""{appconfig.dataSchema}.st_force3d"""
+    force3dfunction = f"""{dbTargetSchema}.st_force3d"""
     
     query = f"""
    
@@ -106,16 +166,135 @@ def indexDem():
     #read all files in dem
     #get bounds
     #build index of 
+    
     print("indexing dem files")
+    catalogue = loadCatalogue()
+    newcatalogue = {}
+    
     demfiles = [];
-    for demfile in os.listdir(demDir):
-        if (demfile.endswith('.tif') or demfile.endswith('.tiff')):
-            demfiles.append(getFileDetails(os.path.join(demDir,demfile)))
-    return demfiles
+    for filename in demFiles():
+        stat = os.stat(filename)
+        
+        entry = catalogue.get(filename)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime_ns:
+            details = readFileDetails(filename)
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'details': vars(details)}
+        else:
+            details = DEMFile(**entry['details'])
+        
+        newcatalogue[filename] = entry
+        demfiles.append(details)
+    
+    if newcatalogue != catalogue:
+        saveCatalogue(newcatalogue)
+    
+    return DemIndex(demfiles)
+
+#the dem files in the dem directory
+def demFiles():
+    return [os.path.join(demDir, demfile) for demfile in os.listdir(demDir) 
+            if demfile.endswith('.tif') or demfile.endswith('.tiff')]
+
   
-def getFileDetails(demfile):
+def loadCatalogue():
+    if not os.path.exists(demCatalogue):
+        return {}
+    try:
+        with open(demCatalogue, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print("    WARNING: unable to read dem catalogue " + demCatalogue + ": " + str(e))
+        return {}
+
+#
+# the catalogue is written to a temporary file that replaces the catalogue
+# so watersheds processed at the same time (see process_watersheds) never
+# read a partially written catalogue or write to the same file
+#
+def saveCatalogue(catalogue):
+    tempname = None
+    try:
+        fd, tempname = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(demCatalogue)), 
+                                        prefix = os.path.basename(demCatalogue), suffix = ".tmp")
+        with os.fdopen(fd, 'w') as f:
+            json.dump(catalogue, f, indent=1)
+        os.replace(tempname, demCatalogue)
+    except OSError as e:
+        print("    WARNING: unable to write dem catalogue " + demCatalogue + ": " + str(e))
+        if tempname is not None and os.path.exists(tempname):
+            os.remove(tempname)
+
+
+#
+# reads the dem file details from the GeoTIFF tags, falling back
+# to gdal if the file is not georeferenced with an EPSG code
+#
+def readFileDetails(demfile):
+    details = readGeoTiffDetails(demfile)
+    if details is None:
+        details = getFileDetails(demfile)
+    return details
+
+def readGeoTiffDetails(demfile):
     print("    reading: " + demfile)
     
+    with tif.TiffFile(demfile) as tiffile:
+        page = tiffile.pages[0]
+        
+        geokeys = getTagValue(page, 34735)
+        scale = getTagValue(page, 33550)
+        tiepoint = getTagValue(page, 33922)
+        nodata = getTagValue(page, 42113)
+        
+        if geokeys is None or scale is None or tiepoint is None or nodata is None:
+            return None
+        
+        #GeoKeyDirectory: header followed by (key id, tag location, count, value)
+        #only keys stored directly in the directory (tag location 0) are used
+        keys = {}
+        for i in range(4, 4 + 4 * geokeys[3], 4):
+            if geokeys[i + 1] == 0:
+                keys[geokeys[i]] = geokeys[i + 3]
+        
+        #ProjectedCSTypeGeoKey or GeographicTypeGeoKey for geographic models
+        if keys.get(1024) == 2:
+            srid = keys.get(2048)
+        else:
+            srid = keys.get(3072)
+        #32767 is user defined
+        if srid is None or srid == 32767:
+            return None
+        
+        xcnt = page.imagewidth
+        ycnt = page.imagelength
+        
+        xsize = scale[0]
+        ysize = scale[1]
+        
+        xmin = tiepoint[3] - tiepoint[0] * xsize
+        ymax = tiepoint[4] + tiepoint[1] * ysize
+        
+        #PixelIsPoint rasters reference cell centers
+        if keys.get(1025) == 2:
+            xmin -= 0.5 * xsize
+            ymax += 0.5 * ysize
+        
+        xmax = xmin + xcnt * xsize
+        ymin = ymax - ycnt * ysize
+        
+        nodata = float(nodata.strip().strip('\x00'))
+        
+    return DEMFile(demfile, xmin, ymin, xmax, ymax, xsize, ysize, xcnt, ycnt, str(srid), nodata)
+
+def getTagValue(page, code):
+    tag = page.tags.get(code)
+    if tag is None:
+        return None
+    return tag.value
+
+def getFileDetails(demfile):
+    print("    reading (gdal): " + demfile)
+    
     out = subprocess.run("\"" + appconfig.gdalsrsinfo + "\" -e -o epsg " + "\"" + demfile + "\"", capture_output=True)
     srid = out.stdout.decode('utf-8').split(':')[1].strip()
     
@@ -141,23 +320,165 @@ def getFileDetails(demfile):
 
     return DEMFile(demfile, xmin, ymin, xmax,ymax, xsize, ysize, xcnt, ycnt, srid, nodata)    
 
-def processArea(demfile, connection, onlymissing = False):
+def processArea(dem, demfile, connection, context, onlymissing = False):
     print("    processing: " + (demfile.filename))
     
-    #get edges
+    srid = getSrid(connection, context)
+    fids, coords = loadArea(demfile, connection, context, srid, onlymissing)
+    if (len(fids) == 0):
+        return
+    
+    print("      processing")
+    allz, updated = sampleArea(dem, demfile, coords, onlymissing)
+    
+    elevations = {}
+    mergeElevations(elevations, fids, coords, allz, updated, onlymissing)
+    
+    print("      saving results")
+    writeElevations(connection, context, srid, elevations)
+
+
+#
+# processes all dem files, sampling the dem files in demWorkers
+# worker processes. Results are merged in dem file order (so where 
+# dem files overlap the later file is used, as when processing the 
+# files one at a time) and written once at the end.
+#
+def processAreas(dem, connection, context, onlymissing = False):
+    
+    srid = getSrid(connection, context)
+    
+    areas = []
+    for demfile in dem.files:
+        print("    loading: " + (demfile.filename))
+        fids, coords = loadArea(demfile, connection, context, srid, onlymissing)
+        if (len(fids) > 0):
+            areas.append((demfile, fids, coords))
+    
+    results = sampleAreas(dem, areas, onlymissing, connection)
+    
+    elevations = {}
+    for (demfile, fids, coords), (allz, updated) in zip(areas, results):
+        mergeElevations(elevations, fids, coords, allz, updated, onlymissing)
+    
+    print("    saving results")
+    writeElevations(connection, context, srid, elevations)
+    
+
+#
+# samples the (demfile, fids, coords) areas returning the (allz, updated)
+# results for each area; when demWorkers > 1 the areas are sampled in
+# worker processes. The socket of the database connection (if given) is
+# closed in the workers so they don't hold on to it.
+#
+def sampleAreas(dem, areas, onlymissing, connection = None):
+    
+    if demWorkers <= 1:
+        return [sampleArea(dem, demfile, coords, onlymissing) for demfile, fids, coords in areas]
+    
+    #forking while other threads are running (stage_workers > 1, see 
+    #stage_scheduler) can deadlock the workers on locks held by those threads
+    if threading.active_count() > 1:
+        print("    other stages are running; sampling dem files one at a time")
+        return [sampleArea(dem, demfile, coords, onlymissing) for demfile, fids, coords in areas]
+    
+    print("    sampling " + str(len(areas)) + " dem files with " + str(demWorkers) + " workers")
+    
+    #workers are forked so they share the loaded configuration
+    #(appconfig prompts for credentials when it is imported)
+    if 'fork' in multiprocessing.get_all_start_methods():
+        inherited = [connection.fileno()] if connection is not None else []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=demWorkers, 
+                mp_context=multiprocessing.get_context('fork'), 
+                initializer=closeInherited, initargs=(inherited,)) as pool:
+            
+            futures = [pool.submit(sampleAreaWorker, dem, demfile, coords, onlymissing) for demfile, fids, coords in areas]
+            return [future.result() for future in futures]
+    
+    print("    WARNING: worker processes are not supported on this platform; sampling dem files one at a time")
+    return [sampleArea(dem, demfile, coords, onlymissing) for demfile, fids, coords in areas]
+
+#
+# closes the file descriptors a worker process inherited (the database
+# connection sockets) when it starts
+#
+def closeInherited(fds):
+    for fd in fds:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+
+#
+# samples an area in a worker process; the dem files opened by the 
+# worker are closed once the area is sampled
+#
+def sampleAreaWorker(dem, demfile, coords, onlymissing):
+    try:
+        return sampleArea(dem, demfile, coords, onlymissing)
+    finally:
+        dem.closeRasters()
+
+
+#
+# assigns elevations to features held in memory instead of loading and
+# saving them for each dem file (used by the fused elevation pipeline,
+# see compute_elevations). coords is a list of (n,3) coordinate arrays 
+# that are updated in place and bounds an (n,4) array of their bounding 
+# boxes; features must be in the same srid as the dem files. Dem files
+# are processed, including the pass for missing values, as in processAreas.
+# The database connection (if any) is not used by the worker processes.
+#
+def assignElevations(dem, coords, bounds, connection = None):
+    
+    elevations = dict(enumerate(coords))
+    
+    passes = [False]
+    if (len(dem.files) > 1):
+        passes.append(True)
+    
+    for onlymissing in passes:
+        areas = []
+        for demfile, (xmin, ymin, xmax, ymax) in zip(dem.files, dem.extents):
+            features = numpy.flatnonzero((bounds[:, 0] <= xmax) & (bounds[:, 2] >= xmin) & 
+                                         (bounds[:, 1] <= ymax) & (bounds[:, 3] >= ymin))
+            if onlymissing:
+                features = [f for f in features if (coords[f][:, 2] == appconfig.NODATA).any()]
+            if len(features) > 0:
+                areas.append((demfile, list(features), [coords[f].copy() for f in features]))
+        
+        results = sampleAreas(dem, areas, onlymissing, connection)
+        
+        for (demfile, fids, areacoords), (allz, updated) in zip(areas, results):
+
+            mergeElevations(elevations, fids, areacoords, allz, updated, onlymissing)
+    
+    dem.closeRasters()
+    
+
+def getSrid(connection, context):
     query = f"""
         SELECT srid 
         FROM public.geometry_columns
         WHERE
-        f_table_schema = '{dbTargetSchema}' and 
+        f_table_schema = '{context.targetSchema}' and 
         f_table_name = '{dbTargetTable}' and 
         f_geometry_column = '{appconfig.dbGeomField}'
     """
-    srid = -9999;
     
     with connection.cursor() as cursor:
         cursor.execute(query)
-        srid = cursor.fetchone()[0]
+        return cursor.fetchone()[0]
+
+
+#
+# loads the features that intersect the dem file returning the 
+# feature ids and a (n,3) coordinate array for each feature
+#
+def loadArea(demfile, connection, context, srid, onlymissing):
+    
+    dbTargetSchema = context.targetSchema
+    watershed_id = context.watershedId
     
     if onlymissing: 
         #only load features with at least one missing elevation values  
@@ -197,170 +518,238 @@ def processArea(demfile, connection, onlymissing = False):
             FROM {dbTargetSchema}.{dbTargetTable} t, env
             WHERE t.{dbTargetGeom} && env.bbox AND t.{appconfig.dbWatershedIdField} = '{watershed_id}'
         """
-    #print(query)
 
-    newvalues = [] 
+    fids = []
+    coords = []
     
     with connection.cursor() as cursor:
+        cursor.execute(query)
+        features = cursor.fetchall()
         
-            cursor.execute(query)
-            features = cursor.fetchall()
-            if (len(features) == 0):
-                return
-            print("      reading dem")
-            imarray = numpy.array(tif.imread(demfile.filename))
-            
-            print("      processing")
-            for feature in features:
-                geom = shapely.wkb.loads(feature[1] , hex=True)
-                fid = feature[0]
-                #print("processing: " + str(fid))
-                ls = processGeometry(geom, demfile, imarray, onlymissing)
-                newvalues.append(  (shapely.wkb.dumps(ls), fid) )
-                
-            imarray = None
-            connection.commit()
+        for feature in features:
+            geom = shapely.wkb.loads(feature[1] , hex=True)
+            fids.append(feature[0])
+            coords.append(numpy.array(geom.coords))
     
-    print("      saving results")
-    updatequery = f"""
-        UPDATE {dbTargetSchema}.{dbTargetTable} 
-        set {dbTargetGeom} = st_setsrid(st_geomfromwkb(%s),{srid})
-        WHERE {appconfig.dbIdField} = %s
-    """
+    connection.commit()
+    return fids, coords
+
+
+#
+# samples all vertices for this dem file at once; only the
+# parts of the dem file that contain vertices are read
+#
+def sampleArea(dem, demfile, coords, onlymissing):
+    allcoords = numpy.concatenate(coords)
+    return sampleElevations(allcoords, dem, demfile, onlymissing)
+
+
+#
+# updates the feature coordinates in elevations (fid -> coordinate array) 
+# with the vertices that were assigned a value by a dem file; when only
+# processing missing values features that no longer have missing values
+# are skipped (as they would not be loaded for this dem file)
+#
+def mergeElevations(elevations, fids, coords, allz, updated, onlymissing):
+    offsets = numpy.cumsum([len(c) for c in coords])[:-1]
+    for fid, c, z, u in zip(fids, coords, numpy.split(allz, offsets), numpy.split(updated, offsets)):
+        if fid not in elevations:
+            elevations[fid] = c.copy()
+        elif onlymissing and not (elevations[fid][:, 2] == appconfig.NODATA).any():
+            continue
+        elevations[fid][u, 2] = z[u]
+
+
+def writeElevations(connection, context, srid, elevations):
+    newvalues = []
+    for fid, c in elevations.items():
+        ls = shapely.geometry.LineString(c)
+        newvalues.append(  (fid, shapely.wkb.dumps(ls, srid=srid)) )
     
-    with connection.cursor() as cursor2:
-        psycopg2.extras.execute_batch(cursor2, updatequery, newvalues);
+    bulk_writer.updateTable(connection, f"{context.targetSchema}.{dbTargetTable}", 
+        appconfig.dbIdField, [dbTargetGeom], newvalues)
             
     connection.commit()
     
     
+#
+# computes the elevation for an array of x,y,z coordinates (one row per vertex)
+# using bilinear interpolation of the four dem cells nearest to each vertex
+# (see Draping Algorithm in README)
+#
+# returns an array of z values, and a mask of the vertices that were 
+# assigned a value from the dem, where:
+#  * vertices that require cells outside this dem file keep their existing
+#    value unless onlymissing is set, in which case these cells are read from 
+#    the other dem files
+#  * vertices where a required cell can't be found in any dem file keep their
+#    existing value
+#  * vertices where a required cell is nodata in the dem are assigned NODATA
+#
+def sampleElevations(coords, dem, demfile, onlymissing):
     
-def processGeometry(geom, demfile, demdata, onlymissing):
+    x = coords[:, 0]
+    y = coords[:, 1]
+    z = coords[:, 2]
     
-    newpnts = [];
-    for c in geom.coords:
-        x = c[0]
-        y = c[1]
-        z = c[2];
-        newpnts.append(processCoordinate(x, y, z, demfile, demdata, onlymissing))
-            
-    #make a geometry from newpnts
-    ls = shapely.geometry.LineString(newpnts)
-    return ls   
-
-
-def processCoordinate(x, y, z, demfile, demdata, onlymissing):
-
-    #find the dem cell and use that for now
-    xindex = floor((x - demfile.xmin) / demfile.xcellsize)
-    yindex = demfile.ycnt - floor((y - demfile.ymin) / abs(demfile.ycellsize)) - 1
-         
-    centerx = xindex * demfile.xcellsize + demfile.xmin + 0.5 * demfile.xcellsize
-    centery = (demfile.ycnt - yindex -1) * abs(demfile.ycellsize) + demfile.ymin + 0.5 * abs(demfile.ycellsize)
-            
-    if ( x < centerx ):
-        xindex2 = xindex - 1
-    else:
-        xindex2 = xindex + 1
-                
-    if ( y < centery ):
-        yindex2 = yindex + 1
-    else:
-        yindex2 = yindex - 1
-     
+    ycellsize = abs(demfile.ycellsize)
     
-    if (onlymissing == False):
-        #if out of range return no data for now - we will go back and deal with 
-        #points that require multiple files later
-        #often dem files will overlap a bit so this edge will
-        #be processed by another area
-        if (xindex < 0 or xindex >= demfile.xcnt or yindex < 0 or yindex >= demfile.ycnt  or
-            xindex2 < 0 or xindex2 >= demfile.xcnt or yindex2 < 0 or yindex2 >= demfile.ycnt ): 
-            return [x, y, z];
-   
+    #find the dem cell containing the point and the neighbouring cells
+    #in the direction of the point from the cell center
+    xindex = numpy.floor((x - demfile.xmin) / demfile.xcellsize).astype(numpy.int64)
+    yindex = demfile.ycnt - numpy.floor((y - demfile.ymin) / ycellsize).astype(numpy.int64) - 1
     
     x1 = xindex * demfile.xcellsize + demfile.xmin + 0.5 * demfile.xcellsize
+    y1 = (demfile.ycnt - yindex - 1) * ycellsize + demfile.ymin + 0.5 * ycellsize
+    
+    xindex2 = numpy.where(x < x1, xindex - 1, xindex + 1)
+    yindex2 = numpy.where(y < y1, yindex + 1, yindex - 1)
+    
     x2 = xindex2 * demfile.xcellsize + demfile.xmin + 0.5 * demfile.xcellsize
-    y1 = (demfile.ycnt - yindex -1) * abs(demfile.ycellsize) + demfile.ymin + 0.5 * abs(demfile.ycellsize)
-    y2 =  (demfile.ycnt - yindex2 -1) * abs(demfile.ycellsize) + demfile.ymin + 0.5 * abs(demfile.ycellsize)
+    y2 = (demfile.ycnt - yindex2 - 1) * ycellsize + demfile.ymin + 0.5 * ycellsize
     
-    if (xindex >= 0 and yindex >= 0 and xindex < demfile.xcnt and yindex < demfile.ycnt):
-        zx1y1 = demdata[yindex][xindex]
-    else:
-        zx1y1 = findElevation(x1, y1)
-        
-    if (xindex2 >= 0 and yindex >= 0 and xindex2 < demfile.xcnt and yindex < demfile.ycnt):
-        zx2y1 = demdata[yindex][xindex2]
+    inx1 = (xindex >= 0) & (xindex < demfile.xcnt)
+    inx2 = (xindex2 >= 0) & (xindex2 < demfile.xcnt)
+    iny1 = (yindex >= 0) & (yindex < demfile.ycnt)
+    iny2 = (yindex2 >= 0) & (yindex2 < demfile.ycnt)
+    
+    if onlymissing:
+        process = numpy.ones(len(coords), dtype=bool)
     else:
-        zx2y1 = findElevation(x2, y1)
+        #if out of range keep the existing value for now - we will go back and deal with 
+        #points that require multiple files later
+        #often dem files will overlap a bit so this edge will
+        #be processed by another area
+        process = inx1 & inx2 & iny1 & iny2
+    
+    #read the four corners together so each dem block is only read once
+    cornervalues = getCellValues(dem, demfile,
+        numpy.concatenate((xindex, xindex2, xindex2, xindex)),
+        numpy.concatenate((yindex, yindex, yindex2, yindex2)),
+        numpy.concatenate((x1, x2, x2, x1)),
+        numpy.concatenate((y1, y1, y2, y2)),
+        numpy.tile(process, 4),
+        numpy.concatenate((inx1 & iny1, inx2 & iny1, inx2 & iny2, inx1 & iny2)))
+    
+    corners = numpy.split(cornervalues, 4)
+    zx1y1, zx2y1, zx2y2, zx1y2 = corners
+    
+    #no data for this points
+    missing = numpy.zeros(len(coords), dtype=bool)
+    for corner in corners:
+        missing |= (corner == appconfig.NODATA)
+    
+    #not enough data to determine
+    nodata = numpy.zeros(len(coords), dtype=bool)
+    for corner in corners:
+        nodata |= (corner == demfile.nodata)
+    
+    #bilinear interpolation of elevation
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        fxy1 = ((x2 - x) / (x2 - x1)) * zx1y1 + ((x - x1) / (x2 - x1)) * zx2y1
+        fxy2 = ((x2 - x) / (x2 - x1)) * zx1y2 + ((x - x1) / (x2 - x1)) * zx2y2
+        fxy = ((y2 - y) / (y2 - y1)) * fxy1 + ((y - y1) / (y2 - y1)) * fxy2
+    
+    newz = numpy.where(nodata, appconfig.NODATA, fxy)
+    updated = process & ~missing
+    newz = numpy.where(updated, newz, z)
+    return newz, updated
+
+
+#
+# returns the dem values for the given cells; cells outside the dem file
+# are looked up in the other dem files
+#
+def getCellValues(dem, demfile, xindex, yindex, xcenter, ycenter, process, inside):
+    
+    values = numpy.full(len(xindex), appconfig.NODATA, dtype=numpy.float64)
+    
+    read = process & inside
+    values[read] = dem.openRaster(demfile).readCells(yindex[read], xindex[read])
+    
+    outside = process & ~inside
+    values[outside] = findElevations(dem, xcenter[outside], ycenter[outside])
+    
+    return values
+
+
+#
+# search through all dem files for elevation at the given points
+# determine by dropping coordinate into dem; should be centered if all dem's are the same
+# but if not won't worry about it for these purposes
+# 
+# each point uses the first dem file (in index order) that contains it
+#
+def findElevations(dem, x, y):
+    
+    values = numpy.full(len(x), appconfig.NODATA, dtype=numpy.float64)
+    pending = numpy.ones(len(x), dtype=bool)
+    
+    if len(x) == 0:
+        return values
+    
+    #candidate dem files are those whose bounds overlap the points
+    candidates = numpy.flatnonzero(
+        (dem.extents[:, 0] <= x.max()) & (dem.extents[:, 2] >= x.min()) &
+        (dem.extents[:, 1] <= y.max()) & (dem.extents[:, 3] >= y.min()))
+    
+    for fileindex in candidates:
+        xmin, ymin, xmax, ymax = dem.extents[fileindex]
+        found = pending & (xmin <= x) & (xmax >= x) & (ymin <= y) & (ymax >= y)
+        if not found.any():
+            continue
         
-    if (xindex2 >= 0 and yindex2 >= 0 and xindex2 < demfile.xcnt and yindex2 < demfile.ycnt):
-        zx2y2 = demdata[yindex2][xindex2]
-    else:
-        zx2y2 = findElevation(x2, y2)
+        demfile = dem.files[fileindex]
+        xindex = numpy.floor((x[found] - demfile.xmin) / demfile.xcellsize).astype(numpy.int64)
+        yindex = demfile.ycnt - numpy.floor((y[found] - demfile.ymin) / abs(demfile.ycellsize)).astype(numpy.int64) - 1
         
-    if (xindex >= 0 and yindex2 >= 0 and xindex < demfile.xcnt and yindex2 < demfile.ycnt):    
-        zx1y2 = demdata[yindex2][xindex]
-    else:
-        zx1y2 = findElevation(x1, y2)
-                
-    if (zx1y1 == appconfig.NODATA or zx1y2 == appconfig.NODATA or zx2y2 == appconfig.NODATA or zx1y2 == appconfig.NODATA):
-        #no data for this points
-        return [x,y,z]
-               
-    if (zx1y1 == demfile.nodata or zx2y1 == demfile.nodata or
-        zx2y1 == demfile.nodata or zx2y2 == demfile.nodata ):
-        #not enough data to determine
-        return [x, y, appconfig.NODATA]
+        #points on the right/bottom edge of the file use the last cell
+        xindex = numpy.clip(xindex, 0, demfile.xcnt - 1)
+        yindex = numpy.clip(yindex, 0, demfile.ycnt - 1)
         
-    #bilinear interpolation of  elevation
-    fxy1 = ((x2 - x) / (x2- x1))*zx1y1 + ((x - x1)/(x2 - x1))*zx2y1
-    fxy2 = ((x2 - x) / (x2- x1))*zx1y2 + ((x - x1)/(x2 - x1))*zx2y2
-    fxy = ((y2 - y) / (y2 - y1))*fxy1 + ((y - y1)/(y2 - y1))*fxy2
+        values[found] = dem.openRaster(demfile).readCells(yindex, xindex)
+        pending &= ~found
         
-    return [x,y,fxy]
-
-
-def findElevation(x, y):
-    #search through all dem files for elevation at that point
-    #determine by dropping coordinate into dem; should be centered if all dem's are the same
-    #but if not won't worry about it for these purposes
-    for demfile in demfiles:
-        if (demfile.xmin <= x and demfile.xmax >= x and demfile.ymin <= y and demfile.ymax >= y ):
-            #read file
-            xindex = floor((x - demfile.xmin) / demfile.xcellsize)
-            yindex = demfile.ycnt - floor((y - demfile.ymin) / abs(demfile.ycellsize)) - 1
-            
-            memmap_image = tif.memmap(demfile.filename)
-            z = memmap_image[yindex][xindex]
-            del memmap_image
-            return z
+        if not pending.any():
+            break
     
-    return appconfig.NODATA    
+    return values
 
-#--- main program ---
-def main():
+def run(context):
     
-    with appconfig.connectdb() as conn:
+    with context.connect() as conn:
         
-        prepareOutput(conn);
+        prepareOutput(conn, context);
     
-        demfiles = indexDem()
+        dem = indexDem()
         
         #process each dem file
         print("Computing Elevations")
-        for demfile in demfiles:
-            processArea(demfile, conn)
+        if demWorkers > 1:
+            processAreas(dem, conn, context)
+        else:
+            for demfile in dem.files:
+                processArea(dem, demfile, conn, context)
     
         #search for any missing coordinates that may require 
         #multiple dem files to compute
         #if we have one giant dem file then ignore this
-        if (len(demfiles) > 1):
+        if (len(dem.files) > 1):
             print ("  computing overlap areas")
-            for demfile in demfiles:
-                processArea(demfile, conn, True)
+            if demWorkers > 1:
+                processAreas(dem, conn, context, True)
+            else:
+                for demfile in dem.files:
+                    processArea(dem, demfile, conn, context, True)
+        
+        dem.closeRasters()
 
     print("done")
 
+#--- main program ---
+def main():
+    run(stage_context.fromArgs())
+
+
 if __name__ == "__main__":
     main()     
\ No newline at end of file
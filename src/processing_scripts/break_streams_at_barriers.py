@@ -21,11 +21,8 @@
 # ASSUMPTION - data is in equal area projection where distance functions return values in metres
 #
 import appconfig
-from imagecodecs.imagecodecs import NONE
+import stage_context
 
-iniSection = appconfig.args.args[0]
-dbTargetSchema = appconfig.config[iniSection]['output_schema']
-watershed_id = appconfig.config[iniSection]['watershed_id']
 dbTargetStreamTable = appconfig.config['PROCESSING']['stream_table']
 
 dbBarrierTable = appconfig.config['BARRIER_PROCESSING']['barrier_table']
@@ -35,8 +32,106 @@ dbCrossingsTable = appconfig.config['CROSSINGS']['crossings_table']
 dbVertexTable = appconfig.config['GRADIENT_PROCESSING']['vertex_gradient_table']
 dbTargetGeom = appconfig.config['ELEVATION_PROCESSING']['smoothedgeometry_field']
 
-def breakstreams (conn):
+#copy of the streams before they are broken so they can be broken again
+#(at different gradient barriers) without reprocessing the watershed 
+#(see refresh_parameters); only kept when enabled as it doubles the 
+#storage used by the streams
+dbUnbrokenTable = dbTargetStreamTable + "_unbroken"
+keepUnbroken = appconfig.config['PROCESSING'].getboolean('keep_unbroken_streams', False)
+
+#tables read and written by this script (see stage_scheduler)
+def stageInputs(context):
+    return [f"{context.targetSchema}.{dbTargetStreamTable}",
+            f"{context.targetSchema}.{dbBarrierTable}",
+            f"{context.targetSchema}.{dbVertexTable}",
+            f"{appconfig.dataSchema}.{appconfig.fishSpeciesTable}"]
+
+def stageOutputs(context):
+    return [f"{context.targetSchema}.{dbTargetStreamTable}",
+            f"{context.targetSchema}.break_points",
+            f"{context.targetSchema}.{dbBarrierTable}",
+            f"{context.targetSchema}.{dbCrossingsTable}",
+            f"{context.targetSchema}.{dbModelledCrossingsTable}",
+            f"{context.targetSchema}.{dbUnbrokenTable}"]
+
+#only the smallest accessibility gradient is read from the species
+#parameters (see stage_checkpoint)
+def stageQueries(context):
+    return {f"{appconfig.dataSchema}.{appconfig.fishSpeciesTable}": 
+        f"SELECT min(accessibility_gradient) FROM {appconfig.dataSchema}.{appconfig.fishSpeciesTable}"}
+
+#streams are split at the break points; the scripts run before this one
+#can't be rerun on the broken streams (see stage_checkpoint)
+def stageRebuilds(context):
+    return [f"{context.targetSchema}.{dbTargetStreamTable}"]
+
+
+#
+# saves a copy of the streams when keepUnbroken is set; otherwise a copy
+# saved by an earlier run is removed as it no longer matches the streams
+#
+def saveUnbroken(connection, context):
+    
+    dbTargetSchema = context.targetSchema
+    
+    query = f"""
+        DROP TABLE IF EXISTS {dbTargetSchema}.{dbUnbrokenTable};
+    """
+    if keepUnbroken:
+        query += f"""
+        CREATE TABLE {dbTargetSchema}.{dbUnbrokenTable} AS
+        SELECT * FROM {dbTargetSchema}.{dbTargetStreamTable};
+        """
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+    connection.commit()
+
+def hasUnbroken(connection, context):
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT to_regclass('{context.targetSchema}.{dbUnbrokenTable}') IS NOT NULL")
+        return cursor.fetchone()[0]
+
+#
+# replaces the streams with the copy of the streams saved before they 
+# were broken. The table is restored in place so its indexes, defaults 
+# and grants are kept; columns added by the scripts run after this one 
+# are dropped so these scripts can be run again
+#
+def restoreUnbroken(connection, context):
+    
+    dbTargetSchema = context.targetSchema
+    
+    query = """
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = %s AND table_name = %s
+        ORDER BY ordinal_position
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query, (dbTargetSchema, dbUnbrokenTable))
+        columns = [row[0] for row in cursor.fetchall()]
+        cursor.execute(query, (dbTargetSchema, dbTargetStreamTable))
+        added = [row[0] for row in cursor.fetchall() if row[0] not in columns]
+    
+    dropstr = "".join([f'ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable} DROP COLUMN "{column}";\n' for column in added])
+    columnstr = ", ".join([f'"{column}"' for column in columns])
+    
+    query = f"""
+        {dropstr}
+        TRUNCATE {dbTargetSchema}.{dbTargetStreamTable};
+        
+        INSERT INTO {dbTargetSchema}.{dbTargetStreamTable} ({columnstr})
+        SELECT {columnstr} FROM {dbTargetSchema}.{dbUnbrokenTable};
         
+        ANALYZE {dbTargetSchema}.{dbTargetStreamTable};
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+    connection.commit()
+
+def breakstreams (conn, context):
+    
+    dbTargetSchema = context.targetSchema
+    
     #find all break points
     # all barriers regardless of passability status (dams, modelled crossings, and assessed crossings)
     # all gradient barriers (Vertex gradient > min fish gradient)
@@ -79,65 +174,38 @@ def breakstreams (conn):
         mingradient = features[0][0]
         
         
-    query = f"""    
-        SELECT mainstem_id, st_Force2d(vertex_pnt), gradient
-        FROM {dbTargetSchema}.{dbVertexTable}
-        ORDER BY mainstem_id, downstream_route_measure
+    # a vertex is a gradient barrier when its gradient is larger than 
+    # the minimum fish gradient and the previous (downstream) vertex on 
+    # the mainstem is not; for the first vertex on a mainstem the 
+    # previous vertex is the vertex at the downstream end of the streams
+    # that touch it. All break points are found and inserted with one
+    # statement instead of querying and inserting each point separately.
+    query = f"""
+        WITH vertices AS (
+            SELECT st_force2d(vertex_pnt) as point, gradient,
+                lag(gradient) OVER (PARTITION BY mainstem_id ORDER BY downstream_route_measure) as lastgradient
+            FROM {dbTargetSchema}.{dbVertexTable}
+        )
+        INSERT INTO {dbTargetSchema}.break_points(point, barrier_id, type, passability_status)
+        SELECT a.point, gen_random_uuid(), 'gradient_barrier', 'BARRIER'
+        FROM vertices a
+        WHERE a.gradient > {mingradient}
+            AND (
+                (a.lastgradient IS NOT NULL AND a.lastgradient <= {mingradient})
+                OR
+                (a.lastgradient IS NULL AND EXISTS (
+                    SELECT 1
+                    FROM {dbTargetSchema}.{dbTargetStreamTable} b,
+                        {dbTargetSchema}.{dbVertexTable} c
+                    WHERE st_intersects(b.geometry, a.point)
+                        AND c.vertex_pnt && st_endpoint(b.geometry)
+                        AND c.gradient <= {mingradient}
+                ))
+            );
     """
-        
+    
     with conn.cursor() as cursor:
         cursor.execute(query)
-        
-        features = cursor.fetchall()
-        
-        lastmainstem = NONE
-        lastgradient = -1
-        
-        for feature in features:
-            mainstem = feature[0]
-            point = feature[1]
-            gradient = feature[2]
-            
-            insert = False
-            if (lastmainstem != mainstem and gradient > mingradient):
-                #we need to find what the gradient is at the downstream point here
-                # and only add this as a break point
-                # if downstream vertex is < 0.35
-                query = f"""
-                
-                    with pnt as (
-                        SELECT st_endpoint(a.geometry) as endpnt
-                        FROM {dbTargetSchema}.{dbTargetStreamTable} a
-                        WHERE st_intersects( a.geometry, '{point}')
-                    )
-                    SELECT gradient
-                    FROM {dbTargetSchema}.{dbVertexTable} a, pnt
-                    WHERE a.vertex_pnt && pnt.endpnt
-                    AND gradient <= {mingradient}
-                """ 
-                #print(query)
-                with conn.cursor() as cursor3:
-                    cursor3.execute(query)
-                    features3 = cursor3.fetchall()
-                    if (len(features3) > 0):
-                        insert = True
-    
-                
-
-            elif (gradient > mingradient) and \
-                not((lastgradient > mingradient and gradient > mingradient and lastmainstem == mainstem)):
-                
-                insert = True
-            
-            if insert:
-                # this is a point that is not the first point on a new mainstem 
-                # has a gradient larger than required values
-                # and has a downstream gradient that is less than required values  
-                query = f"""INSERT INTO {dbTargetSchema}.break_points(point, barrier_id, type, passability_status) values ('{point}', gen_random_uuid(), 'gradient_barrier', 'BARRIER');""" 
-                with conn.cursor() as cursor2:
-                    cursor2.execute(query)
-            lastmainstem = mainstem
-            lastgradient = gradient
             
     #break streams at snapped points
     #todo: may want to ensure this doesn't create small stream segments - 
@@ -206,7 +274,9 @@ def breakstreams (conn):
         cursor.execute(query)
     conn.commit()
 
-def recomputeMainstreamMeasure(connection):
+def recomputeMainstreamMeasure(connection, context):
+    
+    dbTargetSchema = context.targetSchema
     
     query = f"""
         WITH mainstems AS (
@@ -232,7 +302,9 @@ def recomputeMainstreamMeasure(connection):
     with connection.cursor() as cursor:
         cursor.execute(query)
 
-def updateBarrier(connection):
+def updateBarrier(connection, context):
+    
+    dbTargetSchema = context.targetSchema
     
     query = f"""
         ALTER TABLE {dbTargetSchema}.{dbBarrierTable} DROP COLUMN IF EXISTS stream_measure;
@@ -290,18 +362,28 @@ def updateBarrier(connection):
     with connection.cursor() as cursor:
         cursor.execute(query)                    
                         
-def main():
-    with appconfig.connectdb() as connection:
+def run(context):
+    with context.connect() as connection:
+        if keepUnbroken:
+            print("    saving unbroken streams")
+        saveUnbroken(connection, context)
+
+        
         print("    breaking streams at barrier points")
-        breakstreams(connection)
+
+        breakstreams(connection, context)
         
         print("    recomputing mainstem measures")
-        recomputeMainstreamMeasure(connection)
+        recomputeMainstreamMeasure(connection, context)
     
         print("    updating barrier stream references")
-        updateBarrier(connection)
+        updateBarrier(connection, context)
     
     print("Breaking stream complete.")
+
+def main():
+    run(stage_context.fromArgs())
     
+
 if __name__ == "__main__":
     main()     
\ No newline at end of file
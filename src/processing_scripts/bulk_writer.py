@@ -0,0 +1,110 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+#
+# Shared bulk writer used by the processing scripts to write computed
+# values back to the database.
+#
+# Rows are streamed with COPY into a temporary staging table and then
+# applied with a single UPDATE ... FROM join instead of one UPDATE
+# statement per row.
+#
+# Values can be None, strings, numbers, uuids, booleans, lists (written
+# as arrays) or bytes (written as hex; used for WKB geometries).
+#
+import io
+
+stagingTable = "bulk_writer_staging"
+
+#
+# updates the fields of the rows in table (schema qualified) matched on
+# keyfield; each row is a tuple of the key followed by the field values
+#
+def updateTable(connection, table, keyfield, fields, rows):
+
+    allfields = [keyfield] + list(fields)
+
+    #staging table has the same column types as the target table
+    query = f"""
+        DROP TABLE IF EXISTS {stagingTable};
+        CREATE TEMPORARY TABLE {stagingTable} AS
+        SELECT {','.join(allfields)} FROM {table} WITH NO DATA;
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+
+    copyRows(connection, stagingTable, allfields, rows)
+
+    setstr = ', '.join([f"{field} = s.{field}" for field in fields])
+
+    query = f"""
+        ANALYZE {stagingTable};
+
+        UPDATE {table} t
+        SET {setstr}
+        FROM {stagingTable} s
+        WHERE t.{keyfield} = s.{keyfield};
+
+        DROP TABLE {stagingTable};
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+
+
+#
+# copies the rows (tuples of values in field order) into the table
+#
+def copyRows(connection, table, fields, rows):
+
+    data = io.StringIO()
+    for row in rows:
+        data.write('\t'.join([formatValue(value) for value in row]))
+        data.write('\n')
+    data.seek(0)
+
+    with connection.cursor() as cursor:
+        cursor.copy_expert(f"COPY {table} ({','.join(fields)}) FROM STDIN", data)
+
+
+#
+# formats a value for COPY text format
+#
+def formatValue(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value).hex()
+    if isinstance(value, (list, tuple, set)):
+        return escapeText(formatArray(value))
+    return escapeText(str(value))
+
+def formatArray(values):
+    items = []
+    for value in values:
+        if value is None:
+            items.append('NULL')
+        elif isinstance(value, (list, tuple, set)):
+            items.append(formatArray(value))
+        else:
+            items.append('"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"')
+    return '{' + ','.join(items) + '}'
+
+def escapeText(value):
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
@@ -22,96 +22,50 @@
 #
 
 import appconfig
-import shapely.wkb
-from collections import deque
-import psycopg2.extras
+import numpy
+import bulk_writer
+import stream_network
+import stage_context
+import species_parameters
 
-iniSection = appconfig.args.args[0]
-dbTargetSchema = appconfig.config[iniSection]['output_schema']
-watershed_id = appconfig.config[iniSection]['watershed_id']
 dbTargetStreamTable = appconfig.config['PROCESSING']['stream_table']
 
 dbBarrierTable = appconfig.config['BARRIER_PROCESSING']['barrier_table']
 
-edges = []
-nodes = dict()
-species = []
+#tables read and written by this script (see stage_scheduler)
+def stageInputs(context):
+    return [f"{context.targetSchema}.{dbTargetStreamTable}",
+            f"{context.targetSchema}.{dbBarrierTable}",
+            f"{appconfig.dataSchema}.{appconfig.fishSpeciesTable}"]
 
-class Node:
-    
-    def __init__(self, x, y):
-        self.inedges = []
-        self.outedges = []
-        self.x = x
-        self.y = y
-        self.barrierids = set()
-   
-    def addInEdge(self, edge):
-        self.inedges.append(edge)
-   
-    def addOutEdge(self, edge):
-        self.outedges.append(edge)
-    
-class Edge:
-    def __init__(self, fromnode, tonode, fid, length, ls):
-        self.fromNode = fromnode
-        self.toNode = tonode
-        self.ls = ls
-        self.length = length
-        self.fid = fid
-        self.visited = False
-        self.speca = {} # species accessibility
-        self.specaup = {} # species accessibility upstream
-        self.spawn_habitat = {}
-        self.spawn_habitatup = {}
-        self.rear_habitat = {}
-        self.rear_habitatup = {}
-        self.habitat = {}
-        self.habitatup = {}
-        self.spawn_funchabitatup = {}
-        self.rear_funchabitatup = {}
-        self.funchabitatup = {}
-        self.spawn_habitat_all = None
-        self.spawn_habitatup_all = {}
-        self.rear_habitat_all = None
-        self.rear_habitatup_all = {}
-        self.habitat_all = None
-        self.habitatup_all = {}
-        self.spawn_funchabitat_all = {}
-        self.rear_funchabitat_all = {}
-        self.funchabitat_all = {}
-        self.spawn_funchabitatup_all = {}
-        self.rear_funchabitatup_all = {}
-        self.funchabitatup_all = {}
+def stageOutputs(context):
+    return [f"{context.targetSchema}.{dbBarrierTable}", f"{context.targetSchema}.temp"]
 
-        self.upbarriercnt = 0
-    
-    def print(self):
-        print("fid:", self.fid)
-        print("spawn_habitat:", self.spawn_habitat)
-        print("rear_habitat:", self.rear_habitat)
-        print("habitat:", self.habitat)
-        print("spawn_habitatup:", self.spawn_habitatup)
-        print("rear_habitatup:", self.rear_habitatup)
-        print("habitatup:", self.habitatup)
-        print("spawn_habitat_all:", self.spawn_habitat_all)
-        print("rear_habitat_all:", self.rear_habitat_all)
-        print("habitat_all:", self.habitat_all)
+#per species values loaded for each edge (edge x species boolean matrices)
+edgevalues = ['speca', 'spawn_habitat', 'rear_habitat', 'habitat']
 
-    def check_spawn_habitat_all(self):
-        result = any(val == True for val in self.spawn_habitat.values())
-        return result
-    
-    def check_rear_habitat_all(self):
-        result = any(val == True for val in self.rear_habitat.values())
-        return result
+#per species values accumulated walking down the network; for each the
+#edge value it accumulates and if it is functional (only accumulated up 
+#to the first barrier upstream)
+upvalues = [('specaup', 'speca', False), ('spawn_habitatup', 'spawn_habitat', False), 
+            ('rear_habitatup', 'rear_habitat', False), ('habitatup', 'habitat', False), 
+            ('spawn_funchabitatup', 'spawn_habitat', True), ('rear_funchabitatup', 'rear_habitat', True), 
+            ('funchabitatup', 'habitat', True)]
 
-    def check_habitat_all(self):
-        result = any(val == True for val in self.habitat.values())
-        return result
+#all species values accumulated walking down the network; these use the 
+#edge value for any species
+upvalues_all = [('spawn_habitatup_all', 'spawn_habitat', False), ('rear_habitatup_all', 'rear_habitat', False), 
+                ('habitatup_all', 'habitat', False), ('spawn_funchabitatup_all', 'spawn_habitat', True), 
+                ('rear_funchabitatup_all', 'rear_habitat', True), ('funchabitatup_all', 'habitat', True)]
 
-def createNetwork(connection):
+#
+# loads the network with the accessibility and habitat models of each
+# species; the species codes (in column order) are kept in network.species
+#
+def createNetwork(connection, context):
     
+    dbTargetSchema = context.targetSchema
+    species = []
     
     query = f"""
         SELECT a.code
@@ -136,320 +90,154 @@ def createNetwork(connection):
     
     query = f"""
         SELECT a.{appconfig.dbIdField} as id, 
-            st_length(a.{appconfig.dbGeomField}), a.{appconfig.dbGeomField},
+            st_length(a.{appconfig.dbGeomField}), {stream_network.endpointFields('a.' + appconfig.dbGeomField)},
             barrier_up_cnt
             {accessibilitymodel} {spawnhabitatmodel} {rearhabitatmodel} {habitatmodel}
         FROM {dbTargetSchema}.{dbTargetStreamTable} a
     """
    
-    #load geometries and create a network
-    with connection.cursor() as cursor:
-        cursor.execute(query)
-        features = cursor.fetchall()
-        
-        for feature in features:
-            fid = feature[0]
-            length = feature[1]
-            geom = shapely.wkb.loads(feature[2] , hex=True)
-            
-            startc = geom.coords[0]
-            endc = geom.coords[len(geom.coords)-1]
-            
-            startt = (startc[0], startc[1])
-            endt = (endc[0], endc[1])            
-            
-            if (startt in nodes.keys()):
-                fromNode = nodes[startt]
-            else:
-                #create new node
-                fromNode = Node(startc[0], startc[1])
-                nodes[startt] = fromNode
-            
-            if (endt in nodes.keys()):
-                toNode = nodes[endt]
-            else:
-                #create new node
-                toNode = Node(endc[0], endc[1])
-                nodes[endt] = toNode
+    fids = []
+    lengths = []
+    upbarriercnt = []
+    startcoords = []
+    endcoords = []
+    values = {name: [] for name in edgevalues}
+    
+    accessible = (appconfig.Accessibility.ACCESSIBLE.value, appconfig.Accessibility.POTENTIAL.value)
+    speciescnt = len(species)
+    
+    #load end points and create a network; rows are streamed from the
+    #database in batches instead of all being fetched at once
+    for feature in stream_network.readRows(connection, query):
+        fid = feature[0]
+        length = feature[1]
             
-            edge = Edge(fromNode, toNode, fid, length, geom)
-            edge.upbarriercnt = feature[3]
-            index = 4
-            for fish in species:
-                edge.speca[fish] = feature[index]
-                edge.spawn_habitat[fish] = feature[index + len(species)]
-                edge.rear_habitat[fish] = feature[index + len(species)]
-                edge.habitat[fish] = feature[index + len(species)]
-                index = index + 1
-
-            edge.spawn_habitat_all = edge.check_spawn_habitat_all()
-            edge.rear_habitat_all = edge.check_rear_habitat_all()
-            edge.habitat_all = edge.check_habitat_all()
+        fids.append(fid)
+        lengths.append(length)
+        upbarriercnt.append(feature[6])
+        startcoords.append((feature[2], feature[3]))
+        endcoords.append((feature[4], feature[5]))
+        
+        #accessibility, spawn, rear and habitat models for each species
+        index = 7
+        values['speca'].append([value in accessible for value in feature[index:index + speciescnt]])
+        index += speciescnt
+        values['spawn_habitat'].append([value == True for value in feature[index:index + speciescnt]])
+        index += speciescnt
+        values['rear_habitat'].append([value == True for value in feature[index:index + speciescnt]])
+        index += speciescnt
+        values['habitat'].append([value == True for value in feature[index:index + speciescnt]])
+
+    network = stream_network.StreamNetwork(fids, startcoords, endcoords)
+    network.species = species
+    network.attributes['length'] = numpy.array(lengths, dtype=numpy.float64)
+    network.attributes['upbarriercnt'] = numpy.array(upbarriercnt, dtype=numpy.int64)
+    for name in edgevalues:
+        network.attributes[name] = numpy.array(values[name], dtype=bool).reshape(network.edgecount, speciescnt)
+    
+    return network
 
-            edges.append(edge)
+#
+# the columns of the upstream value matrix; one column for each species
+# and upvalue (in species order) followed by the upvalues_all columns. 
+# Returns the edge value (edge x column boolean matrix) each column 
+# accumulates and if each column is functional habitat
+#
+def valueColumns(network):
+    attr = network.attributes
+    
+    columns = []
+    functional = []
+    for fish in range(len(network.species)):
+        for name, edgevalue, isfunctional in upvalues:
+            columns.append(attr[edgevalue][:, fish])
+            functional.append(isfunctional)
             
-            fromNode.addOutEdge(edge)
-            toNode.addInEdge(edge)     
+    for name, edgevalue, isfunctional in upvalues_all:
+        columns.append(attr[edgevalue].any(axis=1))
+        functional.append(isfunctional)
+    
+    ishabitat = numpy.column_stack(columns) if len(columns) > 0 else numpy.zeros((network.edgecount, 0), dtype=bool)
+    return ishabitat, numpy.array(functional, dtype=bool)
 
-def processNodes():
+#
+# computes the upstream values for all species and values at once, one 
+# level of nodes at a time. Values for each out edge are the sum of the values 
+# of the in edges of its upstream node plus the edge length if it is habitat.
+# Functional habitat is only accumulated up to the first barrier upstream; if
+# there is a barrier at the top of the edge only the edge itself is counted
+#
+def processNodes(network):
+    
+    attr = network.attributes
+    lengths = attr['length']
+    upbarriercnt = attr['upbarriercnt']
     
+    ishabitat, functional = valueColumns(network)
+    edgelength = ishabitat * lengths[:, numpy.newaxis]
+    
+    upvaluematrix = numpy.zeros(ishabitat.shape, dtype=numpy.float64)
     
     #walk down network        
-    toprocess = deque()
-    for edge in edges:
-        edge.visited = False
-        
-    for node in nodes.values():
-        if (len(node.inedges) == 0):
-            toprocess.append(node)
-            
-    while (toprocess):
-        node = toprocess.popleft()
+    for nodes in network.topologicalLevels():
         
-        allvisited = True
+        outedges = network.outEdgesOf(nodes)
+        if len(outedges) == 0:
+            continue
         
-        uplength = {}
-        spawn_habitat = {}
-        rear_habitat = {}
-        habitat = {}
-        spawn_funchabitat = {}
-        rear_funchabitat = {}
-        funchabitat = {}
-        spawn_habitat_all = 0
-        rear_habitat_all = 0
-        habitat_all = 0
-        spawn_funchabitat_all = 0
-        rear_funchabitat_all = 0
-        funchabitat_all = 0
+        #sum the in edge values for each node
+        inedges = network.inEdgesOf(nodes)
+        innode = numpy.repeat(numpy.arange(len(nodes)), network.inptr[nodes + 1] - network.inptr[nodes])
         
-        for fish in species:
-            uplength[fish] = 0
-            spawn_habitat[fish] = 0
-            rear_habitat[fish] = 0
-            habitat[fish] = 0
-            spawn_funchabitat[fish] = 0
-            rear_funchabitat[fish] = 0
-            funchabitat[fish] = 0
+        up = numpy.zeros((len(nodes), upvaluematrix.shape[1]), dtype=numpy.float64)
+        numpy.add.at(up, innode, upvaluematrix[inedges])
+        outbarriercnt = numpy.bincount(innode, weights=upbarriercnt[inedges], minlength=len(nodes))
         
-        outbarriercnt = 0
+        #assign the out edge values
+        outnode = numpy.repeat(numpy.arange(len(nodes)), network.outptr[nodes + 1] - network.outptr[nodes])
         
-        for inedge in node.inedges:
-            outbarriercnt += inedge.upbarriercnt
-                
-            if not inedge.visited:
-                allvisited = False
-                break
-            else:
-                for fish in species:
-                    uplength[fish] = uplength[fish] + inedge.specaup[fish]
-                    spawn_habitat[fish] = spawn_habitat[fish] + inedge.spawn_habitatup[fish]
-                    rear_habitat[fish] = rear_habitat[fish] + inedge.rear_habitatup[fish]
-                    habitat[fish] = habitat[fish] + inedge.habitatup[fish]
-                    spawn_funchabitat[fish] = spawn_funchabitat[fish] + inedge.spawn_funchabitatup[fish]
-                    rear_funchabitat[fish] = rear_funchabitat[fish] + inedge.rear_funchabitatup[fish]
-                    funchabitat[fish] = funchabitat[fish] + inedge.funchabitatup[fish]
-                
-                spawn_habitat_all = spawn_habitat_all + inedge.spawn_habitatup_all
-                rear_habitat_all = rear_habitat_all + inedge.rear_habitatup_all
-                habitat_all = habitat_all + inedge.habitatup_all
-
-                spawn_funchabitat_all = spawn_funchabitat_all + inedge.spawn_funchabitatup_all
-                rear_funchabitat_all = rear_funchabitat_all + inedge.rear_funchabitatup_all
-                funchabitat_all = funchabitat_all + inedge.funchabitatup_all
-                
-        if not allvisited:
-            toprocess.append(node)
-        else:
+        isbarrier = upbarriercnt[outedges] != outbarriercnt[outnode]
+        upvalue = up[outnode]
+        upvalue[numpy.ix_(isbarrier, functional)] = 0
         
-            for outedge in node.outedges:
-
-                for fish in species:
-                    if (outedge.speca[fish] == appconfig.Accessibility.ACCESSIBLE.value or outedge.speca[fish] == appconfig.Accessibility.POTENTIAL.value):
-                        outedge.specaup[fish] = uplength[fish] + outedge.length
-                    else:
-                        outedge.specaup[fish] = uplength[fish]
-                        
-                    if outedge.spawn_habitat[fish]:
-                        outedge.spawn_habitatup[fish] = spawn_habitat[fish] + outedge.length
-                    else:
-                        outedge.spawn_habitatup[fish] = spawn_habitat[fish]
-                    
-                    if outedge.rear_habitat[fish]:
-                        outedge.rear_habitatup[fish] = rear_habitat[fish] + outedge.length
-                    else:
-                        outedge.rear_habitatup[fish] = rear_habitat[fish]
-                    
-                    if outedge.habitat[fish]:
-                        outedge.habitatup[fish] = habitat[fish] + outedge.length
-                    else:
-                        outedge.habitatup[fish] = habitat[fish]
-                        
-                    # if outedge.upbarriercnt != outbarriercnt:
-                    #     outedge.spawn_funchabitatup[fish] = outedge.length
-                    # elif outedge.spawn_habitat[fish]:
-                    #     outedge.spawn_funchabitatup[fish] = spawn_funchabitat[fish] + outedge.length
-                    # else: 
-                    #     outedge.spawn_funchabitatup[fish] = spawn_funchabitat[fish]
-                    
-                    ##################
-
-                    if outedge.upbarriercnt != outbarriercnt:
-                        if outedge.spawn_habitat[fish]:
-                            outedge.spawn_funchabitatup[fish] = outedge.length
-                        else:
-                            outedge.spawn_funchabitatup[fish] = 0 
-                    elif outedge.spawn_habitat[fish]:
-                        outedge.spawn_funchabitatup[fish] = spawn_funchabitat[fish] + outedge.length
-                    else:
-                        outedge.spawn_funchabitatup[fish] = spawn_funchabitat[fish]
-
-                    ##################
-
-                    # if outedge.upbarriercnt != outbarriercnt:
-                    #     outedge.rear_funchabitatup[fish] = outedge.length
-                    # elif outedge.rear_habitat[fish]:
-                    #     outedge.rear_funchabitatup[fish] = rear_funchabitat[fish] + outedge.length
-                    # else: 
-                    #     outedge.rear_funchabitatup[fish] = rear_funchabitat[fish]
-
-                    ##################
-
-                    if outedge.upbarriercnt != outbarriercnt:
-                        if outedge.rear_habitat[fish]:
-                            outedge.rear_funchabitatup[fish] = outedge.length
-                        else:
-                            outedge.rear_funchabitatup[fish] = 0 
-                    elif outedge.rear_habitat[fish]:
-                        outedge.rear_funchabitatup[fish] = rear_funchabitat[fish] + outedge.length
-                    else:
-                        outedge.rear_funchabitatup[fish] = rear_funchabitat[fish]
-
-                    ##################
-
-                    # if outedge.upbarriercnt != outbarriercnt:
-                    #     outedge.funchabitatup[fish] = outedge.length
-                    # elif outedge.habitat[fish]:
-                    #     outedge.funchabitatup[fish] = funchabitat[fish] + outedge.length
-                    # else: 
-                    #     outedge.funchabitatup[fish] = funchabitat[fish]
-
-                    ##################
-
-                    if outedge.upbarriercnt != outbarriercnt:
-                        if outedge.habitat[fish]:
-                            outedge.funchabitatup[fish] = outedge.length
-                        else:
-                            outedge.funchabitatup[fish] = 0
-                    elif outedge.habitat[fish]:
-                        outedge.funchabitatup[fish] = funchabitat[fish] + outedge.length
-                    else: 
-                        outedge.funchabitatup[fish] = funchabitat[fish]
-
-                    ##################
-                
-                if outedge.spawn_habitat_all:
-                    outedge.spawn_habitatup_all = spawn_habitat_all + outedge.length
-                else:
-                    outedge.spawn_habitatup_all = spawn_habitat_all
-
-                if outedge.rear_habitat_all:
-                    outedge.rear_habitatup_all = rear_habitat_all + outedge.length
-                else:
-                    outedge.rear_habitatup_all = rear_habitat_all
-
-                if outedge.habitat_all:
-                    outedge.habitatup_all = habitat_all + outedge.length
-                else:
-                    outedge.habitatup_all = habitat_all
-                
-                # if outedge.upbarriercnt != outbarriercnt:
-                #     outedge.spawn_funchabitatup_all = outedge.length
-                # elif outedge.spawn_habitat_all:
-                #     outedge.spawn_funchabitatup_all = spawn_funchabitat_all + outedge.length
-                # else: 
-                #     outedge.spawn_funchabitatup_all = spawn_funchabitat_all
-                
-                ##################
-
-                if outedge.upbarriercnt != outbarriercnt:
-                    if outedge.spawn_habitat_all:
-                        outedge.spawn_funchabitatup_all = outedge.length
-                    else:
-                        outedge.spawn_funchabitatup_all = 0
-                elif outedge.spawn_habitat_all:
-                    outedge.spawn_funchabitatup_all = spawn_funchabitat_all + outedge.length
-                else: 
-                    outedge.spawn_funchabitatup_all = spawn_funchabitat_all
-
-                ##################
-
-                # if outedge.upbarriercnt != outbarriercnt:
-                #     outedge.rear_funchabitatup_all = outedge.length
-                # elif outedge.rear_habitat_all:
-                #     outedge.rear_funchabitatup_all = rear_funchabitat_all + outedge.length
-                # else: 
-                #     outedge.rear_funchabitatup_all = rear_funchabitat_all
-
-                ##################
-
-                if outedge.upbarriercnt != outbarriercnt:
-                    if outedge.rear_habitat_all:
-                        outedge.rear_funchabitatup_all = outedge.length
-                    else:
-                        outedge.rear_funchabitatup_all = 0
-                elif outedge.rear_habitat_all:
-                    outedge.rear_funchabitatup_all = rear_funchabitat_all + outedge.length
-                else: 
-                    outedge.rear_funchabitatup_all = rear_funchabitat_all
-
-                ##################
-
-                # if outedge.upbarriercnt != outbarriercnt:
-                #     outedge.funchabitatup_all = outedge.length
-                # elif outedge.habitat_all:
-                #     outedge.funchabitatup_all = funchabitat_all + outedge.length
-                # else: 
-                #     outedge.funchabitatup_all = funchabitat_all
-
-                ##################
-
-                if outedge.upbarriercnt != outbarriercnt:
-                    if outedge.habitat_all:
-                        outedge.funchabitatup_all = outedge.length
-                    else:
-                        outedge.funchabitatup_all = 0
-                elif outedge.habitat_all:
-                    outedge.funchabitatup_all = funchabitat_all + outedge.length
-                else: 
-                    outedge.funchabitatup_all = funchabitat_all
-
-                ##################
-
-                outedge.visited = True
-                if (not outedge.toNode in toprocess):
-                    toprocess.append(outedge.toNode)
-        
-def writeResults(connection):
-      
-    tablestr = ''
-    inserttablestr = ''
-    for fish in species:
-        tablestr = tablestr + ', total_upstr_pot_access_' + fish + ' numeric'
-        tablestr = tablestr + ', total_upstr_hab_spawn_' + fish + ' numeric'
-        tablestr = tablestr + ', total_upstr_hab_rear_' + fish + ' numeric'
-        tablestr = tablestr + ', total_upstr_hab_' + fish + ' numeric'
-        tablestr = tablestr + ', func_upstr_hab_spawn_' + fish + ' numeric'
-        tablestr = tablestr + ', func_upstr_hab_rear_' + fish + ' numeric'
-        tablestr = tablestr + ', func_upstr_hab_' + fish + ' numeric'
-        inserttablestr = inserttablestr + ",%s,%s,%s,%s,%s,%s,%s"
+        upvaluematrix[outedges] = upvalue + edgelength[outedges]
+    
+    attr['upvalues'] = upvaluematrix
+    
+#barrier table columns computed for each species (in upvalues order)
+def speciesColumns(code):
+    return ['total_upstr_pot_access_' + code, 'total_upstr_hab_spawn_' + code,
+            'total_upstr_hab_rear_' + code, 'total_upstr_hab_' + code,
+            'func_upstr_hab_spawn_' + code, 'func_upstr_hab_rear_' + code,
+            'func_upstr_hab_' + code]
 
-    tablestr = tablestr + ', total_upstr_hab_spawn_all' + ' numeric'
-    tablestr = tablestr + ', total_upstr_hab_rear_all' + ' numeric'
-    tablestr = tablestr + ', total_upstr_hab_all' + ' numeric'
-    tablestr = tablestr + ', func_upstr_hab_spawn_all' + ' numeric'
-    tablestr = tablestr + ', func_upstr_hab_rear_all' + ' numeric'
-    tablestr = tablestr + ', func_upstr_hab_all' + ' numeric'
-    inserttablestr = inserttablestr + ",%s,%s,%s,%s,%s,%s"
+#
+# writes the upstream values of the given species codes (None for all 
+# species) and the all species values
+#
+def writeResults(connection, context, network, species = None):
+    
+    dbTargetSchema = context.targetSchema
+    
+    fieldnames = []
+    #upvalues matrix columns written
+    columns = []
+    for index, fish in enumerate(network.species):
+        if species is None or fish in species:
+            fieldnames.extend(speciesColumns(fish))
+            columns.extend(range(index * len(upvalues), (index + 1) * len(upvalues)))
+    
+    allstart = len(network.species) * len(upvalues)
+    columns.extend(range(allstart, allstart + len(upvalues_all)))
+
+    fieldnames.append('total_upstr_hab_spawn_all')
+    fieldnames.append('total_upstr_hab_rear_all')
+    fieldnames.append('total_upstr_hab_all')
+    fieldnames.append('func_upstr_hab_spawn_all')
+    fieldnames.append('func_upstr_hab_rear_all')
+    fieldnames.append('func_upstr_hab_all')
+    
+    tablestr = ''.join([', ' + name + ' numeric' for name in fieldnames])
 
     query = f"""
         DROP TABLE IF EXISTS {dbTargetSchema}.temp;
@@ -462,175 +250,28 @@ def writeResults(connection):
     with connection.cursor() as cursor:
         cursor.execute(query)
     
-    
-    updatequery = f"""    
-        INSERT INTO {dbTargetSchema}.temp VALUES (%s {inserttablestr}) 
-    """
-
-    newdata = []
-    
-    for edge in edges:
-        
-        data = []
-        data.append(edge.fid)
-        for fish in species:
-            data.append (edge.specaup[fish])
-            data.append (edge.spawn_habitatup[fish])
-            data.append (edge.rear_habitatup[fish])
-            data.append (edge.habitatup[fish])
-            data.append (edge.spawn_funchabitatup[fish])
-            data.append (edge.rear_funchabitatup[fish])
-            data.append (edge.funchabitatup[fish])
-        
-        data.append(edge.spawn_habitatup_all)
-        data.append(edge.rear_habitatup_all)
-        data.append(edge.habitatup_all)
-        data.append(edge.spawn_funchabitatup_all)
-        data.append(edge.rear_funchabitatup_all)
-        data.append(edge.funchabitatup_all)
-
-        newdata.append( data )
-
-    with connection.cursor() as cursor:    
-        psycopg2.extras.execute_batch(cursor, updatequery, newdata)
-            
-    for fish in species:
-        
-        query = f"""
-            --upstream potentially accessible
-            ALTER TABLE {dbTargetSchema}.{dbBarrierTable} DROP COLUMN IF EXISTS total_upstr_pot_access_{fish};
-            ALTER TABLE {dbTargetSchema}.{dbBarrierTable} ADD COLUMN total_upstr_pot_access_{fish} numeric;
-            
-            UPDATE {dbTargetSchema}.{dbBarrierTable} 
-            SET total_upstr_pot_access_{fish} = a.total_upstr_pot_access_{fish} / 1000.0 
-            FROM {dbTargetSchema}.temp a, {dbTargetSchema}.{dbTargetStreamTable} b 
-            WHERE a.stream_id = b.id AND
-                  a.stream_id = {dbTargetSchema}.{dbBarrierTable}.stream_id_up;
-
-
-            --total upstream habitat
-            ALTER TABLE {dbTargetSchema}.{dbBarrierTable} DROP COLUMN IF EXISTS total_upstr_hab_spawn_{fish};
-            ALTER TABLE {dbTargetSchema}.{dbBarrierTable} ADD COLUMN total_upstr_hab_spawn_{fish} numeric;
-    
-            UPDATE {dbTargetSchema}.{dbBarrierTable} 
-            SET total_upstr_hab_spawn_{fish} = a.total_upstr_hab_spawn_{fish} / 1000.0 
-            FROM {dbTargetSchema}.temp a,{dbTargetSchema}.{dbTargetStreamTable} b 
-            WHERE a.stream_id = b.id AND 
-                a.stream_id = {dbTargetSchema}.{dbBarrierTable}.stream_id_up;
-            
-            ALTER TABLE {dbTargetSchema}.{dbBarrierTable} DROP COLUMN IF EXISTS total_upstr_hab_rear_{fish};
-            ALTER TABLE {dbTargetSchema}.{dbBarrierTable} ADD COLUMN total_upstr_hab_rear_{fish} numeric;
-    
-            UPDATE {dbTargetSchema}.{dbBarrierTable} 
-            SET total_upstr_hab_rear_{fish} = a.total_upstr_hab_rear_{fish} / 1000.0 
-            FROM {dbTargetSchema}.temp a,{dbTargetSchema}.{dbTargetStreamTable} b 
-            WHERE a.stream_id = b.id AND 
-                a.stream_id = {dbTargetSchema}.{dbBarrierTable}.stream_id_up;
-            
-            ALTER TABLE {dbTargetSchema}.{dbBarrierTable} DROP COLUMN IF EXISTS total_upstr_hab_{fish};
-            ALTER TABLE {dbTargetSchema}.{dbBarrierTable} ADD COLUMN total_upstr_hab_{fish} numeric;
+    #selected upvalues columns are in the same order as fieldnames
+    upvaluematrix = network.attributes['upvalues'][:, columns].tolist()
+    newdata = [[network.fids[edge]] + upvaluematrix[edge] for edge in range(network.edgecount)]
 
-            UPDATE {dbTargetSchema}.{dbBarrierTable} 
-            SET total_upstr_hab_{fish} = a.total_upstr_hab_{fish} / 1000.0 
-            FROM {dbTargetSchema}.temp a,{dbTargetSchema}.{dbTargetStreamTable} b 
-            WHERE a.stream_id = b.id AND 
-                a.stream_id = {dbTargetSchema}.{dbBarrierTable}.stream_id_up;
-            
-            
-            --functional upstream habitat
-            ALTER TABLE {dbTargetSchema}.{dbBarrierTable} DROP COLUMN IF EXISTS func_upstr_hab_spawn_{fish};
-            ALTER TABLE {dbTargetSchema}.{dbBarrierTable} ADD COLUMN func_upstr_hab_spawn_{fish} numeric;
+    bulk_writer.copyRows(connection, f"{dbTargetSchema}.temp", ['stream_id'] + fieldnames, newdata)
     
-            UPDATE {dbTargetSchema}.{dbBarrierTable} 
-            SET func_upstr_hab_spawn_{fish} = a.func_upstr_hab_spawn_{fish} / 1000.0 
-            FROM {dbTargetSchema}.temp a,{dbTargetSchema}.{dbTargetStreamTable} b 
-            WHERE a.stream_id = b.id AND 
-                a.stream_id = {dbTargetSchema}.{dbBarrierTable}.stream_id_up;
-            
-            ALTER TABLE {dbTargetSchema}.{dbBarrierTable} DROP COLUMN IF EXISTS func_upstr_hab_rear_{fish};
-            ALTER TABLE {dbTargetSchema}.{dbBarrierTable} ADD COLUMN func_upstr_hab_rear_{fish} numeric;
-    
-            UPDATE {dbTargetSchema}.{dbBarrierTable} 
-            SET func_upstr_hab_rear_{fish} = a.func_upstr_hab_rear_{fish} / 1000.0 
-            FROM {dbTargetSchema}.temp a,{dbTargetSchema}.{dbTargetStreamTable} b 
-            WHERE a.stream_id = b.id AND 
-                a.stream_id = {dbTargetSchema}.{dbBarrierTable}.stream_id_up;
-
-            ALTER TABLE {dbTargetSchema}.{dbBarrierTable} DROP COLUMN IF EXISTS func_upstr_hab_{fish};
-            ALTER TABLE {dbTargetSchema}.{dbBarrierTable} ADD COLUMN func_upstr_hab_{fish} numeric;
-
-            UPDATE {dbTargetSchema}.{dbBarrierTable} 
-            SET func_upstr_hab_{fish} = a.func_upstr_hab_{fish} / 1000.0 
-            FROM {dbTargetSchema}.temp a,{dbTargetSchema}.{dbTargetStreamTable} b 
-            WHERE a.stream_id = b.id AND 
-                a.stream_id = {dbTargetSchema}.{dbBarrierTable}.stream_id_up;
-
-        """
-        with connection.cursor() as cursor:
-            cursor.execute(query)
+    #recreate all the columns with a single alter table and 
+    #populate them with a single update (in km)
+    dropstr = ', '.join([f"DROP COLUMN IF EXISTS {name}" for name in fieldnames])
+    addstr = ', '.join([f"ADD COLUMN {name} numeric" for name in fieldnames])
+    setstr = ', '.join([f"{name} = a.{name} / 1000.0" for name in fieldnames])
     
     query = f"""
-        --total upstream habitat - all
-        ALTER TABLE {dbTargetSchema}.{dbBarrierTable} DROP COLUMN IF EXISTS total_upstr_hab_spawn_all;
-        ALTER TABLE {dbTargetSchema}.{dbBarrierTable} ADD COLUMN total_upstr_hab_spawn_all numeric;
-
-        UPDATE {dbTargetSchema}.{dbBarrierTable} 
-        SET total_upstr_hab_spawn_all = a.total_upstr_hab_spawn_all / 1000.0 
-        FROM {dbTargetSchema}.temp a,{dbTargetSchema}.{dbTargetStreamTable} b 
-        WHERE a.stream_id = b.id AND 
-            a.stream_id = {dbTargetSchema}.{dbBarrierTable}.stream_id_up;
-
-        ALTER TABLE {dbTargetSchema}.{dbBarrierTable} DROP COLUMN IF EXISTS total_upstr_hab_rear_all;
-        ALTER TABLE {dbTargetSchema}.{dbBarrierTable} ADD COLUMN total_upstr_hab_rear_all numeric;
-
-        UPDATE {dbTargetSchema}.{dbBarrierTable} 
-        SET total_upstr_hab_rear_all = a.total_upstr_hab_rear_all / 1000.0 
-        FROM {dbTargetSchema}.temp a,{dbTargetSchema}.{dbTargetStreamTable} b 
-        WHERE a.stream_id = b.id AND 
-            a.stream_id = {dbTargetSchema}.{dbBarrierTable}.stream_id_up;
-
-        ALTER TABLE {dbTargetSchema}.{dbBarrierTable} DROP COLUMN IF EXISTS total_upstr_hab_all;
-        ALTER TABLE {dbTargetSchema}.{dbBarrierTable} ADD COLUMN total_upstr_hab_all numeric;
-
-        UPDATE {dbTargetSchema}.{dbBarrierTable} 
-        SET total_upstr_hab_all = a.total_upstr_hab_all / 1000.0 
-        FROM {dbTargetSchema}.temp a,{dbTargetSchema}.{dbTargetStreamTable} b 
-        WHERE a.stream_id = b.id AND 
-            a.stream_id = {dbTargetSchema}.{dbBarrierTable}.stream_id_up;
-
-
-        --functional upstream habitat - all
-        ALTER TABLE {dbTargetSchema}.{dbBarrierTable} DROP COLUMN IF EXISTS func_upstr_hab_spawn_all;
-        ALTER TABLE {dbTargetSchema}.{dbBarrierTable} ADD COLUMN func_upstr_hab_spawn_all numeric;
-
-        UPDATE {dbTargetSchema}.{dbBarrierTable} 
-        SET func_upstr_hab_spawn_all = a.func_upstr_hab_spawn_all / 1000.0 
-        FROM {dbTargetSchema}.temp a,{dbTargetSchema}.{dbTargetStreamTable} b 
-        WHERE a.stream_id = b.id AND 
-            a.stream_id = {dbTargetSchema}.{dbBarrierTable}.stream_id_up;
-
-        ALTER TABLE {dbTargetSchema}.{dbBarrierTable} DROP COLUMN IF EXISTS func_upstr_hab_rear_all;
-        ALTER TABLE {dbTargetSchema}.{dbBarrierTable} ADD COLUMN func_upstr_hab_rear_all numeric;
-
-        UPDATE {dbTargetSchema}.{dbBarrierTable} 
-        SET func_upstr_hab_rear_all = a.func_upstr_hab_rear_all / 1000.0 
-        FROM {dbTargetSchema}.temp a,{dbTargetSchema}.{dbTargetStreamTable} b 
-        WHERE a.stream_id = b.id AND 
-            a.stream_id = {dbTargetSchema}.{dbBarrierTable}.stream_id_up;
+        ALTER TABLE {dbTargetSchema}.{dbBarrierTable} {dropstr};
+        ALTER TABLE {dbTargetSchema}.{dbBarrierTable} {addstr};
         
-        ALTER TABLE {dbTargetSchema}.{dbBarrierTable} DROP COLUMN IF EXISTS func_upstr_hab_all;
-        ALTER TABLE {dbTargetSchema}.{dbBarrierTable} ADD COLUMN func_upstr_hab_all numeric;
-
         UPDATE {dbTargetSchema}.{dbBarrierTable} 
-        SET func_upstr_hab_all = a.func_upstr_hab_all / 1000.0 
-        FROM {dbTargetSchema}.temp a,{dbTargetSchema}.{dbTargetStreamTable} b 
-        WHERE a.stream_id = b.id AND 
-            a.stream_id = {dbTargetSchema}.{dbBarrierTable}.stream_id_up;
-    """
-    with connection.cursor() as cursor:
-        cursor.execute(query)
-
-    query = f"""
+        SET {setstr}
+        FROM {dbTargetSchema}.temp a, {dbTargetSchema}.{dbTargetStreamTable} b 
+        WHERE a.stream_id = b.id AND
+              a.stream_id = {dbTargetSchema}.{dbBarrierTable}.stream_id_up;
+        
         DROP TABLE {dbTargetSchema}.temp;
     """
     with connection.cursor() as cursor:
@@ -650,8 +291,10 @@ def writeResults(connection):
 
     connection.commit()
 
-def assignBarrierSpeciesCounts(connection):
+def assignBarrierSpeciesCounts(connection, context):
 
+    dbTargetSchema = context.targetSchema
+    
     query = f"""
         UPDATE {dbTargetSchema}.{dbBarrierTable}
         SET species_upstr = a.fish_survey_up,
@@ -677,33 +320,61 @@ def assignBarrierSpeciesCounts(connection):
 
     connection.commit()
 
-#--- main program ---
-def main():
-
-    edges.clear()
-    nodes.clear()
-    species.clear()    
-        
-    with appconfig.connectdb() as conn:
+def run(context):
+    
+    with context.connect() as conn:
         
         conn.autocommit = False
         
         print("Computing Habitat Models for Barriers")
         
         print("  assigning barrier and species counts")
-        assignBarrierSpeciesCounts(conn)
+        assignBarrierSpeciesCounts(conn, context)
         
         print("  creating network")
-        createNetwork(conn)
+        network = createNetwork(conn, context)
         
         print("  processing nodes")
-        processNodes()
+        processNodes(network)
             
         print("  writing results")
-        writeResults(conn)
+        writeResults(conn, context, network)
+        
+    print("done")
+
+#
+# recomputes the upstream values of the species whose parameters changed
+# and the all species values, and drops the columns of removed species 
+# (see refresh_parameters); the barrier and species counts don't depend 
+# on the species parameters so they aren't reassigned
+#
+def runSpecies(context, species, removed):
+    
+    with context.connect() as conn:
+        
+        conn.autocommit = False
+        
+        print("Computing Habitat Models for Barriers For Changed Species")
+        species_parameters.dropColumns(conn, f"{context.targetSchema}.{dbBarrierTable}", 
+            [column for code in removed for column in speciesColumns(code)])
+        
+        print("  creating network")
+        network = createNetwork(conn, context)
+        
+        print("  processing nodes")
+        processNodes(network)
+        
+        print("  writing results")
+        writeResults(conn, context, network, species)
         
     print("done")
+
+#--- main program ---
+
+def main():
+    run(stage_context.fromArgs())
     
 
+
 if __name__ == "__main__":
     main()      
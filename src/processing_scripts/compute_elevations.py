@@ -0,0 +1,221 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+#
+# Fused elevation pipeline. Runs assign_raw_z, smooth_z and optionally 
+# compute_vertex_gradient and compute_segment_gradient with the stream
+# coordinates kept in memory between the stages, instead of each stage 
+# writing its 3d geometry to the database and the next stage reading it
+# back. The raw and smoothed geometries and segment gradients are written
+# with a single update and the vertex gradient table once.
+#
+# Enabled in process_watershed with the fused_pipeline option in the
+# ELEVATION_PROCESSING config section. The dem files must be in the 
+# same projection as the stream table.
+#
+import appconfig
+import numpy
+import shapely
+import bulk_writer
+import stream_network
+import assign_raw_z
+import smooth_z
+import compute_vertex_gradient
+import compute_segment_gradient
+import stage_context
+
+dbTargetTable = appconfig.config['PROCESSING']['stream_table']
+
+dbRawGeom = appconfig.config['ELEVATION_PROCESSING']['3dgeometry_field']
+dbSmoothedGeom = appconfig.config['ELEVATION_PROCESSING']['smoothedgeometry_field']
+
+dbMainstemField = appconfig.config['MAINSTEM_PROCESSING']['mainstem_id']
+dbDownMeasureField = appconfig.config['MAINSTEM_PROCESSING']['downstream_route_measure']
+dbUpMeasureField = appconfig.config['MAINSTEM_PROCESSING']['upstream_route_measure']
+
+dbSegmentGradientField = appconfig.config['GRADIENT_PROCESSING']['segment_gradient_field']
+
+#tables read and written by this script (see stage_scheduler)
+def stageInputs(context):
+    return [f"{context.targetSchema}.{dbTargetTable}"]
+
+def stageOutputs(context):
+    return [f"{context.targetSchema}.{dbTargetTable}", f"{context.targetSchema}.{compute_vertex_gradient.dbVertexTable}"]
+
+#files read by this script (see stage_checkpoint)
+def stageFiles(context):
+    return sorted(assign_raw_z.demFiles())
+
+
+#
+# loaded streams; coords are (n,3) coordinate arrays with NODATA 
+# elevations (see assign_raw_z.prepareOutput)
+#
+class Streams:
+    
+    def __init__(self, fids, inwatershed, mainstems, downs, ups, geoms):
+        self.fids = fids
+        self.inwatershed = numpy.array(inwatershed, dtype=bool)
+        self.mainstems = mainstems
+        self.downs = downs
+        self.ups = ups
+        self.bounds = shapely.bounds(geoms)
+        
+        xy, index = shapely.get_coordinates(geoms, return_index=True)
+        counts = numpy.bincount(index, minlength=len(geoms))
+        xyz = numpy.column_stack((xy, numpy.full(len(xy), appconfig.NODATA, dtype=numpy.float64)))
+        self.coords = numpy.split(xyz, numpy.cumsum(counts)[:-1])
+        
+
+def loadStreams(connection, context):
+    
+    query = f"""
+        SELECT {appconfig.dbIdField}, {appconfig.dbWatershedIdField} = '{context.watershedId}',
+            {dbMainstemField}, {dbDownMeasureField}, {dbUpMeasureField}, {appconfig.dbGeomField}
+        FROM {context.targetSchema}.{dbTargetTable}
+    """
+    
+    fids = []
+    inwatershed = []
+    mainstems = []
+    downs = []
+    ups = []
+    wkbs = []
+    
+    #rows are streamed from the database in batches instead 
+    #of all being fetched at once
+    for feature in stream_network.readRows(connection, query):
+        fids.append(feature[0])
+        inwatershed.append(feature[1] == True)
+        mainstems.append(feature[2])
+        downs.append(feature[3])
+        ups.append(feature[4])
+        wkbs.append(feature[5])
+    
+    geoms = shapely.from_wkb(numpy.array(wkbs, dtype=object))
+    return Streams(fids, inwatershed, mainstems, downs, ups, geoms)
+
+
+#
+# assigns dem elevations to the streams in the watershed (the stream 
+# coordinates are updated in place)
+#
+def assignElevations(connection, context, streams):
+    
+    srid = assign_raw_z.getSrid(connection, context)
+    
+    dem = assign_raw_z.indexDem()
+    for demfile in dem.files:
+        if str(demfile.srid) != str(srid):
+            raise ValueError("fused elevation processing requires dem files in the stream table projection (" + 
+                             str(srid) + "); " + demfile.filename + " is in " + str(demfile.srid))
+    
+    features = numpy.flatnonzero(streams.inwatershed)
+    assign_raw_z.assignElevations(dem, [streams.coords[f] for f in features], streams.bounds[features], connection)
+
+    
+
+#
+# returns the smoothed (n,3) coordinate arrays of the streams
+#
+def smoothElevations(streams):
+    
+    network = smooth_z.buildNetwork(streams.fids, streams.coords)
+    smooth_z.processNodes(network)
+    smooth_z.processEdges(network)
+    
+    return [numpy.column_stack((c[:, 0:2], z)) for c, z in zip(streams.coords, network.attributes['newz'])]
+
+
+def writeElevations(connection, context, streams, smoothed, segmentgradient):
+    
+    dbTargetSchema = context.targetSchema
+    
+    query = f"""
+        ALTER TABLE {dbTargetSchema}.{dbTargetTable} 
+        ADD COLUMN IF NOT EXISTS {dbRawGeom} geometry(LineStringZ, {appconfig.dataSrid});
+        
+        ALTER TABLE {dbTargetSchema}.{dbTargetTable} drop column if exists {dbSmoothedGeom};        
+        ALTER TABLE {dbTargetSchema}.{dbTargetTable} add column {dbSmoothedGeom} geometry(linestringz, {appconfig.dataSrid});
+    """
+    if segmentgradient:
+        query += f"""
+        ALTER TABLE {dbTargetSchema}.{dbTargetTable} ADD COLUMN IF NOT EXISTS {dbSegmentGradientField} double precision;
+        """
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+    
+    fields = [dbRawGeom, dbSmoothedGeom]
+    columns = [smooth_z.toWkb(streams.coords, [c[:, 2] for c in streams.coords]),
+               smooth_z.toWkb(smoothed, [c[:, 2] for c in smoothed])]
+    
+    if segmentgradient:
+        fields.append(dbSegmentGradientField)
+        columns.append(compute_segment_gradient.computeGradients(smoothed))
+    
+    bulk_writer.updateTable(connection, f"{dbTargetSchema}.{dbTargetTable}", 
+        appconfig.dbIdField, fields, zip(streams.fids, *columns))
+    
+    connection.commit()
+    
+    smooth_z.createIndex(connection, context)
+
+
+def computeVertexGradients(connection, context, streams, smoothed):
+    
+    segments = [(mainstem, down, up, coords) 
+                for mainstem, down, up, coords in zip(streams.mainstems, streams.downs, streams.ups, smoothed)
+                if mainstem is not None]
+    
+    mainstems = compute_vertex_gradient.createMainstems(segments)
+    results = compute_vertex_gradient.computeVertexGradients(mainstems)
+    compute_vertex_gradient.writeResults(connection, context, results)
+
+
+def run(context, vertexgradient = True, segmentgradient = True):
+    
+    with context.connect() as conn:
+        
+        conn.autocommit = False
+        
+        print("Computing Elevations (fused pipeline)")
+        print("  loading streams")
+        streams = loadStreams(conn, context)
+        
+        print("  assigning raw elevations")
+        assignElevations(conn, context, streams)
+        
+        print("  smoothing elevations")
+        smoothed = smoothElevations(streams)
+        
+        print("  writing elevations")
+        writeElevations(conn, context, streams, smoothed, segmentgradient)
+        
+        if vertexgradient:
+            print("  computing vertex gradients")
+            computeVertexGradients(conn, context, streams, smoothed)
+        
+    print("done")
+
+#--- main program ---
+def main(vertexgradient = True, segmentgradient = True):
+    run(stage_context.fromArgs(), vertexgradient, segmentgradient)
+
+
+if __name__ == "__main__":
+    main()
@@ -24,151 +24,98 @@
 
 
 import appconfig
-import shapely.wkb
-from collections import deque
-import psycopg2.extras
+import numpy
+import bulk_writer
 from appconfig import dataSchema
+import stream_network
+import stage_context
+import species_parameters
 
-iniSection = appconfig.args.args[0]
-dbTargetSchema = appconfig.config[iniSection]['output_schema']
-watershed_id = appconfig.config[iniSection]['watershed_id']
 dbTargetStreamTable = appconfig.config['PROCESSING']['stream_table']
 
 dbMaxDownGradientField = appconfig.config['GRADIENT_PROCESSING']['max_downstream_gradient_field']
 dbSegmentGradientField = appconfig.config['GRADIENT_PROCESSING']['segment_gradient_field']
 
-# TO DO: remove network traversal section if this info is not needed
-edges = []
-nodes = dict()
+#tables read and written by this script (see stage_scheduler)
+def stageInputs(context):
+    return [f"{context.targetSchema}.{dbTargetStreamTable}", f"{appconfig.dataSchema}.{appconfig.fishSpeciesTable}"]
 
-class Node:
-    
-    def __init__(self, x, y):
-        self.inedges = []
-        self.outedges = []
-        self.x = x
-        self.y = y
-        
-    def addInEdge(self, edge):
-        self.inedges.append(edge)
-   
-    def addOutEdge(self, edge):
-        self.outedges.append(edge)
-    
-    def getMinDownstreamGradient(self):
-        if (len(self.outedges) == 0):
-            return 0;
-        
-        minvalue = None;
-        for edge in self.outedges:
-            if (edge.mindowngradient < 0 ): 
-                return -1
-            elif (minvalue is None) or (edge.mindowngradient < minvalue):
-                minvalue = edge.mindowngradient
-        
-        return minvalue;
-    
-class Edge:
-    def __init__(self, fromnode, tonode, fid, maxgradient, ls):
-        self.fromNode = fromnode
-        self.toNode = tonode
-        self.ls = ls
-        self.fid = fid
-        self.visited = False
-        self.maxgradient = maxgradient
-        self.mindowngradient = -1
+def stageOutputs(context):
+    return [f"{context.targetSchema}.{dbTargetStreamTable}"]
 
-        
-def createNetwork(connection):
+#stream table columns computed for each species
+def speciesColumns(code):
+    return [f"{code}_accessibility"]
+
+def createNetwork(connection, context):
     query = f"""
         SELECT a.{appconfig.dbIdField} as id, 
-            {dbSegmentGradientField}, a.{appconfig.dbGeomField}
-        FROM {dbTargetSchema}.{dbTargetStreamTable} a
+            {dbSegmentGradientField}, {stream_network.endpointFields('a.' + appconfig.dbGeomField)}
+        FROM {context.targetSchema}.{dbTargetStreamTable} a
     """
    
-    #load geometries and create a network
-    with connection.cursor() as cursor:
-        cursor.execute(query)
-        features = cursor.fetchall()
-        
-        for feature in features:
-            fid = feature[0]
-            maxgradient = feature[1]
-            geom = shapely.wkb.loads(feature[2] , hex=True)
-            
-            startc = geom.coords[0]
-            endc = geom.coords[len(geom.coords)-1]
-            
-            startt = (startc[0], startc[1])
-            endt = (endc[0], endc[1])            
-            
-            if (startt in nodes.keys()):
-                fromNode = nodes[startt]
-            else:
-                #create new node
-                fromNode = Node(startc[0], startc[1])
-                nodes[startt] = fromNode
-            
-            if (endt in nodes.keys()):
-                toNode = nodes[endt]
-            else:
-                #create new node
-                toNode = Node(endc[0], endc[1])
-                nodes[endt] = toNode
-            
-            edge = Edge(fromNode, toNode, fid, maxgradient, geom)
-            edges.append(edge)
-            
-            fromNode.addOutEdge(edge)
-            toNode.addInEdge(edge)     
-            
-
+    fids = []
+    maxgradients = []
+    startcoords = []
+    endcoords = []
+    
+    #load end points and create a network; rows are streamed from the
+    #database in batches instead of all being fetched at once
+    for feature in stream_network.readRows(connection, query):
+        fid = feature[0]
+        maxgradient = feature[1]
+            
+        fids.append(fid)
+        maxgradients.append(maxgradient)
+        startcoords.append((feature[2], feature[3]))
+        endcoords.append((feature[4], feature[5]))
+    
+    network = stream_network.StreamNetwork(fids, startcoords, endcoords)
+    network.attributes['maxgradient'] = numpy.array(maxgradients, dtype=numpy.float64)
+    return network
 
-def processNodes():
+def processNodes(network):
 
+    maxgradient = network.attributes['maxgradient']
+    mindowngradient = numpy.full(network.edgecount, -1, dtype=numpy.float64)
+    
+    #minimum downstream gradient of the out edges of each node 
+    nodedowngradient = numpy.full(network.nodecount, numpy.inf)
+    nodedowngradient[network.sinks()] = 0
+    
     #walk up 
-    toprocess = deque()
-    for node in nodes.values():
-        if (len(node.outedges) == 0):
-            toprocess.append(node)
+    for edges in reversed(network.edgeLevels()):
+        mindowngradient[edges] = numpy.maximum(maxgradient[edges], nodedowngradient[network.tonode[edges]])
+        numpy.minimum.at(nodedowngradient, network.fromnode[edges], mindowngradient[edges])
     
-    while (toprocess):
-        node = toprocess.popleft()
-        
-        downg = node.getMinDownstreamGradient();
-        
-        if (downg < 0):
-            toprocess.append(node)
-            continue;
-        
-        for edge in node.inedges:
-            edge.mindowngradient = max (edge.maxgradient, downg)
-            toprocess.append(edge.fromNode)
+    network.attributes['mindowngradient'] = mindowngradient
         
 
-def writeResults(connection):
+def writeResults(connection, context, network):
       
-    updatequery = f"""
-        UPDATE {dbTargetSchema}.{dbTargetStreamTable}
-        SET {dbMaxDownGradientField} = %s
-        WHERE {appconfig.dbIdField} = %s;
-    """
-    
     newdata = []
     
-    for edge in edges:
-        newdata.append( (edge.mindowngradient, edge.fid) )
+    mindowngradient = network.attributes['mindowngradient'].tolist()
+    for edge in range(network.edgecount):
+        newdata.append( (network.fids[edge], mindowngradient[edge]) )
     
-    with connection.cursor() as cursor:    
-        psycopg2.extras.execute_batch(cursor, updatequery, newdata);
+    bulk_writer.updateTable(connection, f"{context.targetSchema}.{dbTargetStreamTable}", appconfig.dbIdField, 
+        [dbMaxDownGradientField], newdata)
             
     connection.commit()
     
-def computeAccessibility(connection):
-        
+#
+# computes the accessibility of the given species codes (None for all
+# species)
+#
+def computeAccessibility(connection, context, species = None):
+    
+    dbTargetSchema = context.targetSchema
+    
     query = f"""
         SELECT code, name, accessibility_gradient, allcodes
-        FROM {dataSchema}.{appconfig.fishSpeciesTable};
+        FROM {dataSchema}.{appconfig.fishSpeciesTable}
+        WHERE {species_parameters.speciesFilter(species)};
     """
     
     with connection.cursor() as cursor:
@@ -214,13 +161,11 @@ def computeAccessibility(connection):
             with connection.cursor() as cursor2:
                 cursor2.execute(query)
 
-def main():        
-    #--- main program ---
+def run(context):
     
-    edges.clear()
-    nodes.clear()
-            
-    with appconfig.connectdb() as conn:
+    dbTargetSchema = context.targetSchema
+    
+    with context.connect() as conn:
         
         conn.autocommit = False
         
@@ -237,19 +182,45 @@ def main():
             cursor.execute(query)
             
         print("  creating network")
-        createNetwork(conn)
+        network = createNetwork(conn, context)
         
         print("  computing downstream gradient")
-        processNodes()
+        processNodes(network)
         
         print("  saving results")
-        writeResults(conn)
+        writeResults(conn, context, network)
         
         print("  computing accessibility per species")
-        computeAccessibility(conn)
+        computeAccessibility(conn, context)
         
     print("done")
 
+#
+# recomputes the accessibility of the species whose parameters changed and
+# drops the columns of removed species (see refresh_parameters); the
+# maximum downstream gradient doesn't depend on the species parameters 
+# so it isn't recomputed
+#
+def runSpecies(context, species, removed):
+    
+    with context.connect() as conn:
+        
+        conn.autocommit = False
+        
+        print("Computing Gradient Accessibility For Changed Species")
+        species_parameters.dropColumns(conn, f"{context.targetSchema}.{dbTargetStreamTable}", 
+            [column for code in removed for column in speciesColumns(code)])
+        
+        computeAccessibility(conn, context, species)
+        
+    print("done")
+
+def main():        
+
+    #--- main program ---
+    run(stage_context.fromArgs())
+
+
     
 if __name__ == "__main__":
     main() 
@@ -23,392 +23,149 @@
 
 import appconfig
 from appconfig import dataSchema
+import stage_context
+import species_parameters
 
-iniSection = appconfig.args.args[0]
-dbTargetSchema = appconfig.config[iniSection]['output_schema']
 dbTargetStreamTable = appconfig.config['PROCESSING']['stream_table']
 
 dbSegmentGradientField = appconfig.config['GRADIENT_PROCESSING']['segment_gradient_field']
 
-def computeGradientModel(connection):
-    
-    # spawning
-    query = f"""
-        SELECT code, name, 
-        spawn_gradient_min, spawn_gradient_max
-        FROM {dataSchema}.{appconfig.fishSpeciesTable};
-    """
-    
-    with connection.cursor() as cursor:
-        cursor.execute(query)
-        features = cursor.fetchall()
-        
-        for feature in features:
-            code = feature[0]
-            name = feature[1]
-            mingradient = feature[2]
-            maxgradient = feature[3]
-            
-            colname = "habitat_spawn_gradient_" + code
-            
-            query = f"""
-            
-                alter table {dbTargetSchema}.{dbTargetStreamTable} 
-                    add column if not exists {colname} boolean;
-        
-                update {dbTargetSchema}.{dbTargetStreamTable} 
-                    set {colname} = false;
-                
-                UPDATE {dbTargetSchema}.{dbTargetStreamTable}
-                set {colname} = true
-                WHERE
-                {code}_accessibility in ( '{appconfig.Accessibility.ACCESSIBLE.value}',
-                    '{appconfig.Accessibility.POTENTIAL.value}')
-                AND 
-                {dbSegmentGradientField} >= {mingradient} 
-                AND 
-                {dbSegmentGradientField} < {maxgradient}
-                
-            """
-            with connection.cursor() as cursor2:
-                cursor2.execute(query)
+#tables read and written by this script (see stage_scheduler)
+def stageInputs(context):
+    return [f"{context.targetSchema}.{dbTargetStreamTable}", f"{appconfig.dataSchema}.{appconfig.fishSpeciesTable}"]
 
-    # rearing
-    query = f"""
-        SELECT code, name, 
-        rear_gradient_min, rear_gradient_max
-        FROM {dataSchema}.{appconfig.fishSpeciesTable};
-    """
-    
-    with connection.cursor() as cursor:
-        cursor.execute(query)
-        features = cursor.fetchall()
-        
-        for feature in features:
-            code = feature[0]
-            name = feature[1]
-            mingradient = feature[2]
-            maxgradient = feature[3]
-            
-            colname = "habitat_rear_gradient_" + code
-            
-            query = f"""
-            
-                alter table {dbTargetSchema}.{dbTargetStreamTable} 
-                    add column if not exists {colname} boolean;
-        
-                update {dbTargetSchema}.{dbTargetStreamTable} 
-                    set {colname} = false;
-                
-                UPDATE {dbTargetSchema}.{dbTargetStreamTable}
-                set {colname} = true
-                WHERE
-                {code}_accessibility in ( '{appconfig.Accessibility.ACCESSIBLE.value}',
-                    '{appconfig.Accessibility.POTENTIAL.value}')
-                AND 
-                {dbSegmentGradientField} >= {mingradient} 
-                AND 
-                {dbSegmentGradientField} < {maxgradient}
-                
-            """
-            with connection.cursor() as cursor2:
-                cursor2.execute(query)
+def stageOutputs(context):
+    return [f"{context.targetSchema}.{dbTargetStreamTable}"]
 
+#stream table columns computed for each species
+def speciesColumns(code):
+    return ["habitat_spawn_" + code, "habitat_rear_" + code, "habitat_" + code]
 
-def computeDischargeModel(connection):
-        
-    # spawning    
-    query = f"""
-        SELECT code, name, 
-        spawn_discharge_min, spawn_discharge_max
-        FROM {dataSchema}.{appconfig.fishSpeciesTable};
-    """
-
-    with connection.cursor() as cursor:
-        cursor.execute(query)
-        features = cursor.fetchall()
-        
-        for feature in features:
-            code = feature[0]
-            name = feature[1]
-            minvelocity = feature[2]
-            maxvelocity = feature[3]
-            
-            colname = "habitat_spawn_discharge_" + code
-            
-            query = f"""
-            
-                alter table {dbTargetSchema}.{dbTargetStreamTable} 
-                    add column if not exists {colname} boolean;
-        
-                update {dbTargetSchema}.{dbTargetStreamTable} 
-                    set {colname} = false;
-                
-                UPDATE {dbTargetSchema}.{dbTargetStreamTable}
-                set {colname} = true
-                WHERE
-                {code}_accessibility in ( '{appconfig.Accessibility.ACCESSIBLE.value}',
-                    '{appconfig.Accessibility.POTENTIAL.value}')
-                AND 
-                {appconfig.streamTableDischargeField} >= {minvelocity} 
-                AND 
-                {appconfig.streamTableDischargeField} < {maxvelocity}
-                
-            """
-            with connection.cursor() as cursor2:
-                cursor2.execute(query)
-
-    # rearing
-    query = f"""
-        SELECT code, name, 
-        rear_discharge_min, rear_discharge_max
-        FROM {dataSchema}.{appconfig.fishSpeciesTable};
-    """
-
-    with connection.cursor() as cursor:
-        cursor.execute(query)
-        features = cursor.fetchall()
-        
-        for feature in features:
-            code = feature[0]
-            name = feature[1]
-            minvelocity = feature[2]
-            maxvelocity = feature[3]
-            
-            colname = "habitat_rear_discharge_" + code
-            
-            query = f"""
-            
-                alter table {dbTargetSchema}.{dbTargetStreamTable} 
-                    add column if not exists {colname} boolean;
-        
-                update {dbTargetSchema}.{dbTargetStreamTable} 
-                    set {colname} = false;
-                
-                UPDATE {dbTargetSchema}.{dbTargetStreamTable}
-                set {colname} = true
-                WHERE
-                {code}_accessibility in ( '{appconfig.Accessibility.ACCESSIBLE.value}',
+#
+# sql expression for a range criteria (min <= value < max) that only
+# applies to segments accessible to the species
+#
+def rangeModel(code, field, minvalue, maxvalue):
+    return f"""({code}_accessibility in ( '{appconfig.Accessibility.ACCESSIBLE.value}',
                     '{appconfig.Accessibility.POTENTIAL.value}')
-                AND 
-                {appconfig.streamTableDischargeField} >= {minvelocity} 
-                AND 
-                {appconfig.streamTableDischargeField} < {maxvelocity}
-                
-            """
-            with connection.cursor() as cursor2:
-                cursor2.execute(query)
-
+                AND {field} >= {sqlValue(minvalue)} AND {field} < {sqlValue(maxvalue)})"""
 
-def computeConfinementModel(connection):
+def sqlValue(value):
+    if value is None:
+        return "NULL"
+    return str(value)
 
-    # spawning      
-    query = f"""
-        SELECT code, name, 
-        spawn_channel_confinement_min, spawn_channel_confinement_max
-        FROM {dataSchema}.{appconfig.fishSpeciesTable};
-    """
+#
+# sql expression for a life stage (spawning or rearing) habitat model;
+# segments are habitat when all criteria are met and they are not 
+# first order streams
+#
+def lifeStageModel(code, prefix, parameters):
+    gradient = rangeModel(code, dbSegmentGradientField, 
+        parameters[prefix + '_gradient_min'], parameters[prefix + '_gradient_max'])
+    discharge = rangeModel(code, appconfig.streamTableDischargeField, 
+        parameters[prefix + '_discharge_min'], parameters[prefix + '_discharge_max'])
+    
+    return f"""COALESCE({gradient} 
+                AND {discharge} 
+                AND strahler_order <> 1, false)"""
 
-    with connection.cursor() as cursor:
-        cursor.execute(query)
-        features = cursor.fetchall()
-        
-        for feature in features:
-            code = feature[0]
-            name = feature[1]
-            mincc = feature[2]
-            maxcc = feature[3]
-            
-            colname = "habitat_spawn_channel_confinement_" + code
-            
-            query = f"""
-            
-                alter table {dbTargetSchema}.{dbTargetStreamTable} 
-                    add column if not exists {colname} boolean;
-        
-                update {dbTargetSchema}.{dbTargetStreamTable} 
-                    set {colname} = false;
-                
-                --TODO: implement model when defined
-                UPDATE {dbTargetSchema}.{dbTargetStreamTable}
-                set {colname} = true;                
-            """
-            with connection.cursor() as cursor2:
-                cursor2.execute(query)
+#
+# computes the spawning, rearing and general habitat models for the given
+# species codes (None for all species) with one update of the stream table;
+# the criteria for each species come from the fish species parameter table
+#
+def computeHabitatModels(connection, context, species = None):
+    
+    dbTargetSchema = context.targetSchema
     
-    # rearing
     query = f"""
         SELECT code, name, 
-        rear_channel_confinement_min, rear_channel_confinement_max
-        FROM {dataSchema}.{appconfig.fishSpeciesTable};
+        spawn_gradient_min, spawn_gradient_max,
+        rear_gradient_min, rear_gradient_max,
+        spawn_discharge_min, spawn_discharge_max,
+        rear_discharge_min, rear_discharge_max
+        FROM {dataSchema}.{appconfig.fishSpeciesTable}
+        WHERE {species_parameters.speciesFilter(species)};
     """
-
+    
     with connection.cursor() as cursor:
         cursor.execute(query)
-        features = cursor.fetchall()
+        names = [column[0] for column in cursor.description]
+        features = [dict(zip(names, feature)) for feature in cursor.fetchall()]
+    
+    if len(features) == 0:
+        return
+    
+    addcolumns = []
+    setcolumns = []
+    
+    for parameters in features:
+        code = parameters['code']
+        print("     processing " + parameters['name'])
         
-        for feature in features:
-            code = feature[0]
-            name = feature[1]
-            mincc = feature[2]
-            maxcc = feature[3]
-            
-            colname = "habitat_rear_channel_confinement_" + code
-            
-            query = f"""
-            
-                alter table {dbTargetSchema}.{dbTargetStreamTable} 
-                    add column if not exists {colname} boolean;
+        spawning = lifeStageModel(code, 'spawn', parameters)
+        rearing = lifeStageModel(code, 'rear', parameters)
         
-                update {dbTargetSchema}.{dbTargetStreamTable} 
-                    set {colname} = false;
-                
-                --TODO: implement model when defined
-                UPDATE {dbTargetSchema}.{dbTargetStreamTable}
-                set {colname} = true;                
-            """
-            with connection.cursor() as cursor2:
-                cursor2.execute(query)
-
-def computeHabitatModel(connection):
-
-    # spawning
-    query = f"""
-        SELECT code, name
-        FROM {dataSchema}.{appconfig.fishSpeciesTable};
-    """
-
-    with connection.cursor() as cursor:
-        cursor.execute(query)
-        features = cursor.fetchall()
+        for colname in speciesColumns(code):
+            addcolumns.append(f"ADD COLUMN IF NOT EXISTS {colname} boolean")
+        
+        setcolumns.append(f"habitat_spawn_{code} = {spawning}")
+        setcolumns.append(f"habitat_rear_{code} = {rearing}")
+        setcolumns.append(f"habitat_{code} = ({spawning}) OR ({rearing})")
     
-        for feature in features:
-            code = feature[0]
-            name = feature[1]
-
-            gradient = "habitat_spawn_gradient_" + code
-            discharge = "habitat_spawn_discharge_" + code
-            chn_confine = "habitat_spawn_channel_confinement_" + code
-
-            colname = "habitat_spawn_" + code
-
-            print("     processing " + name)
-
-            query = f"""
-                ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable}
-                    ADD COLUMN IF NOT EXISTS {colname} boolean;
-                
-                UPDATE {dbTargetSchema}.{dbTargetStreamTable} 
-                    SET {colname} = false;
-
-                UPDATE {dbTargetSchema}.{dbTargetStreamTable} 
-                    SET {colname} = true
-                    WHERE {gradient} = true AND {discharge} = true AND {chn_confine} = true
-                    AND strahler_order <> 1;
-                
-                ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable}
-                    DROP COLUMN {gradient},
-                    DROP COLUMN {discharge},
-                    DROP COLUMN {chn_confine};
-            """
-            with connection.cursor() as cursor2:
-                cursor2.execute(query)
-
-    # rearing
-    query = f"""
-        SELECT code, name
-        FROM {dataSchema}.{appconfig.fishSpeciesTable};
-    """
-
-    with connection.cursor() as cursor:
-        cursor.execute(query)
-        features = cursor.fetchall()
+    addstr = ',\n                '.join(addcolumns)
+    setstr = ',\n                '.join(setcolumns)
     
-        for feature in features:
-            code = feature[0]
-            name = feature[1]
-
-            gradient = "habitat_rear_gradient_" + code
-            discharge = "habitat_rear_discharge_" + code
-            chn_confine = "habitat_rear_channel_confinement_" + code
-
-            colname = "habitat_rear_" + code
-
-            query = f"""
-                ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable}
-                    ADD COLUMN IF NOT EXISTS {colname} boolean;
-                
-                UPDATE {dbTargetSchema}.{dbTargetStreamTable} 
-                    SET {colname} = false;
-
-                UPDATE {dbTargetSchema}.{dbTargetStreamTable} 
-                    SET {colname} = true
-                    WHERE {gradient} = true AND {discharge} = true AND {chn_confine} = true
-                    AND strahler_order <> 1;
-                
-                ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable}
-                    DROP COLUMN {gradient},
-                    DROP COLUMN {discharge},
-                    DROP COLUMN {chn_confine};
-            """
-            with connection.cursor() as cursor2:
-                cursor2.execute(query)
-
-    # general habitat
     query = f"""
-        SELECT code, name
-        FROM {dataSchema}.{appconfig.fishSpeciesTable};
+        ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable}
+                {addstr};
+        
+        UPDATE {dbTargetSchema}.{dbTargetStreamTable} SET
+                {setstr};
     """
-
+    
     with connection.cursor() as cursor:
         cursor.execute(query)
-        features = cursor.fetchall()
     
-        for feature in features:
-            code = feature[0]
-            name = feature[1]
-            
-            spawning = "habitat_spawn_" + code
-            rearing = "habitat_rear_" + code
-
-            colname = "habitat_" + code
+    connection.commit()
 
-            query = f"""
-                ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable}
-                    ADD COLUMN IF NOT EXISTS {colname} boolean;
-                
-                UPDATE {dbTargetSchema}.{dbTargetStreamTable} 
-                    SET {colname} = false;
-
-                UPDATE {dbTargetSchema}.{dbTargetStreamTable} 
-                    SET {colname} = CASE WHEN {spawning} = false AND {rearing} = false THEN false ELSE true END;
-            
-            """
-            with connection.cursor() as cursor2:
-                cursor2.execute(query)
-
-def main():                            
-    #--- main program ---    
-    with appconfig.connectdb() as conn:
+def run(context):
+    with context.connect() as conn:
         
         conn.autocommit = False
         
         print("Computing Habitat Models Per Species")
         
-        print("  computing gradient models per species")
-        computeGradientModel(conn)
+        print("  computing gradient, discharge, spawning and rearing habitat models")
+
+        computeHabitatModels(conn, context)
         
-        print("  computing discharge models per species")
-        computeDischargeModel(conn)
+    print("done")
+
+#
+# recomputes the habitat models of the species whose parameters changed 
+# and drops the columns of removed species (see refresh_parameters)
+#
+def runSpecies(context, species, removed):
+    with context.connect() as conn:
         
-        print("  computing channel confinement models per species")
-        computeConfinementModel(conn)
+        conn.autocommit = False
+        
+        print("Computing Habitat Models For Changed Species")
+        species_parameters.dropColumns(conn, f"{context.targetSchema}.{dbTargetStreamTable}", 
+            [column for code in removed for column in speciesColumns(code)])
+        
+        computeHabitatModels(conn, context, species)
 
-        print("  computing spawning and rearing habitat models per species")
-        computeHabitatModel(conn)
         
     print("done")
 
+def main():                            
+
+    #--- main program ---    
+    run(stage_context.fromArgs())
+
 
 if __name__ == "__main__":
     main()  
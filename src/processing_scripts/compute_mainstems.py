@@ -29,161 +29,90 @@
 #  * elevation processing is completed
 #
 import appconfig
-import shapely.wkb
-from collections import deque
 import uuid;
-import psycopg2.extras
+import numpy
+import bulk_writer
+import stream_network
+import stage_context
 
-iniSection = appconfig.args.args[0]
-
-dbTargetSchema = appconfig.config[iniSection]['output_schema']
-watershed_id = appconfig.config[iniSection]['watershed_id']
 dbTargetStreamTable = appconfig.config['PROCESSING']['stream_table']
 
 dbMainstemField = appconfig.config['MAINSTEM_PROCESSING']['mainstem_id']
 dbDownMeasureField = appconfig.config['MAINSTEM_PROCESSING']['downstream_route_measure']
 dbUpMeasureField = appconfig.config['MAINSTEM_PROCESSING']['upstream_route_measure']
-edges = []
-nodes = dict()
 
-class Node:
-    
-    def __init__(self, x, y):
-        self.inedges = []
-        self.outedges = []
-        self.x = x
-        self.y = y
-        self.uplength = 0
-        self.upedge = None
-        self.mainstemid = None
-        self.downstreammeasure = 0
-   
-    def addInEdge(self, edge):
-        self.inedges.append(edge)
-   
-    def addOutEdge(self, edge):
-        self.outedges.append(edge)
-    
-   
-    
-class Edge:
-    def __init__(self, fromnode, tonode, fid, length, sname, ls):
-        self.fromNode = fromnode
-        self.toNode = tonode
-        self.ls = ls
-        self.fid = fid
-        self.visited = False
-        self.length = length
-        self.sname = sname
-        self.mainstemid = None
-        self.uplength = 0
-        self.downstreammeasure = 0
+#tables read and written by this script (see stage_scheduler)
+def stageInputs(context):
+    return [f"{context.targetSchema}.{dbTargetStreamTable}"]
+
+def stageOutputs(context):
+    return [f"{context.targetSchema}.{dbTargetStreamTable}"]
         
-def createNetwork(connection):
+def createNetwork(connection, context):
     query = f"""
         SELECT a.{appconfig.dbIdField} as id, st_length(a.{appconfig.dbGeomField}) as length, 
-          a.stream_name, a.{appconfig.dbGeomField}
-        FROM {dbTargetSchema}.{dbTargetStreamTable} a
+          a.stream_name, {stream_network.endpointFields('a.' + appconfig.dbGeomField)}
+        FROM {context.targetSchema}.{dbTargetStreamTable} a
     """
    
-    #load geometries and create a network
-    with connection.cursor() as cursor:
-        cursor.execute(query)
-        features = cursor.fetchall()
-        
-        
-        for feature in features:
-            fid = feature[0]
-            length = feature[1]
-            sname = feature[2]
-            if (sname == "UNNAMED"):
-                sname = None
-                
-            geom = shapely.wkb.loads(feature[3] , hex=True)
-            
-            startc = geom.coords[0]
-            endc = geom.coords[len(geom.coords)-1]
-            
-            startt = (startc[0], startc[1])
-            endt = (endc[0], endc[1])            
-            
-            if (startt in nodes.keys()):
-                fromNode = nodes[startt]
-            else:
-                #create new node
-                fromNode = Node(startc[0], startc[1])
-                nodes[startt] = fromNode
-            
-            if (endt in nodes.keys()):
-                toNode = nodes[endt]
-            else:
-                #create new node
-                toNode = Node(endc[0], endc[1])
-                nodes[endt] = toNode
-            
-            edge = Edge(fromNode, toNode, fid, length, sname, geom)
-            edges.append(edge)
+    fids = []
+    lengths = []
+    snames = []
+    startcoords = []
+    endcoords = []
+    
+    #load end points and create a network; rows are streamed from the
+    #database in batches instead of all being fetched at once
+    for feature in stream_network.readRows(connection, query):
+        fid = feature[0]
+        length = feature[1]
+        sname = feature[2]
+        if (sname == "UNNAMED"):
+            sname = None
             
-            fromNode.addOutEdge(edge)
-            toNode.addInEdge(edge)            
+        fids.append(fid)
+        lengths.append(length)
+        snames.append(sname)
+        startcoords.append((feature[3], feature[4]))
+        endcoords.append((feature[5], feature[6]))
+    
+    network = stream_network.StreamNetwork(fids, startcoords, endcoords)
+    network.attributes['length'] = numpy.array(lengths, dtype=numpy.float64)
+    network.attributes['sname'] = snames
+    return network
 
-def processNodes():
+def processNodes(network):
     
+    fromnode = network.fromnode
+    length = network.attributes['length']
+    sname = network.attributes['sname']
     
-    #walk down network        
-    toprocess = deque()
-    for edge in edges:
-        edge.visited = False
-        
-    for node in nodes.values():
-        if (len(node.inedges) == 0):
-            toprocess.append(node)
-            
-    while (toprocess):
-        node = toprocess.popleft()
-        
-        allvisited = True
-        
-        maxValue = 0 
-        for inedge in node.inedges:
-            if not inedge.visited:
-                allvisited = False;
-                break;
-            else:
-                length = inedge.fromNode.uplength + inedge.length
-                if (length > maxValue):
-                    maxValue = length
-        
-        if not allvisited:
-            toprocess.append(node)
-        else:
-            node.uplength = maxValue
-            
-        for outedge in node.outedges:
-            outedge.visited = True
-            if (not outedge.toNode in toprocess):
-                toprocess.append(outedge.toNode)
+    nodeuplength = numpy.zeros(network.nodecount)
+    nodemainstemid = [None] * network.nodecount
+    nodedownstreammeasure = numpy.zeros(network.nodecount)
+    
+    edgemainstemid = [None] * network.edgecount
+    edgedownstreammeasure = numpy.zeros(network.edgecount)
+    
+    #walk down network computing the longest upstream length at each node
+    for edges in network.edgeLevels():
+        numpy.maximum.at(nodeuplength, network.tonode[edges], nodeuplength[fromnode[edges]] + length[edges])
     
     #walk up computing mainstem id
-    for edge in edges:
-        edge.visited = False
-        
-    toprocess = deque()
-    for node in nodes.values():
-        if (len(node.outedges) == 0):
-            toprocess.append(node)
-            node.mainstemid = uuid.uuid4()
+    for node in network.sinks():
+        nodemainstemid[node] = uuid.uuid4()
     
-    while (toprocess):
-        node = toprocess.popleft()
+    for node in network.topologicalOrder()[::-1]:
         
-        if (len(node.inedges) == 0):
+        inedges = network.inEdges(node)
+        if (len(inedges) == 0):
             continue
         
         #visit this node
-        sname = None
-        if (len(node.outedges) > 0):
-            sname = node.outedges[0].sname
+        nodesname = None
+        outedges = network.outEdges(node)
+        if (len(outedges) > 0):
+            nodesname = sname[outedges[0]]
         
         longest = -9999
         longestNode = None
@@ -193,71 +122,68 @@ def processNodes():
         longestnamed = -9999
         longestnamedNode = None
         
-        for inedge in node.inedges:
-            if (inedge.fromNode.uplength + inedge.length > longest):
-                longest = inedge.fromNode.uplength + inedge.length
-                longestNode = inedge.fromNode
+        for inedge in inedges:
+            upnode = fromnode[inedge]
+            if (nodeuplength[upnode] + length[inedge] > longest):
+                longest = nodeuplength[upnode] + length[inedge]
+                longestNode = upnode
             
-            if (sname != None and inedge.sname == sname):
-                namedNode = inedge.fromNode
+            if (nodesname != None and sname[inedge] == nodesname):
+                namedNode = upnode
             
-            if (inedge.sname != None and (sname != None and inedge.sname != sname)):
-                if (inedge.fromNode.uplength > longestnamed):
-                    longestnamed = inedge.fromNode.uplength;
-                    longestnamedNode = inedge.fromNode;
-                    
-        
+            if (sname[inedge] != None and (nodesname != None and sname[inedge] != nodesname)):
+                if (nodeuplength[upnode] > longestnamed):
+                    longestnamed = nodeuplength[upnode];
+                    longestnamedNode = upnode;
         
-        upnode = None
+        mainNode = None
         if (namedNode != None):
-            upnode = namedNode
+            mainNode = namedNode
         elif (longestnamedNode != None):
-            upnode = longestnamedNode
+            mainNode = longestnamedNode
         elif (longestNode != None):
-            upnode = longestNode 
-        
-        for inedge in node.inedges:
-            if (inedge.fromNode == upnode):
-                inedge.mainstemid = node.mainstemid
-                inedge.fromNode.downstreammeasure = node.downstreammeasure + inedge.length;
-                inedge.downstreammeasure = node.downstreammeasure;
+            mainNode = longestNode 
+        
+        for inedge in inedges:
+            upnode = fromnode[inedge]
+            if (upnode == mainNode):
+                edgemainstemid[inedge] = nodemainstemid[node]
+                nodedownstreammeasure[upnode] = nodedownstreammeasure[node] + length[inedge];
+                edgedownstreammeasure[inedge] = nodedownstreammeasure[node];
             else:
-                inedge.mainstemid = uuid.uuid4()
-                inedge.downstreammeasure = 0;
-                inedge.fromNode.downstreammeasure = inedge.length
+                edgemainstemid[inedge] = uuid.uuid4()
+                edgedownstreammeasure[inedge] = 0;
+                nodedownstreammeasure[upnode] = length[inedge]
 
-            inedge.fromNode.mainstemid = inedge.mainstemid
-            
-            toprocess.append(inedge.fromNode)
+            nodemainstemid[upnode] = edgemainstemid[inedge]
     
+    network.attributes['mainstemid'] = edgemainstemid
+    network.attributes['downstreammeasure'] = edgedownstreammeasure
         
-def writeResults(connection):
+def writeResults(connection, context, network):
       
-    updatequery = f"""
-        UPDATE {dbTargetSchema}.{dbTargetStreamTable}
-        SET {dbMainstemField} = %s, {dbDownMeasureField} = %s, {dbUpMeasureField} = %s
-        WHERE {appconfig.dbIdField} = %s;
-    """
-    
     newdata = []
     
-    for edge in edges:
-        downmeasurekm = (edge.downstreammeasure)
-        upmeasurekm = (edge.downstreammeasure + edge.length)
-        newdata.append( (edge.mainstemid, downmeasurekm, upmeasurekm, edge.fid) )
+    length = network.attributes['length']
+    mainstemid = network.attributes['mainstemid']
+    downstreammeasure = network.attributes['downstreammeasure']
+    
+    for edge in range(network.edgecount):
+        downmeasurekm = float(downstreammeasure[edge])
+        upmeasurekm = float(downstreammeasure[edge] + length[edge])
+        newdata.append( (network.fids[edge], mainstemid[edge], downmeasurekm, upmeasurekm) )
     
-    with connection.cursor() as cursor:    
-        psycopg2.extras.execute_batch(cursor, updatequery, newdata);
+    bulk_writer.updateTable(connection, f"{context.targetSchema}.{dbTargetStreamTable}", appconfig.dbIdField, 
+        [dbMainstemField, dbDownMeasureField, dbUpMeasureField], newdata)
             
     connection.commit()
 
 
-#--- main program ---  
-def main():  
-    edges.clear()
-    nodes.clear()
+def run(context):
     
-    with appconfig.connectdb() as conn:
+    dbTargetSchema = context.targetSchema
+    
+    with context.connect() as conn:
         
         conn.autocommit = False
         
@@ -283,15 +209,20 @@ def main():
             cursor.execute(query)
         
         print("  creating network")
-        createNetwork(conn)
+        network = createNetwork(conn, context)
         
         print("  processing nodes")
-        processNodes()
+        processNodes(network)
             
         print("  writing results")
-        writeResults(conn)
+        writeResults(conn, context, network)
         
     print("done")
 
+#--- main program ---  
+def main():  
+    run(stage_context.fromArgs())
+
+
 if __name__ == "__main__":
     main()     
\ No newline at end of file
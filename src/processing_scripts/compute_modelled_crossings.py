@@ -22,10 +22,9 @@
 # from the stream network
 #
 import appconfig
+import stage_checkpoint
+import stage_context
 
-iniSection = appconfig.args.args[0]
-
-dbTargetSchema = appconfig.config[iniSection]['output_schema']
 dbTargetStreamTable = appconfig.config['PROCESSING']['stream_table']
 
 dbModelledCrossingsTable = appconfig.config['CROSSINGS']['modelled_crossings_table']
@@ -38,9 +37,35 @@ trailTable = appconfig.config['CREATE_LOAD_SCRIPT']['trail_table']
 dbBarrierTable = appconfig.config['BARRIER_PROCESSING']['barrier_table']
 dbCrossingsTable = appconfig.config['CROSSINGS']['crossings_table']
 
+#tables read and written by this script (see stage_scheduler)
+def stageInputs(context):
+    return [f"{context.targetSchema}.{dbTargetStreamTable}",
+            f"{appconfig.dataSchema}.{roadTable}",
+            f"{appconfig.dataSchema}.{railTable}",
+            f"{appconfig.dataSchema}.{trailTable}"]
+
+def stageOutputs(context):
+    return [f"{context.targetSchema}.{dbModelledCrossingsTable}", f"{context.targetSchema}.{dbModelledCrossingsTable}_archive"]
+
+#only the features within the extent of the watershed streams are read
+#(see stage_checkpoint)
+def stageQueries(context):
+    extent = f"""(SELECT ST_SetSRID(ST_Extent({appconfig.dbGeomField})::geometry, {appconfig.dataSrid}) 
+        FROM {appconfig.dataSchema}.{appconfig.streamTable} 
+        WHERE {appconfig.dbWatershedIdField} = '{context.watershedId}')"""
+    
+    queries = {}
+    for table in [roadTable, railTable, trailTable]:
+        table = f"{appconfig.dataSchema}.{table}"
+        queries[table] = stage_checkpoint.checksumQuery(table, f"t.geometry && {extent}")
+    return queries
+
 
-def createTable(connection):
 
+def createTable(connection, context):
+
+    dbTargetSchema = context.targetSchema
+    
     query = f"""
         --create an archive table so we can keep modelled_id stable
         DROP TABLE IF EXISTS {dbTargetSchema}.{dbModelledCrossingsTable}_archive;
@@ -74,8 +99,10 @@ def createTable(connection):
         cursor.execute(query)
     connection.commit()
 
-def computeCrossings(connection):
-        
+def computeCrossings(connection, context):
+    
+    dbTargetSchema = context.targetSchema
+    
     query = f"""
         --roads
         INSERT INTO {dbTargetSchema}.{dbModelledCrossingsTable} 
@@ -154,8 +181,10 @@ def computeCrossings(connection):
     with connection.cursor() as cursor:
         cursor.execute(query)
 
-def matchArchive(connection):
+def matchArchive(connection, context):
 
+    dbTargetSchema = context.targetSchema
+    
     query = f"""
         ALTER TABLE {dbTargetSchema}.{dbModelledCrossingsTable} DROP CONSTRAINT IF EXISTS modelled_crossings_pkey;
 
@@ -188,7 +217,9 @@ def matchArchive(connection):
     with connection.cursor() as cursor:
         cursor.execute(query)
 
-def computeAttributes(connection):
+def computeAttributes(connection, context):
+    
+    dbTargetSchema = context.targetSchema
     
     #assign all modelled crossings on 6th order streams and above a 
     #crossing_subtype of 'bridge' and a passability_status of 'passable'
@@ -214,29 +245,33 @@ def computeAttributes(connection):
     with connection.cursor() as cursor:
         cursor.execute(query)
 
-def main():   
-    #--- main program ---
-    with appconfig.connectdb() as conn:
+def run(context):
+    with context.connect() as conn:
 
         conn.autocommit = False
 
         print("Computing Modelled Crossings")
 
         print("  creating tales")
-        createTable(conn)
+        createTable(conn, context)
         
         print("  computing modelled crossings")
-        computeCrossings(conn)
+        computeCrossings(conn, context)
 
         print("  matching to archived crossings")
-        matchArchive(conn)
+        matchArchive(conn, context)
 
         print("  calculating modelled crossing attributes")
-        computeAttributes(conn)
+        computeAttributes(conn, context)
 
         conn.commit()
 
     print("done")
 
+def main():   
+    #--- main program ---
+    run(stage_context.fromArgs())
+
+
 if __name__ == "__main__":
     main()
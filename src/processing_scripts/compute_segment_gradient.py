@@ -25,18 +25,26 @@
 # maximum vertex gradient for the stream segment
 #
 import appconfig
+import numpy
+import stage_context
 
-iniSection = appconfig.args.args[0]
-
-dbTargetSchema = appconfig.config[iniSection]['output_schema']
 dbTargetStreamTable = appconfig.config['PROCESSING']['stream_table']
 
 dbSegmentGradientField = appconfig.config['GRADIENT_PROCESSING']['segment_gradient_field']
 dbSmoothedGeomField = appconfig.config['ELEVATION_PROCESSING']['smoothedgeometry_field']
 
+#tables read and written by this script (see stage_scheduler)
+def stageInputs(context):
+    return [f"{context.targetSchema}.{dbTargetStreamTable}"]
+
+def stageOutputs(context):
+    return [f"{context.targetSchema}.{dbTargetStreamTable}"]
+
 
-def computeSegmentGradient(connection):
+def computeSegmentGradient(connection, context):
 
+    dbTargetSchema = context.targetSchema
+    
     query = f"""
         ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable} ADD COLUMN IF NOT EXISTS {dbSegmentGradientField} double precision;
         
@@ -50,20 +58,39 @@ def computeSegmentGradient(connection):
     connection.commit()
 
 
+#
+# computes the segment gradient of (n,3) smoothed coordinate arrays held
+# in memory (used by the fused elevation pipeline); the same as 
+# computeSegmentGradient, the elevation change over the 2d length
+#
+def computeGradients(coords):
+    gradients = []
+    for c in coords:
+        length = numpy.hypot(numpy.diff(c[:, 0]), numpy.diff(c[:, 1])).sum()
+        if length > 0:
+            gradients.append(float((c[0, 2] - c[-1, 2]) / length))
+        else:
+            gradients.append(None)
+    return gradients
 
-def main():
-    #--- main program ---    
-    with appconfig.connectdb() as conn:
+
+def run(context):
+    with context.connect() as conn:
         
         conn.autocommit = False
         
         print("Computing Segment Gradient")
         
         print("  computing vertex gradients")
-        computeSegmentGradient(conn)
+        computeSegmentGradient(conn, context)
         
         
     print("done")
 
+def main():
+    #--- main program ---    
+    run(stage_context.fromArgs())
+
+
 if __name__ == "__main__":
     main() 
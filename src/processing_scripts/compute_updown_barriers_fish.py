@@ -22,15 +22,10 @@
 #
 #
 import appconfig
-import shapely.wkb
-from collections import deque
-import psycopg2.extras
+import bulk_writer
+import stream_network
+import stage_context
 
-
-iniSection = appconfig.args.args[0]
-
-dbTargetSchema = appconfig.config[iniSection]['output_schema']
-watershed_id = appconfig.config[iniSection]['watershed_id']
 dbTargetStreamTable = appconfig.config['PROCESSING']['stream_table']
 
 dbBarrierTable = appconfig.config['BARRIER_PROCESSING']['barrier_table']
@@ -39,343 +34,267 @@ dbGradientBarrierTable = appconfig.config['BARRIER_PROCESSING']['gradient_barrie
 dbFishStockingTable = appconfig.config['DATABASE']['fish_stocking_table']
 dbFishSurveyTable = appconfig.config['DATABASE']['fish_survey_table']
 
-edges = []
-nodes = dict()
+#tables read and written by this script (see stage_scheduler)
+def stageInputs(context):
+    return [f"{context.targetSchema}.{dbTargetStreamTable}",
+            f"{context.targetSchema}.{dbBarrierTable}",
+            f"{context.targetSchema}.{dbGradientBarrierTable}",
+            f"{context.targetSchema}.{dbFishStockingTable}",
+            f"{context.targetSchema}.{dbFishSurveyTable}"]
+
+def stageOutputs(context):
+    return [f"{context.targetSchema}.{dbTargetStreamTable}",
+            f"{context.targetSchema}.{dbFishStockingTable}",
+            f"{context.targetSchema}.{dbFishSurveyTable}"]
 
-class Node:
+#per edge sets computed by the network walk; each set is stored as a 
+#python int bitset with one bit for each barrier id or species code
+edgesets = ['upbarriers', 'downbarriers', 'upgradient', 'downgradient', 
+            'stockedge', 'stockup', 'stockdown', 
+            'surveyedge', 'surveyup', 'surveydown']
+
+#
+# assigns each value (barrier id, species code) a bit so sets of values
+# can be stored as int bitsets
+#
+class BitSlots:
     
-    def __init__(self, x, y):
-        self.inedges = []
-        self.outedges = []
-        self.x = x
-        self.y = y
-        self.barrierids = set()
-        self.gradientbarrierids = set()
-   
-    def addInEdge(self, edge):
-        self.inedges.append(edge)
-   
-    def addOutEdge(self, edge):
-        self.outedges.append(edge)
+    def __init__(self):
+        self.slots = {}
+        self.values = []
     
-   
+    #the bitset containing only the value
+    def bit(self, value):
+        slot = self.slots.get(value)
+        if slot is None:
+            slot = len(self.values)
+            self.slots[value] = slot
+            self.values.append(value)
+        return 1 << slot
     
-class Edge:
-    def __init__(self, fromnode, tonode, fid, ls):
-        self.fromNode = fromnode
-        self.toNode = tonode
-        self.ls = ls
-        self.fid = fid
-        self.visited = False
-        self.upbarriers = set()
-        self.downbarriers = set()
-        self.upgradient = set()
-        self.downgradient = set()
-        self.stockedge = set()
-        self.stockup = set()
-        self.stockdown = set()
-        self.surveyedge = set()
-        self.surveyup = set()
-        self.surveydown = set()
+    #the values in the bitset
+    def toList(self, bits):
+        values = []
+        while bits:
+            lowbit = bits & -bits
+            values.append(self.values[lowbit.bit_length() - 1])
+            bits ^= lowbit
+        return values
+
+def bitCount(bits):
+    return bin(bits).count('1')
         
-def createNetwork(connection):
+def createNetwork(connection, context):
+    
+    dbTargetSchema = context.targetSchema
     
     query = f"""
-        SELECT a.{appconfig.dbIdField} as id, a.{appconfig.dbGeomField}
+        SELECT a.{appconfig.dbIdField} as id, {stream_network.endpointFields('a.' + appconfig.dbGeomField)}
         FROM {dbTargetSchema}.{dbTargetStreamTable} a
     """
    
-    #load geometries and create a network
-    with connection.cursor() as cursor:
-        cursor.execute(query)
-        features = cursor.fetchall()
-        
-        
-        for feature in features:
-            fid = feature[0]
-            geom = shapely.wkb.loads(feature[1] , hex=True)
-            
-            startc = geom.coords[0]
-            endc = geom.coords[len(geom.coords)-1]
-            
-            startt = (startc[0], startc[1])
-            endt = (endc[0], endc[1])            
-            
-            if (startt in nodes.keys()):
-                fromNode = nodes[startt]
-            else:
-                #create new node
-                fromNode = Node(startc[0], startc[1])
-                nodes[startt] = fromNode
-            
-            if (endt in nodes.keys()):
-                toNode = nodes[endt]
-            else:
-                #create new node
-                toNode = Node(endc[0], endc[1])
-                nodes[endt] = toNode
-            
-            edge = Edge(fromNode, toNode, fid, geom)
-            edges.append(edge)
+    fids = []
+    startcoords = []
+    endcoords = []
+    
+    #load end points and create a network; rows are streamed from the
+    #database in batches instead of all being fetched at once
+    for feature in stream_network.readRows(connection, query):
+        fid = feature[0]
             
-            fromNode.addOutEdge(edge)
-            toNode.addInEdge(edge)     
+        fids.append(fid)
+        startcoords.append((feature[1], feature[2]))
+        endcoords.append((feature[3], feature[4]))
+    
+    network = stream_network.StreamNetwork(fids, startcoords, endcoords)
+    for name in edgesets:
+        network.attributes[name] = [0] * network.edgecount
+    barrierids = [0] * network.nodecount
+    gradientbarrierids = [0] * network.nodecount
+    network.nodeattributes['barrierids'] = barrierids
+    network.nodeattributes['gradientbarrierids'] = gradientbarrierids
+    
+    barrierslots = BitSlots()
+    gradientslots = BitSlots()
+    speciesslots = BitSlots()
+    network.barrierslots = barrierslots
+    network.gradientslots = gradientslots
+    network.speciesslots = speciesslots
             
-    #add barriers
+    #add barriers, gradient barriers and species stocking and survey 
+    #details; all are loaded in a single query
     query = f"""
-        select 'up', a.id, b.id 
+        select 'barrier', 'up', a.id::varchar, b.id 
         from {dbTargetSchema}.{dbBarrierTable} a, {dbTargetSchema}.{dbTargetStreamTable} b
         where b.geometry && st_buffer(a.snapped_point, 0.0000001)
             and ST_DWithin(st_startpoint(b.geometry), a.snapped_point, 0.00000001)
             and a.passability_status != 'PASSABLE'
         union 
-        select 'down', a.id, b.id 
+        select 'barrier', 'down', a.id::varchar, b.id 
         from {dbTargetSchema}.{dbBarrierTable} a, {dbTargetSchema}.{dbTargetStreamTable} b
         where b.geometry && st_buffer(a.snapped_point, 0.0000001)
             and ST_DWithin(st_endpoint(b.geometry), a.snapped_point, 0.00000001)
-            and a.passability_status != 'PASSABLE'       
-    """
-   
-    #load geometries and create a network
-    with connection.cursor() as cursor:
-        cursor.execute(query)
-        features = cursor.fetchall()
-        
-        
-        for feature in features:
-            etype = feature[0]
-            bid = feature[1]
-            sid = feature[2]
-            
-            for edge in edges:
-                if (edge.fid == sid):
-                    if (etype == 'up'):
-                        edge.fromNode.barrierids.add(bid)
-                    elif (etype == 'down'):
-                        edge.toNode.barrierids.add(bid)
-                        
-    #add gradient barriers
-    query = f"""
-        select 'up', a.barrier_id, b.id 
+            and a.passability_status != 'PASSABLE'
+        union
+        select 'gradient', 'up', a.barrier_id::varchar, b.id 
         from {dbTargetSchema}.{dbGradientBarrierTable} a, {dbTargetSchema}.{dbTargetStreamTable} b
         where b.geometry && st_buffer(a.point, 0.0000001)
             and ST_DWithin(st_startpoint(b.geometry), a.point, 0.00000001)
             and a.type = 'gradient_barrier'
         union 
-        select 'down', a.barrier_id, b.id 
+        select 'gradient', 'down', a.barrier_id::varchar, b.id 
         from {dbTargetSchema}.{dbGradientBarrierTable} a, {dbTargetSchema}.{dbTargetStreamTable} b
         where b.geometry && st_buffer(a.point, 0.0000001)
             and ST_DWithin(st_endpoint(b.geometry), a.point, 0.00000001)
-            and a.type = 'gradient_barrier'     
-    """
-   
-    #load geometries and create a network
-    with connection.cursor() as cursor:
-        cursor.execute(query)
-        features = cursor.fetchall()
-        
-        
-        for feature in features:
-            etype = feature[0]
-            bid = feature[1]
-            sid = feature[2]
-            
-            for edge in edges:
-                if (edge.fid == sid):
-                    if (etype == 'up'):
-                        edge.fromNode.gradientbarrierids.add(bid)
-                    elif (etype == 'down'):
-                        edge.toNode.gradientbarrierids.add(bid)         
-
-    #add species and stocking details
-    query = f"""
-        select a.stream_id, a.spec_code
+            and a.type = 'gradient_barrier'
+        union
+        select 'stock', null, a.spec_code::varchar, a.stream_id
         FROM {dbTargetSchema}.{dbFishStockingTable} a
         WHERE spec_code IS NOT NULL
-    """ 
-    
-    with connection.cursor() as cursor:
-        cursor.execute(query)
-        features = cursor.fetchall()
-        
-        
-        for feature in features:
-            sid = feature[0]
-            speccode = feature[1]
-            
-            for edge in edges:
-                if (edge.fid == sid):
-                    edge.stockedge.add(speccode)
-    
-    query = f"""
-        select a.stream_id, a.spec_code
+        union
+        select 'survey', null, a.spec_code::varchar, a.stream_id
         FROM {dbTargetSchema}.{dbFishSurveyTable} a
         WHERE spec_code IS NOT NULL
     """
-   
-    #add species and stocking details
+    
+    stockedge = network.attributes['stockedge']
+    surveyedge = network.attributes['surveyedge']
+    
     with connection.cursor() as cursor:
         cursor.execute(query)
         features = cursor.fetchall()
         
-        
         for feature in features:
-            sid = feature[0]
-            speccode = feature[1]
+            ftype = feature[0]
+            etype = feature[1]
+            value = feature[2]
+            edge = network.getEdge(feature[3])
+            
+            if edge is None:
+                continue
             
-            for edge in edges:
-                if (edge.fid == sid):
-                    edge.surveyedge.add(speccode)
+            if ftype == 'barrier' or ftype == 'gradient':
+                if ftype == 'barrier':
+                    nodeids = barrierids
+                    bit = barrierslots.bit(value)
+                else:
+                    nodeids = gradientbarrierids
+                    bit = gradientslots.bit(value)
+                
+                if (etype == 'up'):
+                    nodeids[network.fromnode[edge]] |= bit
+                elif (etype == 'down'):
+                    nodeids[network.tonode[edge]] |= bit
+            elif ftype == 'stock':
+                stockedge[edge] |= speciesslots.bit(value)
+            elif ftype == 'survey':
+                surveyedge[edge] |= speciesslots.bit(value)
+    
+    return network
                                             
 
-def processNodes():
+def processNodes(network):
+    
+    attr = network.attributes
+    barrierids = network.nodeattributes['barrierids']
+    gradientbarrierids = network.nodeattributes['gradientbarrierids']
     
+    upbarrieredges = attr['upbarriers']
+    upgradientedges = attr['upgradient']
+    stockupedges = attr['stockup']
+    surveyupedges = attr['surveyup']
+    downbarrieredges = attr['downbarriers']
+    downgradientedges = attr['downgradient']
+    stockdownedges = attr['stockdown']
+    surveydownedges = attr['surveydown']
+    stockedges = attr['stockedge']
+    surveyedges = attr['surveyedge']
     
     #walk down network        
-    toprocess = deque()
-    for edge in edges:
-        edge.visited = False
-        
-    for node in nodes.values():
-        if (len(node.inedges) == 0):
-            toprocess.append(node)
-            
-    while (toprocess):
-        node = toprocess.popleft()
-        
-        allvisited = True
+    for node in network.topologicalOrder():
         
-        upbarriers = set()
-        upgradient = set()
+        upbarriers = barrierids[node]
+        upgradient = gradientbarrierids[node]
         
-        stockup = set()
-        surveyup = set()
+        stockup = 0
+        surveyup = 0
          
-        for inedge in node.inedges:
-               
-            if not inedge.visited:
-                allvisited = False;
-                break;
-            else:
-                upbarriers.update(inedge.upbarriers)
-                upgradient.update(inedge.upgradient)
-                stockup.update(inedge.stockup)
-                stockup.update(inedge.stockedge)
-                surveyup.update(inedge.surveyup)
-                surveyup.update(inedge.surveyedge)
-                
-        if not allvisited:
-            toprocess.append(node)
-        else:
-            upbarriers.update(node.barrierids)
-            upgradient.update(node.gradientbarrierids)
-        
-            for outedge in node.outedges:
-                outedge.upbarriers.update(upbarriers)
-                outedge.upgradient.update(upgradient)
-                outedge.stockup.update(stockup)
-                outedge.surveyup.update(surveyup)
-                
-                outedge.visited = True
-                if (not outedge.toNode in toprocess):
-                    toprocess.append(outedge.toNode)
-            
-            
-    #walk up computing mainstem id
-    for edge in edges:
-        edge.visited = False
-        
-    toprocess = deque()
-    for node in nodes.values():
-        if (len(node.outedges) == 0):
-            toprocess.append(node)
+        for inedge in network.inEdges(node):
+            upbarriers |= upbarrieredges[inedge]
+            upgradient |= upgradientedges[inedge]
+            stockup |= stockupedges[inedge] | stockedges[inedge]
+            surveyup |= surveyupedges[inedge] | surveyedges[inedge]
     
-    while (toprocess):
-        node = toprocess.popleft()
+        for outedge in network.outEdges(node):
+            upbarrieredges[outedge] |= upbarriers
+            upgradientedges[outedge] |= upgradient
+            stockupedges[outedge] |= stockup
+            surveyupedges[outedge] |= surveyup
+            
+    #walk up network
+    for node in network.topologicalOrder()[::-1]:
         
-        if (len(node.inedges) == 0):
+        inedges = network.inEdges(node)
+        if (len(inedges) == 0):
             continue
         
-        downbarriers = set()
-        downbarriers.update(node.barrierids)
-
-        downgradient = set()
-        downgradient.update(node.gradientbarrierids)
-        
-        stockdown = set()
-        surveydown = set()
+        downbarriers = barrierids[node]
+        downgradient = gradientbarrierids[node]
         
-        allvisited = True
+        stockdown = 0
+        surveydown = 0
         
-        for outedge in node.outedges:
-            if not inedge.visited:
-                allvisited = False;
-                break;
-            else:
-                downbarriers.update(outedge.downbarriers)
-                downgradient.update(outedge.downgradient)
-                stockdown.update(outedge.stockdown)
-                stockdown.update(outedge.stockedge)
-                surveydown.update(outedge.surveydown)
-                surveydown.update(outedge.surveyedge)
+        for outedge in network.outEdges(node):
+            downbarriers |= downbarrieredges[outedge]
+            downgradient |= downgradientedges[outedge]
+            stockdown |= stockdownedges[outedge] | stockedges[outedge]
+            surveydown |= surveydownedges[outedge] | surveyedges[outedge]
         
-        if not allvisited:
-            toprocess.append(node)
-        else:
-            for inedge in node.inedges:
-                inedge.downbarriers.update(downbarriers)
-                inedge.downgradient.update(downgradient)
-                inedge.stockdown.update(stockdown)                
-                inedge.surveydown.update(surveydown)
-                inedge.visited = True
-                if (not outedge.toNode in toprocess):
-                    toprocess.append(inedge.fromNode)
+        for inedge in inedges:
+            downbarrieredges[inedge] |= downbarriers
+            downgradientedges[inedge] |= downgradient
+            stockdownedges[inedge] |= stockdown
+            surveydownedges[inedge] |= surveydown
     
         
-def writeResults(connection):
+def writeResults(connection, context, network):
       
-    updatequery = f"""
-        UPDATE {dbTargetSchema}.{dbTargetStreamTable} SET 
-            barrier_up_cnt = %s,
-            barrier_down_cnt = %s,
-            barriers_up = %s,
-            barriers_down = %s,
-            gradient_barrier_up_cnt = %s,
-            gradient_barrier_down_cnt = %s,
-            fish_stock_up = %s,
-            fish_stock_down = %s,
-            fish_survey_up = %s,
-            fish_survey_down = %s
-            
-        WHERE id = %s;
-    """
+    fields = ['barrier_up_cnt', 'barrier_down_cnt', 'barriers_up', 'barriers_down',
+        'gradient_barrier_up_cnt', 'gradient_barrier_down_cnt', 
+        'fish_stock_up', 'fish_stock_down', 'fish_survey_up', 'fish_survey_down']
     
     newdata = []
+    attr = network.attributes
     
-    for edge in edges:
-        upbarriersstr = (list(edge.upbarriers),)  
-        downbarriersstr = (list(edge.downbarriers),)
-        upstockstr = (list(edge.stockup),)  
-        downstockstr = (list(edge.stockdown),) 
-        upsurveystr = (list(edge.surveyup),)  
-        downsurveystr = (list(edge.surveydown),) 
-        
-        newdata.append( (len(edge.upbarriers), len(edge.downbarriers), upbarriersstr, downbarriersstr, len(edge.upgradient), len(edge.downgradient), upstockstr, downstockstr, upsurveystr, downsurveystr, edge.fid))
-
+    #bitsets are converted back to ids and species codes here
+    barrierslots = network.barrierslots
+    speciesslots = network.speciesslots
     
-    with connection.cursor() as cursor:    
-        psycopg2.extras.execute_batch(cursor, updatequery, newdata);
+    for edge in range(network.edgecount):
+        upbarriersstr = barrierslots.toList(attr['upbarriers'][edge])
+        downbarriersstr = barrierslots.toList(attr['downbarriers'][edge])
+        upstockstr = speciesslots.toList(attr['stockup'][edge])
+        downstockstr = speciesslots.toList(attr['stockdown'][edge])
+        upsurveystr = speciesslots.toList(attr['surveyup'][edge])
+        downsurveystr = speciesslots.toList(attr['surveydown'][edge])
+        
+        newdata.append( (network.fids[edge], 
+                         len(upbarriersstr), len(downbarriersstr), 
+                         upbarriersstr, downbarriersstr, 
+                         bitCount(attr['upgradient'][edge]), bitCount(attr['downgradient'][edge]), 
+                         upstockstr, downstockstr, upsurveystr, downsurveystr))
+
+    bulk_writer.updateTable(connection, f"{context.targetSchema}.{dbTargetStreamTable}", appconfig.dbIdField, 
+        fields, newdata)
             
     connection.commit()
 
 
-#--- main program ---
-def main():
+def run(context):
     
-    edges.clear()
-    nodes.clear()
-        
-    with appconfig.connectdb() as conn:
+    dbTargetSchema = context.targetSchema
+    
+    with context.connect() as conn:
         
         conn.autocommit = False
         
@@ -469,15 +388,20 @@ def main():
             cursor.execute(query)
         
         print("  creating network")
-        createNetwork(conn)
+        network = createNetwork(conn, context)
         
         print("  processing nodes")
-        processNodes()
+        processNodes(network)
             
         print("  writing results")
-        writeResults(conn)
+        writeResults(conn, context, network)
         
     print("done")
+
+#--- main program ---
+def main():
+    run(stage_context.fromArgs())
     
+
 if __name__ == "__main__":
     main()      
\ No newline at end of file
@@ -25,10 +25,13 @@
 # maximum vertex gradient for the stream segment
 #
 import appconfig
+import shapely
+import shapely.wkb
+import numpy
+import bulk_writer
+import stream_network
+import stage_context
 
-iniSection = appconfig.args.args[0]
-
-dbTargetSchema = appconfig.config[iniSection]['output_schema']
 dbTargetStreamTable = appconfig.config['PROCESSING']['stream_table']
 
 dbMainstemField = appconfig.config['MAINSTEM_PROCESSING']['mainstem_id']
@@ -38,101 +41,241 @@ dbUpMeasureField = appconfig.config['MAINSTEM_PROCESSING']['upstream_route_measu
 db3dGeomField = appconfig.config['ELEVATION_PROCESSING']['smoothedgeometry_field']
 
 dbVertexTable = appconfig.config['GRADIENT_PROCESSING']['vertex_gradient_table']
-dbDownMeasureField = appconfig.config['MAINSTEM_PROCESSING']['downstream_route_measure']
-dbUpMeasureField = appconfig.config['MAINSTEM_PROCESSING']['upstream_route_measure']
 
-db4dGeomField = "geometryzm"
- 
-def setupGeometry(connection):
+#distances (m) upstream along the mainstem used to compute vertex gradients;
+#the first distance is used for the gradient field and all distances are
+#stored (in order) in the gradient profile array field
+upstreamDistances = [float(d) for d in appconfig.config['GRADIENT_PROCESSING'].get('vertex_gradient_distances', '100').split(",")]
+
+#lower bound of each gradient class
+gradeClasses = [float(c) for c in appconfig.config['GRADIENT_PROCESSING'].get('grade_classes', '0.05,0.07,0.10,0.12,0.15,0.20,0.25,0.30').split(",")]
+
+dbGradientProfileField = "gradient_profile"
+
+#tables read and written by this script (see stage_scheduler)
+def stageInputs(context):
+    return [f"{context.targetSchema}.{dbTargetStreamTable}"]
+
+def stageOutputs(context):
+    return [f"{context.targetSchema}.{dbVertexTable}"]
+
+#
+# a mainstem as arrays of the vertices of all its segments ordered 
+# from the mouth up; measure is the distance from the mouth of the mainstem
+#
+class Mainstem:
     
-    # update geometry column    
-    query = f"""
-        alter table {dbTargetSchema}.{dbTargetStreamTable} 
-        add column if not exists {db4dGeomField} geometry(LinestringZM, {appconfig.dataSrid});
+    def __init__(self, mainstemid):
+        self.mainstemid = mainstemid
+        self.downs = []
+        self.ups = []
+        self.coords = []
+    
+    def addSegment(self, down, up, coords):
+        self.downs.append(down)
+        self.ups.append(up)
+        self.coords.append(coords)
+    
+    #
+    # builds the vertex arrays once all segments are added; segments
+    # (and their vertices) are reversed so they go from downstream to 
+    # upstream
+    #
+    def build(self):
+        order = numpy.argsort(self.downs, kind='stable')
+        self.downs = numpy.array(self.downs, dtype=numpy.float64)[order]
+        self.ups = numpy.array(self.ups, dtype=numpy.float64)[order]
+        coords = [self.coords[i][::-1] for i in order]
+        self.coords = None
+        
+        counts = numpy.array([len(c) for c in coords], dtype=numpy.int64)
+        self.ptr = numpy.zeros(len(counts) + 1, dtype=numpy.int64)
+        numpy.cumsum(counts, out=self.ptr[1:])
+        
+        self.segment = numpy.repeat(numpy.arange(len(counts)), counts)
+        self.xyz = numpy.concatenate(coords)
+        
+        #distance of each vertex from the downstream end of its segment
+        self.segmeasure = numpy.zeros(len(self.xyz), dtype=numpy.float64)
+        for i, c in enumerate(coords):
+            steps = numpy.hypot(numpy.diff(c[:, 0]), numpy.diff(c[:, 1]))
+            self.segmeasure[self.ptr[i] + 1:self.ptr[i + 1]] = numpy.cumsum(steps)
         
-        update {dbTargetSchema}.{dbTargetStreamTable} 
-        set {db4dGeomField} = st_addmeasure({db3dGeomField}, st_length({db3dGeomField}), 0) 
+        self.measure = self.downs[self.segment] + self.segmeasure
+        #guards against rounding where segments meet
+        self.searchmeasure = numpy.maximum.accumulate(self.measure)
+        
+        #the downstream end of each segment is not a vertex for the
+        #gradient table (it is the upstream vertex of the next segment)
+        self.isvertex = numpy.ones(len(self.xyz), dtype=bool)
+        self.isvertex[self.ptr[:-1]] = False
+    
+    #
+    # returns the x, y, z at the given measures along the mainstem and 
+    # a mask of the measures that are on the mainstem; values are 
+    # interpolated within the segment that contains the measure 
+    #
+    def locate(self, measures):
+        
+        segment = numpy.searchsorted(self.downs, measures, side='right') - 1
+        valid = segment >= 0
+        segment = numpy.maximum(segment, 0)
+        valid &= measures < self.ups[segment]
+        valid &= (self.ptr[segment + 1] - self.ptr[segment]) > 1
+        
+        upper = numpy.searchsorted(self.searchmeasure, measures, side='right')
+        upper = numpy.clip(upper, self.ptr[segment] + 1, numpy.maximum(self.ptr[segment + 1] - 1, self.ptr[segment] + 1))
+        upper = numpy.minimum(upper, len(self.xyz) - 1)
+        lower = upper - 1
+        
+        local = measures - self.downs[segment]
+        span = self.segmeasure[upper] - self.segmeasure[lower]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            fraction = numpy.where(span > 0, (local - self.segmeasure[lower]) / span, 0)
+        
+        xyz = self.xyz[lower] + (self.xyz[upper] - self.xyz[lower]) * fraction[:, None]
+        return xyz, valid
+    
+    
+def loadMainstems(connection, context):
+    
+    query = f"""
+        SELECT {dbMainstemField}, {dbDownMeasureField}, {dbUpMeasureField}, {db3dGeomField}
+        FROM {context.targetSchema}.{dbTargetStreamTable}
+        WHERE {dbMainstemField} IS NOT NULL
     """
     
-    with connection.cursor() as cursor:
-        cursor.execute(query)    
+    segments = []
+    
+    #rows are streamed from the database in batches instead 
+    #of all being fetched at once
+    for feature in stream_network.readRows(connection, query):
+        geom = shapely.wkb.loads(feature[3], hex=True)
+        segments.append((feature[0], feature[1], feature[2], numpy.array(geom.coords)))
+    
+    return createMainstems(segments)
+
+#
+# creates the mainstems from (mainstem id, downstream measure, upstream 
+# measure, (n,3) smoothed coordinate array) segments
+#
+def createMainstems(segments):
+    
+    mainstems = {}
+    
+    for mainstemid, down, up, coords in segments:
+        if mainstemid not in mainstems:
+            mainstems[mainstemid] = Mainstem(mainstemid)
+        mainstems[mainstemid].addSegment(down, up, coords)
+    
+    for mainstem in mainstems.values():
+        mainstem.build()
+    
+    return mainstems
+
+#
+# computes the gradient at each vertex from the elevation of the vertex
+# and the elevation the first upstream distance upstream along the 
+# mainstem; vertices where the upstream point is not on the mainstem or 
+# either elevation is missing are skipped
+#
+# the gradient profile (one gradient per upstreamDistances) is computed
+# in the same pass; profile gradients that can't be computed are nan
+#
+def computeVertexGradients(mainstems):
+    
+    results = []
+    
+    for mainstem in mainstems.values():
+        vertices = numpy.flatnonzero(mainstem.isvertex)
+        measures = mainstem.measure[vertices]
+        elevationa = mainstem.xyz[vertices, 2]
+        
+        profile = numpy.full((len(vertices), len(upstreamDistances)), numpy.nan)
+        for i, distance in enumerate(upstreamDistances):
+            upxyz, valid = mainstem.locate(measures + distance)
+            valid &= (elevationa != appconfig.NODATA) & (upxyz[:, 2] != appconfig.NODATA)
+            profile[valid, i] = (upxyz[valid, 2] - elevationa[valid]) / distance
             
-    connection.commit()
+            if i == 0:
+                keep = valid
+                elevationb = upxyz[:, 2]
+                uppnts = upxyz
+        
+        results.append((mainstem.mainstemid, measures[keep], elevationa[keep], elevationb[keep], 
+                        profile[keep, 0], mainstem.xyz[vertices[keep]], uppnts[keep], profile[keep]))
+    
+    return results
 
-def computeVertexGradients(connection):
+def gradeClass(gradient):
+    classes = numpy.array([0] + [int(round(c * 100)) for c in gradeClasses])
+    return classes[numpy.digitize(gradient, gradeClasses)]
+    
+def toWkb(xyz):
+    points = shapely.set_srid(shapely.points(xyz), int(appconfig.dataSrid))
+    return shapely.to_wkb(points, include_srid=True)
 
+def writeResults(connection, context, results):
+    
+    dbTargetSchema = context.targetSchema
+    
     query = f"""
         DROP TABLE IF EXISTS {dbTargetSchema}.{dbVertexTable};
-         
-        CREATE TABLE {dbTargetSchema}.{dbVertexTable} AS 
-        SELECT
-            sv.{dbMainstemField},
-            sv.{dbDownMeasureField} as downstream_route_measure,
-            sv.elevation as elevation_a,
-            st_z((st_dump(ST_LocateAlong(s2.{db4dGeomField}, (sv.{dbDownMeasureField} + 100) - s2.{dbDownMeasureField} ))).geom) as elevation_b,
-            (st_z((st_dump(ST_LocateAlong(s2.{db4dGeomField}, (sv.{dbDownMeasureField} + 100) - s2.{dbDownMeasureField} ))).geom) - sv.elevation) / 100 as gradient,
-            sv.pnt as vertex_pnt,
-            ST_LocateAlong(s2.{db4dGeomField}, (sv.{dbDownMeasureField} + 100) - s2.{dbDownMeasureField} ) as upstream_pnt    
-        FROM (
-           SELECT
-            s.{dbMainstemField},
-            (((1.0 - ST_LineLocatePoint(s.{db4dGeomField}, ST_PointN(s.{db4dGeomField}, generate_series(1, ST_NPoints(s.{db4dGeomField}) - 1)))) * st_length(s.{db4dGeomField})) + s.downstream_route_measure) as downstream_route_measure,
-            ST_Z(ST_PointN(s.{db4dGeomField}, generate_series(1, ST_NPoints(s.{db4dGeomField}) - 1))) AS elevation,
-            ST_PointN(s.{db4dGeomField}, generate_series(1, ST_NPoints(s.{db4dGeomField}) - 1)) as pnt
-            FROM {dbTargetSchema}.{dbTargetStreamTable} s
-            ORDER BY {dbMainstemField}, {dbDownMeasureField}
-        ) as sv
-        INNER JOIN {dbTargetSchema}.{dbTargetStreamTable} s2 ON sv.{dbMainstemField} = s2.{dbMainstemField} 
-          AND sv.{dbDownMeasureField} + 100 >= s2.{dbDownMeasureField} 
-          AND sv.{dbDownMeasureField} + 100 < s2.{dbUpMeasureField};
-          
-
-        DELETE FROM {dbTargetSchema}.{dbVertexTable} WHERE elevation_a = -999999 or elevation_b = -999999;
-        
-        ALTER TABLE {dbTargetSchema}.{dbVertexTable} ADD COLUMN grade_class smallint;
-        
-        UPDATE {dbTargetSchema}.{dbVertexTable} set grade_class = 
-          CASE
-              WHEN gradient >= .05 AND gradient < .07 THEN 5
-              WHEN gradient >= .07 AND gradient < .10 THEN 7
-              WHEN gradient >= .10 AND gradient < .12 THEN 10
-              WHEN gradient >= .12 AND gradient < .15 THEN 12
-              WHEN gradient >= .15 AND gradient < .20 THEN 15
-              WHEN gradient >= .20 AND gradient < .25 THEN 20
-              WHEN gradient >= .25 AND gradient < .30 THEN 25
-              WHEN gradient >= .30 THEN 30
-              ELSE 0
-        END;
-
-        
-        alter table {dbTargetSchema}.{dbTargetStreamTable} 
-        drop column {db4dGeomField};
+        
+        CREATE TABLE {dbTargetSchema}.{dbVertexTable} (
+            {dbMainstemField} uuid,
+            downstream_route_measure double precision,
+            elevation_a double precision,
+            elevation_b double precision,
+            gradient double precision,
+            vertex_pnt geometry(PointZ, {appconfig.dataSrid}),
+            upstream_pnt geometry(PointZ, {appconfig.dataSrid}),
+            grade_class smallint,
+            {dbGradientProfileField} double precision[]
+        );
+        
+        COMMENT ON COLUMN {dbTargetSchema}.{dbVertexTable}.{dbGradientProfileField} 
+        IS 'vertex gradients for upstream distances (m): {", ".join([str(d) for d in upstreamDistances])}';
     """
-    
-    #print (query)
     with connection.cursor() as cursor:
-        cursor.execute(query)    
-            
+        cursor.execute(query)
+    
+    def rows():
+        for mainstemid, measures, elevationa, elevationb, gradient, vertexpnts, uppnts, profile in results:
+            profile = [[None if numpy.isnan(g) else g for g in p] for p in profile.tolist()]
+            columns = zip(measures.tolist(), elevationa.tolist(), elevationb.tolist(), 
+                gradient.tolist(), toWkb(vertexpnts), toWkb(uppnts), gradeClass(gradient).tolist(), profile)
+            for column in columns:
+                yield (mainstemid,) + column
+    
+    bulk_writer.copyRows(connection, f"{dbTargetSchema}.{dbVertexTable}", 
+        [dbMainstemField, "downstream_route_measure", "elevation_a", "elevation_b", 
+         "gradient", "vertex_pnt", "upstream_pnt", "grade_class", dbGradientProfileField], rows())
+    
     connection.commit()
 
 
-
-
-def main():
-    #--- main program ---    
-    with appconfig.connectdb() as conn:
+def run(context):
+    with context.connect() as conn:
         
         conn.autocommit = False
         
         print("Computing Gradient")
-        print("  setting up tables")
-        setupGeometry(conn)
+        print("  loading mainstems")
+        mainstems = loadMainstems(conn, context)
         
         print("  computing vertex gradients")
-        computeVertexGradients(conn)
+        results = computeVertexGradients(mainstems)
         
+        print("  writing results")
+        writeResults(conn, context, results)
         
     print("done")
 
+def main():
+    #--- main program ---    
+    run(stage_context.fromArgs())
+
+
 if __name__ == "__main__":
     main() 
@@ -0,0 +1,117 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+#
+# Read access to single band DEM GeoTIFF files that only reads the parts
+# of the file required instead of loading the entire raster into memory.
+#
+# Uncompressed files are memory mapped. Tiled and stripped (compressed)
+# files are read one block (tile or strip) at a time and only the blocks
+# that contain requested cells are read and decoded. Blocks that are not
+# stored in the file (sparse files) contain only nodata cells.
+#
+import appconfig
+import numpy
+import tifffile as tif
+
+class DemRaster:
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.tif = tif.TiffFile(filename)
+        self.page = self.tif.pages[0]
+
+        if (self.page.samplesperpixel != 1):
+            self.close()
+            raise ValueError("DEM file " + filename + " must contain a single band")
+
+        self.memmap = None
+        if self.page.is_memmappable:
+            self.memmap = tif.memmap(filename, mode='r')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.memmap = None
+        self.tif.close()
+
+    #
+    # returns the values for the given cells (row and column index arrays)
+    # as float64 array
+    #
+    def readCells(self, rows, cols):
+        rows = numpy.asarray(rows, dtype=numpy.int64)
+        cols = numpy.asarray(cols, dtype=numpy.int64)
+
+        if self.memmap is not None:
+            return numpy.asarray(self.memmap[rows, cols], dtype=numpy.float64)
+
+        values = numpy.empty(len(rows), dtype=numpy.float64)
+        if len(rows) == 0:
+            return values
+
+        page = self.page
+        if page.is_tiled:
+            blockheight = page.tilelength
+            blockwidth = page.tilewidth
+        else:
+            blockheight = page.rowsperstrip
+            blockwidth = page.imagewidth
+        blocksacross = -(-page.imagewidth // blockwidth)
+
+        blocks = (rows // blockheight) * blocksacross + (cols // blockwidth)
+
+        #group the cells by block so each block is only decoded once
+        order = numpy.argsort(blocks, kind='stable')
+        blockids, starts = numpy.unique(blocks[order], return_index=True)
+        ends = numpy.append(starts[1:], len(order))
+
+        for blockid, start, end in zip(blockids, starts, ends):
+            data, rowoffset, coloffset = self.readBlock(int(blockid))
+            cells = order[start:end]
+            values[cells] = data[rows[cells] - rowoffset, cols[cells] - coloffset]
+
+        return values
+
+    #
+    # reads and decodes a single tile or strip returning the data
+    # and the row/column of the upper left cell of the block; empty
+    # blocks are filled with the nodata value of the file (NODATA if the
+    # file has none)
+    #
+    def readBlock(self, blockid):
+        page = self.page
+        fh = self.tif.filehandle
+
+        raw = None
+        if page.databytecounts[blockid] > 0:
+            fh.seek(page.dataoffsets[blockid])
+            raw = fh.read(page.databytecounts[blockid])
+
+        segment, indices, shape = page.decode(raw, blockid, jpegtables=page.jpegtables)
+        if segment is None:
+            nodata = page.nodata if "GDAL_NODATA" in page.tags else appconfig.NODATA
+            data = numpy.full((shape[-3], shape[-2]), nodata, dtype=numpy.float64)
+        else:
+            data = segment.reshape(segment.shape[-3], segment.shape[-2])
+        return data, indices[-3], indices[-2]
+
@@ -22,19 +22,26 @@
 import json
 import urllib.request
 import appconfig
+import stage_context
 
-iniSection = appconfig.args.args[0]
-
-dbTargetSchema = appconfig.config[iniSection]['output_schema']
 dbTargetStreamTable = appconfig.config['PROCESSING']['stream_table']
-workingWatershedId = appconfig.config[iniSection]['watershed_id']
-nhnWatershedId = appconfig.config[iniSection]['nhn_watershed_id']
 
 dbBarrierTable = appconfig.config['BARRIER_PROCESSING']['barrier_table']
 snapDistance = appconfig.config['CABD_DATABASE']['snap_distance']
 
-def tableExists(conn):
+#tables read and written by this script (see stage_scheduler)
+def stageInputs(context):
+    return [f"{context.targetSchema}.{dbTargetStreamTable}"]
+
+def stageOutputs(context):
+    return [f"{context.targetSchema}.{dbBarrierTable}",
+            f"{context.targetSchema}.{dbBarrierTable}_archive",
+            f"{context.targetSchema}.snap_barriers_to_network"]
 
+def tableExists(conn, context):
+
+    dbTargetSchema = context.targetSchema
+    
     query = f"""
     SELECT EXISTS(SELECT 1 FROM information_schema.tables 
     WHERE table_catalog='{appconfig.dbName}' AND 
@@ -49,9 +56,11 @@ def tableExists(conn):
 
     return result
 
-def createTable(conn):
+def createTable(conn, context):
 
-    result = tableExists(conn)
+    dbTargetSchema = context.targetSchema
+    
+    result = tableExists(conn, context)
 
     if result:
 
@@ -190,8 +199,11 @@ def createTable(conn):
             cursor.execute(query)
         conn.commit()
 
-def getCABD(conn):
+def getCABD(conn, context):
 
+    dbTargetSchema = context.targetSchema
+    nhnWatershedId = context.watershed['nhn_watershed_id']
+    
     # retrieve barrier data from CABD API
     url = f"https://cabd-web.azurewebsites.net/cabd-api/features/dams?&filter=nhn_watershed_id:eq:{nhnWatershedId}&filter=use_analysis:eq:true"
     response = urllib.request.urlopen(url)
@@ -231,7 +243,7 @@ def getCABD(conn):
                     
     # snaps barrier features to network
     query = f"""
-        CREATE OR REPLACE FUNCTION public.snap_to_network(src_schema varchar, src_table varchar, raw_geom varchar, snapped_geom varchar, max_distance_m double precision) RETURNS VOID AS $$
+        CREATE OR REPLACE FUNCTION {dbTargetSchema}.snap_barriers_to_network(src_schema varchar, src_table varchar, raw_geom varchar, snapped_geom varchar, max_distance_m double precision) RETURNS VOID AS $$
         DECLARE    
             pnt_rec RECORD;
             fp_rec RECORD;
@@ -247,7 +259,7 @@ def getCABD(conn):
         END;
         $$ LANGUAGE plpgsql;
         
-        SELECT public.snap_to_network('{dbTargetSchema}', '{dbBarrierTable}', 'original_point', 'snapped_point', '{snapDistance}');
+        SELECT {dbTargetSchema}.snap_barriers_to_network('{dbTargetSchema}', '{dbBarrierTable}', 'original_point', 'snapped_point', '{snapDistance}');
 
         --remove any dam features not snapped to streams
         --because using nhn_watershed_id can cover multiple HUC8 watersheds
@@ -261,26 +273,22 @@ def getCABD(conn):
 
     print("Loading Barriers from CABD dataset complete")
 
-def main():
+def run(context):
 
-    with appconfig.connectdb() as conn:
+    with context.connect() as conn:
 
         print("Loading barrier data")
 
-        query = f"""
-        SELECT code
-        FROM {appconfig.dataSchema}.{appconfig.fishSpeciesTable};
-        """
-
-        with conn.cursor() as cursor:
-            cursor.execute(query)
-            specCodes = cursor.fetchall()
-
         print("  creating tables")
-        createTable(conn)
+
+        createTable(conn, context)
 
         print("  fetching barriers from CABD")
-        getCABD(conn)
+        getCABD(conn, context)
+
+def main():
+    run(stage_context.fromArgs())
+
 
 if __name__ == "__main__":
     main()
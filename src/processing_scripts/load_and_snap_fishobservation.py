@@ -25,10 +25,7 @@ import subprocess
 import appconfig
 import zipfile
 import tempfile
-
-iniSection = appconfig.args.args[0]
-dbTargetSchema = appconfig.config[iniSection]['output_schema']
-rawData = appconfig.config[iniSection]['fish_observation_data'];
+import stage_context
 
 dbTargetStreamTable = appconfig.config['PROCESSING']['stream_table']
 
@@ -38,14 +35,33 @@ fishSurveyFile = "FishSurvey.shp"
 
 snapDistance = appconfig.config['CABD_DATABASE']['snap_distance']
 
+#tables read and written by this script (see stage_scheduler)
+def stageInputs(context):
+    return [f"{context.targetSchema}.{dbTargetStreamTable}"]
+
+def stageOutputs(context):
+    return [f"{context.targetSchema}.{appconfig.config['DATABASE']['aquatic_habitat_table']}",
+            f"{context.targetSchema}.{appconfig.config['DATABASE']['fish_stocking_table']}",
+            f"{context.targetSchema}.{appconfig.config['DATABASE']['fish_survey_table']}",
+            f"{context.targetSchema}.snap_observations_to_network"]
+
+#files read by this script (see stage_checkpoint)
+def stageFiles(context):
+    return [context.watershed['fish_observation_data']]
+
+
 #unzip data to temp location
-def main():
+def run(context):
+    
+    dbTargetSchema = context.targetSchema
+    rawData = context.watershed['fish_observation_data']
+    
     with tempfile.TemporaryDirectory() as workingdir:
         with zipfile.ZipFile(rawData, "r") as zipref:
             zipref.extractall(workingdir)
     
     
-        with appconfig.connectdb() as conn:
+        with context.connect() as conn:
         
             orgDb="dbname='" + appconfig.dbName + "' host='"+ appconfig.dbHost+"' port='"+appconfig.dbPort+"' user='"+appconfig.dbUser+"' password='"+ appconfig.dbPassword+"'"
         
@@ -74,7 +90,7 @@ def main():
                 #snap to flowpath
                 
                 query = f"""
-                    CREATE OR REPLACE FUNCTION public.snap_to_network(src_schema varchar, src_table varchar, raw_geom varchar, snapped_geom varchar, max_distance_m double precision) RETURNS VOID AS $$
+                    CREATE OR REPLACE FUNCTION {dbTargetSchema}.snap_observations_to_network(src_schema varchar, src_table varchar, raw_geom varchar, snapped_geom varchar, max_distance_m double precision) RETURNS VOID AS $$
                     DECLARE    
                       pnt_rec RECORD;
                       fp_rec RECORD;
@@ -95,7 +111,7 @@ def main():
                     
                     ALTER TABLE {dataschema}.{datatablename} add column snapped_point geometry(POINT, {appconfig.dataSrid});
                     
-                    SELECT public.snap_to_network('{dataschema}', '{datatablename}', 'geometry', 'snapped_point', '{snapDistance}');
+                    SELECT {dbTargetSchema}.snap_observations_to_network('{dataschema}', '{datatablename}', 'geometry', 'snapped_point', '{snapDistance}');
                     
                     ALTER TABLE {dataschema}.{datatablename} add column stream_id uuid;
                     ALTER TABLE {dataschema}.{datatablename} add column stream_measure numeric;
@@ -114,6 +130,10 @@ def main():
                     cursor.execute(query)
                 conn.commit();
     print("Loading Fish Observation datasets complete")
+
+def main():
+    run(stage_context.fromArgs())
     
 if __name__ == "__main__":
+
     main()     
\ No newline at end of file
@@ -28,14 +28,10 @@
 
 import subprocess
 import appconfig
+import stage_context
 
-iniSection = appconfig.args.args[0]
-dbTargetSchema = appconfig.config[iniSection]['output_schema']
-dbWatershedId = appconfig.config[iniSection]['watershed_id']
-rawData = appconfig.config[iniSection]['assessment_data']
 dataSchema = appconfig.config['DATABASE']['data_schema']
 
-dbTempTable = 'assessment_data_' + dbWatershedId
 dbTargetTable = appconfig.config['CROSSINGS']['assessed_crossings_table']
 dbModelledCrossingsTable = appconfig.config['CROSSINGS']['modelled_crossings_table']
 dbCrossingsTable = appconfig.config['CROSSINGS']['crossings_table']
@@ -44,8 +40,31 @@ dbBarrierTable = appconfig.config['BARRIER_PROCESSING']['barrier_table']
 dbHuc8Table = appconfig.config['CREATE_LOAD_SCRIPT']['huc8_table']
 joinDistance = appconfig.config['CROSSINGS']['join_distance']
 
-def loadAssessmentData(connection):
+#tables read and written by this script (see stage_scheduler)
+def stageInputs(context):
+    return [f"{context.targetSchema}.{dbModelledCrossingsTable}", f"{dataSchema}.{dbHuc8Table}"]
 
+def stageOutputs(context):
+    return [f"{context.targetSchema}.{dbTargetTable}",
+            f"{context.targetSchema}.{dbCrossingsTable}",
+            f"{context.targetSchema}.{dbBarrierTable}",
+            f"{dataSchema}.{tempTable(context)}"]
+
+#files read by this script (see stage_checkpoint)
+def stageFiles(context):
+    return [context.watershed['assessment_data']]
+
+
+#table the raw assessment data is loaded into
+def tempTable(context):
+    return 'assessment_data_' + context.watershedId
+
+def loadAssessmentData(connection, context):
+
+    dbTargetSchema = context.targetSchema
+    dbTempTable = tempTable(context)
+    rawData = context.watershed['assessment_data']
+    
     # create assessed crossings table
     query = f"""
         DROP TABLE IF EXISTS {dataSchema}.{dbTempTable};
@@ -128,8 +147,10 @@ def loadAssessmentData(connection):
         cursor.execute(query)
     connection.commit()
 
-def joinAssessmentData(connection):
+def joinAssessmentData(connection, context):
 
+    dbTargetSchema = context.targetSchema
+    
     query = f"""
         DROP TABLE IF EXISTS {dbTargetSchema}.{dbCrossingsTable};
 
@@ -226,8 +247,11 @@ def joinAssessmentData(connection):
         cursor.execute(query)
     connection.commit()
 
-def loadToBarriers(connection):
+def loadToBarriers(connection, context):
 
+    dbTargetSchema = context.targetSchema
+    dbWatershedId = context.watershedId
+    
     query = f"""
         DELETE FROM {dbTargetSchema}.{dbBarrierTable} WHERE type = 'stream_crossing';
         
@@ -265,25 +289,29 @@ def loadToBarriers(connection):
         cursor.execute(query)
     connection.commit()
 
-#--- main program ---
-def main():
+def run(context):
 
-    with appconfig.connectdb() as conn:
+    with context.connect() as conn:
 
         conn.autocommit = False
 
         print("Loading Assessment Data for Stream Crossings")
 
         print("  loading assessment data")
-        loadAssessmentData(conn)
+        loadAssessmentData(conn, context)
 
         print("  joining assessment points to modelled points")
-        joinAssessmentData(conn)
+        joinAssessmentData(conn, context)
 
         print("  adding joined points to crossings and barriers tables")
-        loadToBarriers(conn)
+        loadToBarriers(conn, context)
 
     print("done")
 
+#--- main program ---
+def main():
+    run(stage_context.fromArgs())
+
+
 if __name__ == "__main__":
     main()
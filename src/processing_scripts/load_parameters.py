@@ -23,12 +23,27 @@
 
 import subprocess
 import appconfig
+import stage_context
 
 dataFile = appconfig.config['DATABASE']['fish_parameters']
 sourceTable = appconfig.dataSchema + ".fish_species_raw"
 
-def main():
-    with appconfig.connectdb() as conn:
+#tables read and written by this script (see stage_scheduler)
+def stageInputs(context):
+    return []
+
+def stageOutputs(context):
+    return [f"{appconfig.dataSchema}.{appconfig.fishSpeciesTable}", sourceTable]
+
+#files read by this script (see stage_checkpoint)
+def stageFiles(context):
+    return [dataFile]
+
+
+#the species parameters are shared by all watersheds; the context
+#only provides the connection
+def run(context):
+    with context.connect() as conn:
 
         query = f"""
             DROP TABLE IF EXISTS {sourceTable};
@@ -131,5 +146,9 @@ def main():
 
     print (f"""Species parameters loaded to {appconfig.dataSchema}.{appconfig.fishSpeciesTable}""")
 
+def main():
+    run(stage_context.fromArgs())
+
 if __name__ == "__main__":
+
     main()
@@ -20,14 +20,30 @@
 # ASSUMPTION - data is in equal area projection where distance functions return values in metres
 #
 import appconfig
+import stage_context
+import stage_checkpoint
+
 
-iniSection = appconfig.args.args[0]
-dbTargetSchema = appconfig.config[iniSection]['output_schema']
-workingWatershedId = appconfig.config[iniSection]['watershed_id']
 dbTargetStreamTable = appconfig.config['PROCESSING']['stream_table']
 
-def main():
-    with appconfig.connectdb() as conn:
+#tables read and written by this script (see stage_scheduler)
+def stageInputs(context):
+    return [f"{appconfig.dataSchema}.{appconfig.streamTable}"]
+
+def stageOutputs(context):
+    return [f"{context.targetSchema}.{dbTargetStreamTable}"]
+
+#only the streams of the watershed are read (see stage_checkpoint)
+def stageQueries(context):
+    table = f"{appconfig.dataSchema}.{appconfig.streamTable}"
+    return {table: stage_checkpoint.checksumQuery(table, f"{appconfig.dbWatershedIdField} = '{context.watershedId}'")}
+
+def run(context):
+    
+    dbTargetSchema = context.targetSchema
+    workingWatershedId = context.watershedId
+    
+    with context.connect() as conn:
         
         query = f"""
             CREATE SCHEMA IF NOT EXISTS {dbTargetSchema};
@@ -85,5 +101,8 @@ def main():
         
     print(f"""Initializing processing for watershed {workingWatershedId} complete.""")
 
+def main():
+    run(stage_context.fromArgs())
+
 if __name__ == "__main__":
     main()     
\ No newline at end of file
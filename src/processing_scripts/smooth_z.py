@@ -20,245 +20,175 @@
 # Smooths raw elevation values to ensure hydro network flows downhill
 #
 import appconfig
+import shapely
 import shapely.wkb
-import shapely.geometry
-import psycopg2.extras
-from collections import deque
+import numpy
+import bulk_writer
+import stream_network
+import stage_context
 
-iniSection = appconfig.args.args[0]
-dbTargetSchema = appconfig.config[iniSection]['output_schema']
 dbTargetTable = appconfig.config['PROCESSING']['stream_table']
 
 dbSourceGeom = appconfig.config['ELEVATION_PROCESSING']['3dgeometry_field']
 dbTargetGeom = appconfig.config['ELEVATION_PROCESSING']['smoothedgeometry_field']
-    
-edges = []
-nodes = dict()
 
-class Node:
-    
-    def __init__(self, x, y):
-        self.inedges = []
-        self.outedges = []
-        self.x = x
-        self.y = y
-        self.z = appconfig.NODATA
-        self.minvalue = self.z
-        self.maxvalue = self.z
-        
+#tables read and written by this script (see stage_scheduler)
+def stageInputs(context):
+    return [f"{context.targetSchema}.{dbTargetTable}"]
 
-    def addInEdge(self, edge):
-        self.inedges.append(edge)
-        self.addZ(edge.ls.coords[len(edge.ls.coords) - 1][2])
-
-    def addOutEdge(self, edge):
-        self.outedges.append(edge)
-        self.addZ(edge.ls.coords[0][2])
-    
-    def addZ(self, z):
-        if (self.z == appconfig.NODATA or self.z == z):
-            self.z = z
-        else:
-            print("DIFFERENT Z VALUES AT SAME POSITION: POINT(" + str(self.x) + " " + str(self.y) + "): " +str(self.x) + " " +str(z))
-    
-class Edge:
-    def __init__(self, fromnode, tonode, fid, ls):
-        self.fromNode = fromnode
-        self.toNode = tonode
-        self.ls = ls
-        self.fid = fid
-        self.visited = False
-        self.newz = [appconfig.NODATA for i in range(len(ls.coords))]
+def stageOutputs(context):
+    return [f"{context.targetSchema}.{dbTargetTable}"]
         
-def createNetwork(connection):
+def createNetwork(connection, context):
     query = f"""
         SELECT {appconfig.dbIdField}, {dbSourceGeom}
-        FROM {dbTargetSchema}.{dbTargetTable}
+        FROM {context.targetSchema}.{dbTargetTable}
     """
    
-    #load geometries and create a network
-    with connection.cursor() as cursor:
-        cursor.execute(query)
-        features = cursor.fetchall()
-        
-        
-        for feature in features:
-            geom = shapely.wkb.loads(feature[1] , hex=True)
-            fid = feature[0]
-            
-            startc = geom.coords[0]
-            endc = geom.coords[len(geom.coords)-1]
-            
-            startt = (startc[0], startc[1])
-            endt = (endc[0], endc[1])            
-            
-            if (startt in nodes.keys()):
-                fromNode = nodes[startt]
-            else:
-                #create new node
-                fromNode = Node(startc[0], startc[1])
-                nodes[startt] = fromNode
-            
-            if (endt in nodes.keys()):
-                toNode = nodes[endt]
-            else:
-                #create new node
-                toNode = Node(endc[0], endc[1])
-                nodes[endt] = toNode
-            
-            edge = Edge(fromNode, toNode, fid, geom)
-            edges.append(edge)
-            
-            fromNode.addOutEdge(edge)
-            toNode.addInEdge(edge)            
+    fids = []
+    coords = []
+    
+    #load geometries and create a network; rows are streamed from the
+    #database in batches instead of all being fetched at once
+    for feature in stream_network.readRows(connection, query):
+        geom = shapely.wkb.loads(feature[1] , hex=True)
+        fids.append(feature[0])
+        coords.append(numpy.array(geom.coords))
+    
+    return buildNetwork(fids, coords)
 
-def processNodes():
+#
+# creates the network from (n,3) coordinate arrays of the edges 
+# (the raw elevations)
+#
+def buildNetwork(fids, coords):
     
-    #walk up network
-    for edge in edges:
-        edge.visited = False
-        
-    toprocess = deque()
-    for node in nodes.values():
-        if (len(node.outedges) == 0):
-            toprocess.append(node)
-            node.maxvalue = node.z
+    startcoords = [c[0, 0:2] for c in coords]
+    endcoords = [c[-1, 0:2] for c in coords]
     
-    while (toprocess):
-        node = toprocess.popleft()
-        
-        allvisited = True
-        for outedge in node.outedges:
-            if not outedge.visited:
-                allvisited = False;
-                break;
-        if not allvisited:
-            toprocess.append(node)
-        else:
-            #visit this node
-            for inedge in node.inedges:
-                inedge.fromNode.maxvalue = max(node.maxvalue, inedge.fromNode.z)
-                inedge.visited = True
-                toprocess.append(inedge.fromNode)
+    network = stream_network.StreamNetwork(fids, startcoords, endcoords)
+    network.attributes['coords'] = coords
     
-    #walk down network        
-    toprocess = deque()
-    for edge in edges:
-        edge.visited = False
-        
-    for node in nodes.values():
-        node.minvalue = node.z
-        if (len(node.inedges) == 0):
-            toprocess.append(node)
-     
-    while (toprocess):
-        node = toprocess.popleft()
-        
-        allvisited = True
-        for inedge in node.inedges:
-            if not inedge.visited:
-                allvisited = False;
-                break;
-        if not allvisited:
-            toprocess.append(node)
-        else:
-            #visit this node
-            for outedge in node.outedges:
-                if (node.minvalue == appconfig.NODATA):
-                    outedge.toNode.minvalue = outedge.toNode.minvalue 
-                elif (outedge.toNode.minvalue == appconfig.NODATA):
-                    outedge.toNode.minvalue = node.minvalue
-                else: 
-                    outedge.toNode.minvalue = min(node.minvalue, outedge.toNode.minvalue)
-                                   
-                outedge.visited = True
-                
-                if (outedge.toNode in toprocess):
-                    toprocess.remove(outedge.toNode)
-                toprocess.append(outedge.toNode)     
+    #node elevation taken from the edge end points
+    nodez = numpy.full(network.nodecount, appconfig.NODATA, dtype=numpy.float64)
+    for edge in range(network.edgecount):
+        addZ(network, nodez, network.fromnode[edge], coords[edge][0][2])
+        addZ(network, nodez, network.tonode[edge], coords[edge][-1][2])
+    network.nodeattributes['z'] = nodez
+    
+    return network
+
+def addZ(network, nodez, node, z):
+    if (nodez[node] == appconfig.NODATA or nodez[node] == z):
+        nodez[node] = z
+    else:
+        x = network.nodex[node]
+        y = network.nodey[node]
+        print("DIFFERENT Z VALUES AT SAME POSITION: POINT(" + str(x) + " " + str(y) + "): " +str(x) + " " +str(z))
+
+def processNodes(network):
+    
+    fromnode = network.fromnode
+    tonode = network.tonode
+    nodez = network.nodeattributes['z']
+    
+    #walk up network; max value is the maximum of the node elevation 
+    #and the downstream node max value (NODATA is smaller than any elevation)
+    maxvalue = numpy.full(network.nodecount, appconfig.NODATA, dtype=numpy.float64)
+    sinks = network.sinks()
+    maxvalue[sinks] = nodez[sinks]
+    
+    for edges in reversed(network.edgeLevels()):
+        upnodes = fromnode[edges]
+        maxvalue[upnodes] = numpy.maximum(maxvalue[tonode[edges]], nodez[upnodes])
+    
+    #walk down network; min value is the minimum of the node elevation
+    #and the upstream node min values ignoring NODATA
+    minvalue = numpy.where(nodez == appconfig.NODATA, numpy.inf, nodez)
+    
+    for edges in network.edgeLevels():
+        numpy.minimum.at(minvalue, tonode[edges], minvalue[fromnode[edges]])
+    
+    minvalue[numpy.isinf(minvalue)] = appconfig.NODATA
     
     #update z values 
-    for node in nodes.values():
-        if (node.maxvalue == appconfig.NODATA or node.minvalue == appconfig.NODATA):
-            node.z = appconfig.NODATA
-        else:
-            node.z = (node.maxvalue + node.minvalue) / 2.0
-        
-    for edge in edges:
-        edge.newz[0] = edge.fromNode.z
-        edge.newz[len(edge.ls.coords)-1] = edge.toNode.z
+    nodata = (maxvalue == appconfig.NODATA) | (minvalue == appconfig.NODATA)
+    smoothz = numpy.where(nodata, appconfig.NODATA, (maxvalue + minvalue) / 2.0)
+    
+    newz = []
+    for edge in range(network.edgecount):
+        z = numpy.full(len(network.attributes['coords'][edge]), appconfig.NODATA, dtype=numpy.float64)
+        z[0] = smoothz[fromnode[edge]]
+        z[-1] = smoothz[tonode[edge]]
+        newz.append(z)
+    network.attributes['newz'] = newz
 
 
-def processEdges():   
+#
+# smooths the vertices between the edge end points; the running minimum
+# (walking down the edge) and running maximum (walking up the edge) of 
+# the vertex elevations are clipped to the end point elevations and the 
+# new elevation is the average of the two
+#
+def processEdges(network):   
     
-    for edge in edges:             
-        ls = edge.ls
+    for edge in range(network.edgecount):             
+        z = network.attributes['coords'][edge][:, 2]
+        newz = network.attributes['newz'][edge]
         
-        size = len(ls.coords)
+        absmax = newz[0]
+        absmin = newz[-1]
         
-        minvalues = [appconfig.NODATA] * size
-        maxvalues = [appconfig.NODATA] * size
+        minvalues = numpy.minimum.accumulate(numpy.concatenate(([newz[0]], numpy.maximum(z[1:], absmin))))
+        maxvalues = numpy.maximum.accumulate(numpy.concatenate(([newz[-1]], numpy.minimum(z[-2::-1], absmax))))[::-1]
         
-        absmax = edge.newz[0]
-        absmin = edge.newz[size - 1]
+        nodata = (minvalues == appconfig.NODATA) | (maxvalues == appconfig.NODATA)
+        newz[:] = numpy.where(nodata, appconfig.NODATA, (minvalues + maxvalues) / 2.0)
         
-        minvalues [0] = edge.newz[0]
-        maxvalues [size - 1] = edge.newz[size - 1]
         
-        
-        for i in range(1, size):
-            temp = ls.coords[i][2]
-            if (temp < absmin):
-                temp = absmin
-            minv = min(temp, minvalues[i-1])
-            minvalues[i] = minv
-            
-            temp = ls.coords[size - 1 - i][2]
-            if (temp > absmax):
-                temp = absmax
-            maxv = max(temp, maxvalues[size - i])
-            maxvalues [size - 1 - i ] = maxv
-        
-        for i in range(0, size):
-            if minvalues[i] == appconfig.NODATA or maxvalues[i] == appconfig.NODATA:
-                edge.newz[i] = appconfig.NODATA
-            else:
-                edge.newz[i] = ((minvalues[i] + maxvalues[i]) / 2.0)
-        
-        
-def writeResults(connection):
+def writeResults(connection, context, network):
     
-    updatequery = f"""
-        UPDATE {dbTargetSchema}.{dbTargetTable} 
-        set {dbTargetGeom} = st_setsrid(st_geomfromwkb(%s),{appconfig.dataSrid})
-        WHERE  {appconfig.dbIdField} = %s
-    """
+    newdata = zip(network.fids, toWkb(network.attributes['coords'], network.attributes['newz']))
     
-    newdata = []
-    
-    for edge in edges:
-        newpnts = [];
-        for i in range(0, len(edge.ls.coords)):
-            x = edge.ls.coords[i][0]
-            y = edge.ls.coords[i][1]
-            z = edge.newz[i]
-            newpnts.append((x,y,z))
-        ls = shapely.geometry.LineString(newpnts)
-        newdata.append( (shapely.wkb.dumps(ls), edge.fid))
-    
-    with connection.cursor() as cursor:    
-        psycopg2.extras.execute_batch(cursor, updatequery, newdata);
+    bulk_writer.updateTable(connection, f"{context.targetSchema}.{dbTargetTable}", 
+        appconfig.dbIdField, [dbTargetGeom], newdata)
             
     connection.commit()
     
 
-#--- main program ---    
-def main():
+#
+# returns the ewkb of the linestrings with the x,y values of the coordinate 
+# arrays and the given z values; all lines are built and converted at once
+#
+def toWkb(coords, zvalues):
+    counts = [len(c) for c in coords]
+    newpnts = numpy.column_stack((numpy.concatenate(coords)[:, 0:2], numpy.concatenate(zvalues)))
+    lines = shapely.linestrings(newpnts, indices=numpy.repeat(numpy.arange(len(coords)), counts))
+    lines = shapely.set_srid(lines, int(appconfig.dataSrid))
+    return shapely.to_wkb(lines, include_srid=True)
+
+
+def createIndex(connection, context):
+    
+    dbTargetSchema = context.targetSchema
+    
+    # replace index on geometry field
+    query = f"""
+        DROP INDEX IF EXISTS {dbTargetSchema}.{dbTargetSchema}_{dbTargetTable}_geometry_idx;
+        CREATE INDEX IF NOT EXISTS {dbTargetSchema}_{dbTargetTable}_geometry_idx
+            ON {dbTargetSchema}.{dbTargetTable} USING gist
+            ({dbTargetGeom});
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+    connection.commit()
     
-    edges.clear()
-    nodes.clear()
 
-    with appconfig.connectdb() as conn:
+def run(context):
+    
+    dbTargetSchema = context.targetSchema
+    
+    with context.connect() as conn:
         
         conn.autocommit = False
         
@@ -273,29 +203,24 @@ def main():
             cursor.execute(query)
         
         print("  creating network")
-        createNetwork(conn)
+        network = createNetwork(conn, context)
         
         print("  processing nodes")
-        processNodes()
+        processNodes(network)
         
         print("  processing edges")
-        processEdges()
+        processEdges(network)
         
         print("  writing results")
-        writeResults(conn)
-        # replace index on geometry field
-        query = f"""
-            DROP INDEX IF EXISTS {dbTargetSchema}.{dbTargetSchema}_{dbTargetTable}_geometry_idx;
-            CREATE INDEX IF NOT EXISTS {dbTargetSchema}_{dbTargetTable}_geometry_idx
-                ON {dbTargetSchema}.{dbTargetTable} USING gist
-                ({dbTargetGeom});
-        """
-        with conn.cursor() as cursor:
-            cursor.execute(query)
-        conn.commit()
+        writeResults(conn, context, network)
+        createIndex(conn, context)
         
     print("done")
 
+#--- main program ---    
+def main():
+    run(stage_context.fromArgs())
+
 
 if __name__ == "__main__":
     main()      
@@ -0,0 +1,146 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+
+#
+# Records the fish species parameters a watershed was processed with
+# (run; the last processing script) and finds the species whose parameters
+# changed since, so only the per species columns of those species have to 
+# be recomputed when the parameters change (see refresh_parameters).
+#
+# The parameters are copied to the fish_species_processed table of the 
+# output schema.
+#
+import appconfig
+import stage_context
+
+dbTargetStreamTable = appconfig.config['PROCESSING']['stream_table']
+dbBarrierTable = appconfig.config['BARRIER_PROCESSING']['barrier_table']
+
+speciesTable = f"{appconfig.dataSchema}.{appconfig.fishSpeciesTable}"
+processedTable = "fish_species_processed"
+
+#tables read and written by this script (see stage_scheduler); the per
+#species columns of the stream and barrier tables are the results the
+#recorded parameters were used for so this script runs after they are 
+#computed
+def stageInputs(context):
+    return [speciesTable,
+            f"{context.targetSchema}.{dbTargetStreamTable}",
+            f"{context.targetSchema}.{dbBarrierTable}"]
+
+def stageOutputs(context):
+    return [f"{context.targetSchema}.{processedTable}"]
+
+class SpeciesChanges:
+    
+    def __init__(self, changed, removed, gradientchanged):
+        #codes of the species that are new or whose parameters changed
+        self.changed = changed
+        #codes of the species no longer in the parameters
+        self.removed = removed
+        #if the smallest accessibility gradient (used to break streams
+        #at gradient barriers) changed
+        self.gradientchanged = gradientchanged
+
+#
+# returns the species changes since the parameters were recorded for the
+# watershed; None if no parameters were recorded
+#
+def findChanges(connection, context):
+    
+    processed = f"{context.targetSchema}.{processedTable}"
+    
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT to_regclass('{processed}') IS NOT NULL")
+        if not cursor.fetchone()[0]:
+            return None
+    
+    #rows are compared as a whole so a change to any parameter (or
+    #parameters added to the table) marks the species as changed
+    query = f"""
+        SELECT coalesce(a.code, b.code), a.code IS NULL
+        FROM {speciesTable} a FULL OUTER JOIN {processed} b ON a.code = b.code
+        WHERE to_jsonb(a) IS DISTINCT FROM to_jsonb(b)
+        ORDER BY 1
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+        rows = cursor.fetchall()
+    
+    changed = [row[0] for row in rows if not row[1]]
+    removed = [row[0] for row in rows if row[1]]
+    
+    query = f"""
+        SELECT (SELECT min(accessibility_gradient) FROM {speciesTable}),
+            (SELECT min(accessibility_gradient) FROM {processed})
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+        current, previous = cursor.fetchone()
+    
+    return SpeciesChanges(changed, removed, current != previous)
+
+#
+# sql condition selecting the given species codes from the species 
+# parameter table; None selects all species
+#
+def speciesFilter(species):
+    if species is None:
+        return "true"
+    if len(species) == 0:
+        return "false"
+    return "code IN (" + ",".join(["'" + code + "'" for code in species]) + ")"
+
+#
+# drops the columns from the (schema qualified) table
+#
+def dropColumns(connection, table, columns):
+    if len(columns) == 0:
+        return
+    dropstr = ', '.join([f"DROP COLUMN IF EXISTS {column}" for column in columns])
+    with connection.cursor() as cursor:
+        cursor.execute(f"ALTER TABLE {table} {dropstr}")
+
+def run(context):
+    
+    dbTargetSchema = context.targetSchema
+    
+    with context.connect() as conn:
+        
+        print("Recording species parameters")
+        
+        query = f"""
+            DROP TABLE IF EXISTS {dbTargetSchema}.{processedTable};
+            
+            CREATE TABLE {dbTargetSchema}.{processedTable} AS
+            SELECT * FROM {speciesTable};
+        """
+        with conn.cursor() as cursor:
+            cursor.execute(query)
+        conn.commit()
+        
+    print("done")
+
+#--- main program ---
+def main():
+    run(stage_context.fromArgs())
+
+
+if __name__ == "__main__":
+    main()
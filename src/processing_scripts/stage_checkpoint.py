@@ -0,0 +1,368 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+
+#
+# Per stage checkpoints so a rerun of a watershed only runs the processing
+# scripts (stages, see stage_scheduler) whose inputs changed since they
+# last completed.
+#
+# When a stage completes a fingerprint of its inputs is recorded in the
+# stage_checkpoints table of the output schema. The fingerprint covers:
+#  * the stage name and the source of its processing script and of the
+#    project modules it imports (directly or through other modules; e.g.
+#    stream_network, bulk_writer, appconfig)
+#  * the configuration (all sections except other watersheds; settings
+#    that only change how fast the scripts run are ignored)
+#  * the files the script reads (stageFiles; path, size and modified time)
+#  * each input table: the fingerprints of the earlier stages that write
+#    the table. Tables no stage writes (e.g. the provincial road and 
+#    stream tables) are fingerprinted from a checksum of their contents.
+#    For large tables scripts should replace this with a query returning
+#    only the values they use from the table (stageQueries; e.g. the rows
+#    of the watershed)
+#
+# A stage is run when it has no checkpoint, its fingerprint changed or an
+# earlier stage writing a table it uses is run. Scripts that restructure a
+# table in place (stageRebuilds; e.g. break_streams_at_barriers splitting
+# streams) leave it in a state the earlier stages can't be rerun on, so if
+# that script has to run all earlier scripts using the table are run as
+# well, starting from the script that creates it. The checkpoints of all stages
+# that will run are removed before any are started so a failed run never
+# leaves checkpoints behind for stages whose inputs changed.
+#
+# Stages without inputs (load_parameters) are run while planning so the
+# queries of later stages see the values they load.
+#
+# Data read from outside the database and files (e.g. the CABD barriers)
+# is not fingerprinted; delete the checkpoint of a stage to force it to
+# run:
+#  DELETE FROM <output_schema>.stage_checkpoints WHERE stage = '<stage>';
+#
+import hashlib
+import os
+import sys
+import types
+import stage_scheduler
+
+checkpointTable = "stage_checkpoints"
+
+#configuration settings that don't change the results
+ignoredSettings = {"stage_workers", "watershed_workers", "dem_workers", "dem_catalogue", "stage_checkpoints"}
+
+#
+# returns the stages that have to be run, removing their checkpoints; 
+# the returned stages record their checkpoint when they complete
+#
+def checkpointStages(stages, context):
+    
+    plan = CheckpointPlan(stages, context)
+    
+    with context.connect() as conn:
+        createTable(conn, context)
+        recorded = loadCheckpoints(conn, context)
+        
+        run = set()
+        for index, stage in enumerate(stages):
+            fingerprint = plan.fingerprint(conn, index, run - plan.executed)
+            plan.fingerprints[index] = fingerprint
+            
+            if fingerprint is None or recorded.get(stage.name) != fingerprint or plan.forced(index, run):
+                run.add(index)
+                if not stage.inputs:
+                    #nothing earlier can change the result; run it now so
+                    #the queries of the later stages see its outputs
+                    deleteCheckpoints(conn, context, [stage.name])
+                    plan.runStage(index)
+                    
+        run |= plan.rebuilds(run)
+        
+        pending = sorted(run - plan.executed)
+        deleteCheckpoints(conn, context, [stages[index].name for index in pending])
+    
+    for index, stage in enumerate(stages):
+        if index not in run:
+            print("skipping stage (unchanged): " + stage.name)
+    
+    return [plan.checkpointStage(index) for index in pending]
+
+#
+# returns the stages from first on for running them again without 
+# checking their inputs (see refresh_parameters), removing their 
+# checkpoints; the returned stages record their checkpoint when they
+# complete
+#
+def rerunStages(stages, first, context):
+    
+    plan = CheckpointPlan(stages, context)
+    
+    with context.connect() as conn:
+        createTable(conn, context)
+        for index in range(first):
+            plan.fingerprints[index] = plan.fingerprint(conn, index, set())
+        deleteCheckpoints(conn, context, [stage.name for stage in stages[first:]])
+    
+    #computed when the stages are run
+    for index in range(first, len(stages)):
+        plan.fingerprints[index] = None
+
+    
+    return [plan.checkpointStage(index) for index in range(first, len(stages))]
+
+
+class CheckpointPlan:
+    
+    def __init__(self, stages, context):
+        self.stages = stages
+        self.context = context
+        self.config = configFingerprint(context)
+        self.fingerprints = {}
+        self.executed = set()
+    
+    #
+    # fingerprint of the inputs of the stage; None if it can't be computed
+    # before the given (pending) stages are run
+    #
+    def fingerprint(self, connection, index, pending):
+        stage = self.stages[index]
+        queries = moduleHook(stage, "stageQueries", {})
+        
+        digest = hashlib.sha256()
+        digest.update(f"stage={stage.name}\nconfig={self.config}\n".encode())
+        
+        if stage.module is not None:
+            digest.update(f"source={sourceFingerprint(stage.module)}\n".encode())
+        
+        for filename in moduleHook(stage, "stageFiles", []):
+            digest.update(f"file={fileFingerprint(filename)}\n".encode())
+        
+        for table in sorted(stage.inputs):
+            writers = [i for i in range(index) if table in self.stages[i].outputs]
+            
+            if table in queries:
+                if any(i in pending for i in writers):
+                    return None
+                value = queryFingerprint(connection, queries[table])
+            elif writers:
+                values = [self.fingerprints.get(i) for i in writers]
+                if None in values:
+                    return None
+                value = ",".join(values)
+            else:
+                value = tableChecksum(connection, table)
+            
+            digest.update(f"table={table}:{value}\n".encode())
+        
+        return digest.hexdigest()
+    
+    #
+    # true if an earlier stage that is run writes a table the stage uses; 
+    # tables fingerprinted with a query only force the stage to run if the
+    # query result changes
+    #
+    def forced(self, index, run):
+        stage = self.stages[index]
+        uses = (stage.inputs | stage.outputs) - set(moduleHook(stage, "stageQueries", {}))
+        return any(self.stages[i].outputs & uses for i in run if i < index)
+    
+    #
+    # extends the stages to run with the earlier stages using tables that
+    # are restructured by later stages, and the stages depending on those
+    #
+    def rebuilds(self, run):
+        run = set(run)
+        changed = True
+        while changed:
+            changed = False
+            for r in sorted(run):
+                for table in moduleHook(self.stages[r], "stageRebuilds", []):
+                    for i in range(r):
+                        stage = self.stages[i]
+                        if i not in run and table in (stage.inputs | stage.outputs):
+                            run.add(i)
+                            changed = True
+            
+            for index in range(len(self.stages)):
+                if index not in run and self.forced(index, run):
+                    run.add(index)
+                    changed = True
+        return run
+    
+    def runStage(self, index):
+        stage = self.stages[index]
+        print("running stage: " + stage.name)
+        stage.run()
+        self.executed.add(index)
+        
+        with self.context.connect() as conn:
+            saveCheckpoint(conn, self.context, stage.name, self.fingerprints[index])
+    
+    #
+    # stage running the planned stage and recording its checkpoint; the
+    # fingerprint is computed before the stage is run if it depended on
+    # stages that hadn't run yet when planning
+    #
+    def checkpointStage(self, index):
+        stage = self.stages[index]
+        
+        def run():
+            if self.fingerprints[index] is None:
+                with self.context.connect() as conn:
+                    self.fingerprints[index] = self.fingerprint(conn, index, set())
+            stage.run()
+            with self.context.connect() as conn:
+                saveCheckpoint(conn, self.context, stage.name, self.fingerprints[index])
+        
+        return stage_scheduler.Stage(stage.name, run, stage.inputs, stage.outputs, stage.module, stage.context)
+
+
+
+#
+# returns the value of the optional processing script function 
+# (stageFiles, stageQueries, stageRebuilds) for the stage
+#
+def moduleHook(stage, name, default):
+    if stage.module is None or not hasattr(stage.module, name):
+        return default
+    return getattr(stage.module, name)(stage.context)
+
+def configFingerprint(context):
+    digest = hashlib.sha256()
+    config = context.config
+    for section in sorted(config.sections()):
+        if section != context.section and config.has_option(section, "watershed_id"):
+            continue
+        for key in sorted(config[section]):
+            if key in ignoredSettings:
+                continue
+            digest.update(f"{section}.{key}={config.get(section, key, raw = True)}\n".encode())
+    return digest.hexdigest()
+
+#
+# hash of the source of the module and the project modules (in the 
+# directory tree containing the processing scripts) it imports
+#
+def sourceFingerprint(module):
+    digest = hashlib.sha256()
+    for filename in sorted(projectModules(module)):
+        with open(filename, "rb") as f:
+            digest.update(filename.encode() + b"\n" + f.read())
+    return digest.hexdigest()
+
+#
+# source files of the module and the project modules it imports; modules
+# and module level names imported from modules are followed
+#
+def projectModules(module):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(module.__file__)))
+    files = set()
+    pending = [module]
+    while pending:
+        current = pending.pop()
+        filename = getattr(current, "__file__", None)
+        if filename is None:
+            continue
+        filename = os.path.abspath(filename)
+        if filename in files or not filename.startswith(root + os.sep):
+            continue
+        files.add(filename)
+        
+        for value in list(vars(current).values()):
+            if isinstance(value, types.ModuleType):
+                pending.append(value)
+            elif getattr(value, "__module__", None) in sys.modules:
+                pending.append(sys.modules[value.__module__])
+    return files
+
+#
+# path, size and modified time of the file; for directories all files in
+# the directory
+#
+def fileFingerprint(filename):
+    if os.path.isdir(filename):
+        return ";".join([fileFingerprint(os.path.join(filename, f)) for f in sorted(os.listdir(filename))])
+    if not os.path.exists(filename):
+        return f"{filename}:missing"
+    stat = os.stat(filename)
+    return f"{filename}:{stat.st_size}:{stat.st_mtime_ns}"
+
+def queryFingerprint(connection, query):
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+        rows = cursor.fetchall()
+    return hashlib.sha256(repr(rows).encode()).hexdigest()
+
+#
+# query returning a checksum of the contents of the (schema qualified)
+# table rows matching the optional where clause
+#
+def checksumQuery(table, where = None):
+    query = f"""
+        SELECT count(*), md5(string_agg(md5(t::text), '' ORDER BY md5(t::text)))
+        FROM {table} t
+    """
+    if where is not None:
+        query += f" WHERE {where}"
+    return query
+
+def tableChecksum(connection, table):
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT to_regclass('{table}') IS NOT NULL")
+        exists = cursor.fetchone()[0]
+    if not exists:
+        return "missing"
+    return queryFingerprint(connection, checksumQuery(table))
+
+
+def createTable(connection, context):
+    query = f"""
+        CREATE SCHEMA IF NOT EXISTS {context.targetSchema};
+        
+        CREATE TABLE IF NOT EXISTS {context.targetSchema}.{checkpointTable}(
+            stage varchar primary key,
+            fingerprint varchar not null,
+            completed timestamp not null default now()
+        );
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+    connection.commit()
+
+def loadCheckpoints(connection, context):
+    query = f"SELECT stage, fingerprint FROM {context.targetSchema}.{checkpointTable}"
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+        return {row[0]: row[1] for row in cursor.fetchall()}
+
+def deleteCheckpoints(connection, context, names):
+    if len(names) == 0:
+        return
+    query = f"DELETE FROM {context.targetSchema}.{checkpointTable} WHERE stage = ANY(%s)"
+    with connection.cursor() as cursor:
+        cursor.execute(query, (list(names),))
+    connection.commit()
+
+def saveCheckpoint(connection, context, name, fingerprint):
+    query = f"""
+        INSERT INTO {context.targetSchema}.{checkpointTable} (stage, fingerprint, completed)
+        VALUES (%s, %s, now())
+        ON CONFLICT (stage) DO UPDATE SET fingerprint = excluded.fingerprint, completed = excluded.completed
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query, (name, fingerprint))
+    connection.commit()
@@ -0,0 +1,70 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+#
+# Run context passed to the processing scripts (see the run function of 
+# each script). Holds the configuration, the watershed being processed 
+# (config section; None for scripts that aren't watershed specific such 
+# as load_parameters) and optionally a database connection so the scripts 
+# don't bind the watershed from the command line when they are imported; 
+# the same imported scripts can process any number of watersheds, one 
+# after another or at the same time.
+#
+# Settings that are the same for every watershed (field names, processing
+# parameters) are still read by the scripts from appconfig when imported.
+#
+import appconfig
+
+class StageContext:
+
+    def __init__(self, section, connection = None, config = None):
+        if config is None:
+            config = appconfig.config
+        
+        self.config = config
+        self.section = section
+        self.connection = connection
+        
+        self.watershed = None
+        self.watershedId = None
+        self.targetSchema = None
+        
+        if section is not None:
+            self.watershed = config[section]
+            self.watershedId = self.watershed['watershed_id']
+            self.targetSchema = self.watershed['output_schema']
+
+    #
+    # returns the connection given to the context, otherwise a new 
+    # connection; scripts run at the same time must not share a connection
+    # (and transaction) so contexts used that way shouldn't be given one
+    #
+    def connect(self):
+        if self.connection is not None:
+            return self.connection
+        return appconfig.connectdb()
+
+
+#
+# context for the watershed given on the command line (if any)
+#
+def fromArgs():
+    if len(appconfig.args.args) == 0:
+        return StageContext(None)
+    return StageContext(appconfig.args.args[0])
+
@@ -0,0 +1,114 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+#
+# Runs processing scripts (stages) as a dependency graph instead of in a
+# fixed serial order.
+#
+# Each processing script declares the tables it reads (stageInputs) and
+# writes (stageOutputs) for a run context (see stage_context). A stage
+# depends on every earlier stage (in the order given) that writes a table
+# it reads or writes, or that reads a table it writes, so stages are only
+# reordered or run concurrently when they don't touch the same tables.
+# Tables are the unit of dependency as adding columns locks the whole
+# table.
+#
+# Stages are run in threads; each stage opens its own database connection.
+#
+# Stages created for a processing script keep the module and context so 
+# optional script functions can be looked up (see stage_checkpoint).
+#
+import concurrent.futures
+
+class Stage:
+    
+    def __init__(self, name, run, inputs, outputs, module = None, context = None):
+        self.name = name
+        self.run = run
+        self.inputs = set(inputs)
+        self.outputs = set(outputs)
+        self.module = module
+        self.context = context
+
+#
+# creates a stage running a processing script module for the context 
+# using its run function and declared inputs and outputs
+#
+def moduleStage(module, context, name = None, run = None):
+    if name is None:
+        name = module.__name__.rsplit(".", 1)[-1]
+    if run is None:
+        run = lambda: module.run(context)
+    return Stage(name, run, module.stageInputs(context), module.stageOutputs(context), module, context)
+
+#
+# returns for each stage the indices of the earlier stages it depends on
+#
+def dependencies(stages):
+    depends = []
+    for j, stage in enumerate(stages):
+        uses = stage.inputs | stage.outputs
+        depends.append({i for i in range(j) 
+                        if (stages[i].outputs & uses) or (stages[i].inputs & stage.outputs)})
+    return depends
+
+#
+# runs the stages using up to workers concurrent stages; with one worker
+# the stages are run in the order given. If a stage fails no new stages
+# are started and the error is raised once the running stages complete.
+#
+def runStages(stages, workers = 1):
+    
+    if workers <= 1:
+        for stage in stages:
+            stage.run()
+        return
+    
+    depends = dependencies(stages)
+    done = set()
+    pending = list(range(len(stages)))
+    running = {}
+    error = None
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as pool:
+        while pending or running:
+            
+            if error is None:
+                #start stages in order as their dependencies complete
+                for index in [i for i in pending if depends[i] <= done]:
+                    if len(running) >= workers:
+                        break
+                    print("starting stage: " + stages[index].name)
+                    running[pool.submit(stages[index].run)] = index
+                    pending.remove(index)
+            
+            if not running:
+                break
+            
+            finished, _ = concurrent.futures.wait(running, return_when = concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                index = running.pop(future)
+                if future.exception() is not None:
+                    print("stage failed: " + stages[index].name)
+                    if error is None:
+                        error = future.exception()
+                else:
+                    done.add(index)
+    
+    if error is not None:
+        raise error
@@ -0,0 +1,200 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+#
+# Shared stream network used by the scripts that need to walk the
+# stream graph (mainstems, smoothing, barriers, accessibility).
+#
+# Nodes are the unique start/end coordinates of the stream edges and are
+# identified by integer ids. Edges are kept in the order they were loaded
+# and are identified by their index. In and out edges for each node are
+# stored in compressed (CSR) arrays so the network holds a handful of numpy
+# arrays instead of a python object per node and edge.
+#
+# Values used by the individual scripts are stored in the attributes
+# (indexed by edge) and nodeattributes (indexed by node) dictionaries as
+# one list or array per attribute.
+#
+import numpy
+
+#number of rows fetched from the database at a time when loading networks
+fetchSize = 10000
+
+class StreamNetwork:
+
+    def __init__(self, fids, startcoords, endcoords):
+        self.fids = list(fids)
+        self.edgecount = len(self.fids)
+
+        startcoords = numpy.asarray(startcoords, dtype=numpy.float64).reshape(-1, 2)
+        endcoords = numpy.asarray(endcoords, dtype=numpy.float64).reshape(-1, 2)
+
+        #nodes are matched on exact coordinates
+        allcoords = numpy.concatenate((startcoords, endcoords))
+        nodecoords, nodeids = numpy.unique(allcoords, axis=0, return_inverse=True)
+        nodeids = nodeids.reshape(-1)
+
+        self.nodecount = len(nodecoords)
+        self.nodex = nodecoords[:, 0]
+        self.nodey = nodecoords[:, 1]
+
+        self.fromnode = nodeids[:self.edgecount]
+        self.tonode = nodeids[self.edgecount:]
+
+        self.outptr, self.outedges = createAdjacency(self.fromnode, self.nodecount)
+        self.inptr, self.inedges = createAdjacency(self.tonode, self.nodecount)
+
+        self.attributes = {}
+        self.nodeattributes = {}
+        
+        self.levels = None
+        self.edgeindex = None
+
+    #
+    # returns the edge with the given feature id (or None); the 
+    # id -> edge index is built on first use
+    #
+    def getEdge(self, fid):
+        if self.edgeindex is None:
+            self.edgeindex = {fid: edge for edge, fid in enumerate(self.fids)}
+        return self.edgeindex.get(fid)
+
+    def inEdges(self, node):
+        return self.inedges[self.inptr[node]:self.inptr[node + 1]]
+
+    def outEdges(self, node):
+        return self.outedges[self.outptr[node]:self.outptr[node + 1]]
+
+    def inDegree(self):
+        return numpy.diff(self.inptr)
+
+    def outDegree(self):
+        return numpy.diff(self.outptr)
+
+    #nodes with no upstream edges
+    def sources(self):
+        return numpy.flatnonzero(self.inDegree() == 0)
+
+    #nodes with no downstream edges
+    def sinks(self):
+        return numpy.flatnonzero(self.outDegree() == 0)
+
+    #
+    # nodes grouped by their position in the network; level 0 contains the
+    # source nodes and every node is in a later level than all of the nodes
+    # upstream of it. Computed once (Kahn's algorithm, one level at a time).
+    #
+    def topologicalLevels(self):
+        if self.levels is None:
+            self.levels = computeLevels(self)
+        return self.levels
+
+    #all nodes ordered from the sources down to the sinks
+    def topologicalOrder(self):
+        levels = self.topologicalLevels()
+        if len(levels) == 0:
+            return numpy.zeros(0, dtype=numpy.int64)
+        return numpy.concatenate(levels)
+
+    #
+    # edges grouped by the level of their downstream node. Walking these
+    # groups in order visits every edge after all edges upstream of it; walking
+    # them in reverse visits every edge after all edges downstream of it.
+    #
+    def edgeLevels(self):
+        return [self.inEdgesOf(nodes) for nodes in self.topologicalLevels()[1:]]
+
+    #all in edges of the given set of nodes
+    def inEdgesOf(self, nodes):
+        return self.inedges[expandRanges(self.inptr[nodes], self.inptr[nodes + 1])]
+
+    #all out edges of the given set of nodes
+    def outEdgesOf(self, nodes):
+        return self.outedges[expandRanges(self.outptr[nodes], self.outptr[nodes + 1])]
+
+
+#
+# select list returning the start x, start y, end x and end y coordinates
+# of a linestring field, so the network topology can be loaded without 
+# transferring and parsing the full geometries
+#
+def endpointFields(geomfield):
+    return (f"st_x(st_startpoint({geomfield})), st_y(st_startpoint({geomfield})), "
+            f"st_x(st_endpoint({geomfield})), st_y(st_endpoint({geomfield}))")
+
+
+#
+# iterates over the rows returned by the query; rows are read using a
+# named (server side) cursor fetchSize rows at a time so the full result
+# set is never held in memory
+#
+def readRows(connection, query, fetchsize = fetchSize):
+    with connection.cursor(name = "stream_network_rows") as cursor:
+        cursor.itersize = fetchsize
+        cursor.execute(query)
+        
+        while True:
+            rows = cursor.fetchmany(fetchsize)
+            if len(rows) == 0:
+                break
+            for row in rows:
+                yield row
+
+
+#
+# builds a CSR style adjacency list for the given edge -> node array;
+# edges for each node retain the order they were loaded in
+#
+def createAdjacency(edgenodes, nodecount):
+    order = numpy.argsort(edgenodes, kind='stable')
+    counts = numpy.bincount(edgenodes, minlength=nodecount)
+    ptr = numpy.zeros(nodecount + 1, dtype=numpy.int64)
+    numpy.cumsum(counts, out=ptr[1:])
+    return ptr, order
+
+
+#
+# concatenates the index ranges [starts[i], ends[i])
+#
+def expandRanges(starts, ends):
+    counts = ends - starts
+    total = int(counts.sum())
+    if total == 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+    offsets = numpy.repeat(starts - numpy.cumsum(counts) + counts, counts)
+    return offsets + numpy.arange(total)
+
+
+def computeLevels(network):
+    indegree = network.inDegree().copy()
+    levels = []
+    visited = 0
+    
+    frontier = numpy.flatnonzero(indegree == 0)
+    while len(frontier) > 0:
+        levels.append(frontier)
+        visited += len(frontier)
+        
+        downnodes = network.tonode[network.outEdgesOf(frontier)]
+        numpy.subtract.at(indegree, downnodes, 1)
+        frontier = numpy.unique(downnodes[indegree[downnodes] == 0])
+    
+    if visited != network.nodecount:
+        raise ValueError("stream network contains a cycle; " + str(network.nodecount - visited) + " nodes could not be ordered")
+    
+    return levels
@@ -0,0 +1,139 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+#
+# Updates a processed watershed after the fish species parameters change
+# without reprocessing the stream geometries.
+#
+# refresh_parameters.py -c config.ini [watershedid] -user [username] -password [password]
+#
+# The parameters are reloaded (unless -noparameters is given) and compared
+# to the parameters the watershed was last processed with (see 
+# species_parameters). Only the accessibility, habitat model and barrier
+# upstream value columns of the species whose parameters changed are 
+# recomputed; columns of removed species are dropped. 
+#
+# Streams are broken at gradient barriers using the smallest accessibility
+# gradient of all species, so if it changed the streams saved before they
+# were broken are restored and the processing scripts are run again from
+# break_streams_at_barriers on; the barriers, observations and elevations
+# are not reloaded. If the watershed has no recorded parameters (or no
+# saved streams) the watershed is fully reprocessed instead (see 
+# process_watershed).
+#
+
+from datetime import datetime
+import os
+import sys
+import appconfig
+
+#shared modules are imported directly by the processing scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "processing_scripts"))
+
+import process_watershed
+from processing_scripts import load_parameters
+from processing_scripts import break_streams_at_barriers
+from processing_scripts import compute_gradient_accessibility
+from processing_scripts import compute_habitat_models
+from processing_scripts import compute_barriers_upstream_values
+from processing_scripts import species_parameters
+from processing_scripts import stage_scheduler
+from processing_scripts import stage_context
+from processing_scripts import stage_checkpoint
+
+#
+# restores the unbroken streams and runs the processing scripts from 
+# break_streams_at_barriers on; returns false if the watershed has no 
+# saved unbroken streams. With stage checkpoints the checkpoints of the
+# scripts are replaced (see stage_checkpoint)
+#
+def rebreakStreams(context, removed):
+    
+    with context.connect() as conn:
+        if not break_streams_at_barriers.hasUnbroken(conn, context):
+            return False
+        
+        print("  restoring unbroken streams")
+        break_streams_at_barriers.restoreUnbroken(conn, context)
+    
+    stages = process_watershed.watershedStages(context, parameters = False)
+    first = [stage.module for stage in stages].index(break_streams_at_barriers)
+    if process_watershed.stageCheckpoints:
+        stages = stage_checkpoint.rerunStages(stages, first, context)
+    else:
+        stages = stages[first:]
+    stage_scheduler.runStages(stages, process_watershed.stageWorkers)
+    
+    #the stream table columns of removed species were dropped when the
+    #streams were restored; the barrier table is kept
+    with context.connect() as conn:
+        species_parameters.dropColumns(conn, 
+            f"{context.targetSchema}.{compute_barriers_upstream_values.dbBarrierTable}",
+            [column for code in removed for column in compute_barriers_upstream_values.speciesColumns(code)])
+    
+    return True
+
+def refreshParameters(context):
+    
+    with context.connect() as conn:
+        changes = species_parameters.findChanges(conn, context)
+    
+    if changes is None:
+        print("No species parameters recorded for " + context.watershedId + "; reprocessing watershed")
+        process_watershed.processWatershed(context, parameters = False)
+        return
+    
+    if changes.gradientchanged:
+        print("Minimum accessibility gradient changed; breaking streams at the new gradient barriers")
+        if not rebreakStreams(context, changes.removed):
+            print("No unbroken streams saved for " + context.watershedId + "; reprocessing watershed")
+            process_watershed.processWatershed(context, parameters = False)
+        return
+    
+    if len(changes.changed) == 0 and len(changes.removed) == 0:
+        print("Species parameters unchanged")
+        return
+    
+    print("Changed species: " + ", ".join(changes.changed))
+    print("Removed species: " + ", ".join(changes.removed))
+    
+    compute_gradient_accessibility.runSpecies(context, changes.changed, changes.removed)
+    compute_habitat_models.runSpecies(context, changes.changed, changes.removed)
+    compute_barriers_upstream_values.runSpecies(context, changes.changed, changes.removed)
+    species_parameters.run(context)
+
+
+def main():
+    
+    startTime = datetime.now()
+    
+    context = stage_context.fromArgs()
+    
+    print ("Refreshing parameters: " + context.watershedId)
+    
+    if not appconfig.args.noparameters:
+        load_parameters.run(context)
+    
+    refreshParameters(context)
+    
+    print ("Refresh Complete: " + context.watershedId)
+    print("Runtime: " + str((datetime.now() - startTime)))
+
+
+if __name__ == "__main__":
+    main()
@@ -20,9 +20,15 @@
 # This script creates the database tables that follow the structure
 # in the gdb file.
 #
- 
+
+import os
+import sys
 import appconfig
 
+#shared modules (stream_network etc.) are imported directly by the 
+#processing scripts so they can also be run on their own
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "processing_scripts"))
+
 from processing_scripts import preprocess_watershed
 from processing_scripts import load_and_snap_barriers_cabd 
 from processing_scripts import compute_modelled_crossings
@@ -32,37 +38,51 @@ from processing_scripts import assign_raw_z
 from processing_scripts import smooth_z
 from processing_scripts import compute_vertex_gradient
 from processing_scripts import compute_segment_gradient
+from processing_scripts import compute_elevations
 from processing_scripts import break_streams_at_barriers
 from processing_scripts import load_and_snap_fishobservation
 from processing_scripts import compute_gradient_accessibility
 from processing_scripts import compute_updown_barriers_fish
 from processing_scripts import compute_habitat_models
 from processing_scripts import compute_barriers_upstream_values
+from processing_scripts import species_parameters
+from processing_scripts import stage_context
 
-iniSection = appconfig.args.args[0]
+context = stage_context.fromArgs()
 
-workingWatershedId = appconfig.config[iniSection]['watershed_id']
+workingWatershedId = context.watershedId
+
+#run the elevation stages in memory (see compute_elevations)
+fusedElevation = appconfig.config['ELEVATION_PROCESSING'].getboolean('fused_pipeline', False)
 
 print ("Processing: " + workingWatershedId)
 
 # re-load unbroken stream table
-preprocess_watershed.main()
-# load_and_snap_barriers_cabd.main()
-# load_and_snap_fishobservation.main()
-# compute_modelled_crossings.main()
-# load_assessment_data.main()
-compute_mainstems.main()
-assign_raw_z.main()
-smooth_z.main()
-compute_vertex_gradient.main()
-break_streams_at_barriers.main()
+preprocess_watershed.run(context)
+# load_and_snap_barriers_cabd.run(context)
+# load_and_snap_fishobservation.run(context)
+# compute_modelled_crossings.run(context)
+# load_assessment_data.run(context)
+compute_mainstems.run(context)
+if fusedElevation:
+    compute_elevations.run(context, vertexgradient = True, segmentgradient = False)
+else:
+    assign_raw_z.run(context)
+    smooth_z.run(context)
+    compute_vertex_gradient.run(context)
+break_streams_at_barriers.run(context)
 # re-assign elevations to broken streams
-assign_raw_z.main()
-smooth_z.main()
-compute_segment_gradient.main()
-compute_updown_barriers_fish.main()
-compute_gradient_accessibility.main()
-compute_habitat_models.main()
-compute_barriers_upstream_values.main()
+if fusedElevation:
+    compute_elevations.run(context, vertexgradient = False, segmentgradient = True)
+else:
+    assign_raw_z.run(context)
+    smooth_z.run(context)
+    compute_segment_gradient.run(context)
+compute_updown_barriers_fish.run(context)
+compute_gradient_accessibility.run(context)
+compute_habitat_models.run(context)
+compute_barriers_upstream_values.run(context)
+species_parameters.run(context)
+
 
 print ("Processing Complete: " + workingWatershedId)
@@ -0,0 +1,38 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+
+#
+# The processing scripts import appconfig, which parses the command line
+# and reads the configuration file when it is imported. It is imported here
+# once with the configuration file and placeholder credentials (no 
+# database connection is made) so the scripts can be imported by the tests.
+#
+import os
+import sys
+
+srcDir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+sys.path.insert(0, srcDir)
+sys.path.insert(0, os.path.join(srcDir, "processing_scripts"))
+
+argv = sys.argv
+sys.argv = [argv[0], "-c", os.path.join(srcDir, "config.ini"), "-user", "test", "-password", "test"]
+try:
+    import appconfig
+finally:
+    sys.argv = argv
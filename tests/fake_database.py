@@ -0,0 +1,91 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+
+#
+# In memory stand in for a psycopg2 connection used by the tests of the
+# functions that query the database. Results are given as a list of 
+# (text, rows) pairs; a query returns the rows of the first pair whose 
+# text is part of the query (no rows if none match). Rows can be a 
+# function of the query and its parameters. All queries and their 
+# parameters are kept in executed.
+#
+
+class FakeCursor:
+    
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+        self.itersize = 2000
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        pass
+    
+    def execute(self, query, params = None):
+        self.connection.executed.append((query, params))
+        self.rows = []
+        for text, rows in self.connection.results:
+            if text in query:
+                self.rows = list(rows(query, params) if callable(rows) else rows)
+                break
+    
+    def fetchall(self):
+        rows = self.rows
+        self.rows = []
+        return rows
+    
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+    
+    def fetchmany(self, size = None):
+        size = size or self.itersize
+        rows = self.rows[:size]
+        self.rows = self.rows[size:]
+        return rows
+
+class FakeConnection:
+    
+    def __init__(self, results = None):
+        self.results = results or []
+        self.executed = []
+        self.autocommit = False
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        pass
+    
+    def cursor(self, name = None, **kwargs):
+        return FakeCursor(self)
+    
+    def commit(self):
+        pass
+    
+    def rollback(self):
+        pass
+    
+    def close(self):
+        pass
+    
+    #the queries executed that contain the text
+    def queries(self, text):
+        return [query for query, params in self.executed if text in query]
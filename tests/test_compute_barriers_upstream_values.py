@@ -0,0 +1,136 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+
+#
+# tests for accumulating the upstream habitat values of all species
+# with one matrix
+#
+import numpy
+import pytest
+
+import stream_network
+import compute_barriers_upstream_values as upstream
+
+#
+#  A (0,3)   C (1,3)
+#      e0 \   / e1
+#         B (0,2)
+#           | e2
+#         D (0,1)  <- barrier
+#           | e3
+#         E (0,0)
+#
+# edge lengths are 1, 2, 4 and 8 so each sum shows the edges it includes
+#
+species = ["bt", "rb"]
+
+def createNetwork():
+    network = stream_network.StreamNetwork([10, 11, 12, 13], 
+        [(0, 3), (1, 3), (0, 2), (0, 1)], [(0, 2), (0, 2), (0, 1), (0, 0)])
+    network.species = species
+    
+    attr = network.attributes
+    attr['length'] = numpy.array([1, 2, 4, 8], dtype=numpy.float64)
+    #number of barriers upstream of the edge; the barrier at D is at the
+    #top of e3
+    attr['upbarriercnt'] = numpy.array([0, 0, 0, 1], dtype=numpy.int64)
+    
+    #bt is accessible everywhere and has habitat on all edges; rb is only
+    #accessible below the barrier and only has habitat on e1 (spawning) 
+    #and e3 (rearing)
+    attr['speca'] = numpy.array([[True, False], [True, False], [True, False], [True, True]])
+    attr['spawn_habitat'] = numpy.array([[True, False], [True, True], [True, False], [True, False]])
+    attr['rear_habitat'] = numpy.array([[True, False], [True, False], [True, False], [True, True]])
+    attr['habitat'] = attr['spawn_habitat'] | attr['rear_habitat']
+    return network
+
+#the upstream values of the species (None for all species) for each edge
+def upValues(network, name, fish = None):
+    if fish is None:
+        names = [value[0] for value in upstream.upvalues_all]
+        column = len(network.species) * len(upstream.upvalues) + names.index(name)
+    else:
+        names = [value[0] for value in upstream.upvalues]
+        column = network.species.index(fish) * len(upstream.upvalues) + names.index(name)
+    return list(network.attributes['upvalues'][:, column])
+
+
+def test_columns():
+    network = createNetwork()
+    
+    ishabitat, functional = upstream.valueColumns(network)
+    
+    assert ishabitat.shape == (4, len(species) * len(upstream.upvalues) + len(upstream.upvalues_all))
+    assert list(functional) == [value[2] for value in upstream.upvalues] * len(species) + [value[2] for value in upstream.upvalues_all]
+
+def test_total():
+    network = createNetwork()
+    upstream.processNodes(network)
+    
+    assert upValues(network, 'habitatup', 'bt') == [1, 2, 7, 15]
+    assert upValues(network, 'specaup', 'rb') == [0, 0, 0, 8]
+    assert upValues(network, 'spawn_habitatup', 'rb') == [0, 2, 2, 2]
+    assert upValues(network, 'rear_habitatup', 'rb') == [0, 0, 0, 8]
+    assert upValues(network, 'habitatup', 'rb') == [0, 2, 2, 10]
+
+def test_functional():
+    network = createNetwork()
+    upstream.processNodes(network)
+    
+    #only the edge itself is counted below the barrier
+    assert upValues(network, 'funchabitatup', 'bt') == [1, 2, 7, 8]
+    assert upValues(network, 'spawn_funchabitatup', 'rb') == [0, 2, 2, 0]
+    assert upValues(network, 'rear_funchabitatup', 'rb') == [0, 0, 0, 8]
+
+def test_all_species():
+    network = createNetwork()
+    upstream.processNodes(network)
+    
+    assert upValues(network, 'habitatup_all') == [1, 2, 7, 15]
+    assert upValues(network, 'funchabitatup_all') == [1, 2, 7, 8]
+    assert upValues(network, 'spawn_habitatup_all') == [1, 2, 7, 15]
+
+def test_no_species():
+    network = createNetwork()
+    network.species = []
+    for name in upstream.edgevalues:
+        network.attributes[name] = numpy.zeros((4, 0), dtype=bool)
+    upstream.processNodes(network)
+    
+    assert upValues(network, 'habitatup_all') == [0, 0, 0, 0]
+    assert network.attributes['upvalues'].shape == (4, len(upstream.upvalues_all))
+
+def test_matches_edge_walk():
+    network = createNetwork()
+    upstream.processNodes(network)
+    
+    ishabitat, functional = upstream.valueColumns(network)
+    attr = network.attributes
+    
+    #the same values walking one edge at a time
+    expected = numpy.zeros(ishabitat.shape)
+    for edge in numpy.concatenate(network.edgeLevels()):
+        node = network.fromnode[edge]
+        inedges = network.inEdges(node)
+        up = expected[inedges].sum(axis=0)
+        if attr['upbarriercnt'][edge] != attr['upbarriercnt'][inedges].sum():
+            up[functional] = 0
+        expected[edge] = up + ishabitat[edge] * attr['length'][edge]
+    
+    assert attr['upvalues'] == pytest.approx(expected)
@@ -0,0 +1,62 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+
+#
+# tests for the in memory segment gradient used by the fused elevation
+# pipeline; it has to match the computeSegmentGradient sql:
+# (ST_Z(ST_PointN(geom, 1)) - ST_Z(ST_PointN(geom, -1))) / ST_Length(geom)
+# where ST_Length is the 2d length of the line
+#
+import numpy
+import pytest
+import shapely
+
+import compute_segment_gradient
+
+def sqlGradient(coords):
+    line = shapely.LineString(coords)
+    return (coords[0][2] - coords[-1][2]) / line.length
+
+
+def test_known_gradient():
+    coords = numpy.array([(0, 0, 10), (3, 4, 8), (3, 10, 5)], dtype=numpy.float64)
+    
+    assert compute_segment_gradient.computeGradients([coords]) == [pytest.approx(5 / 11)]
+
+def test_matches_sql():
+    rng = numpy.random.default_rng(1)
+    coords = []
+    for count in [2, 3, 10, 50]:
+        xy = numpy.cumsum(rng.uniform(-50, 50, (count, 2)), axis=0)
+        z = rng.uniform(500, 1500, (count, 1))
+        coords.append(numpy.hstack((xy, z)))
+    
+    gradients = compute_segment_gradient.computeGradients(coords)
+    
+    assert gradients == [pytest.approx(sqlGradient(c)) for c in coords]
+    
+def test_uphill():
+    coords = numpy.array([(0, 0, 5), (0, 10, 7)], dtype=numpy.float64)
+    
+    assert compute_segment_gradient.computeGradients([coords]) == [pytest.approx(-0.2)]
+
+def test_zero_length():
+    coords = numpy.array([(1, 1, 5), (1, 1, 3)], dtype=numpy.float64)
+    
+    assert compute_segment_gradient.computeGradients([coords]) == [None]
@@ -0,0 +1,113 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+
+#
+# tests for attaching barriers and fish observations to the streams and
+# propagating them up and down the network as bitsets
+#
+import types
+
+import compute_updown_barriers_fish as updown
+from fake_database import FakeConnection
+
+#
+#  A (0,3)   C (1,3)
+#      e0 \   / e1
+#         B (0,2)
+#           | e2
+#         D (0,1)
+#           | e3
+#         E (0,0)
+#
+streams = [
+    ("e0", 0, 3, 0, 2),
+    ("e1", 1, 3, 0, 2),
+    ("e2", 0, 2, 0, 1),
+    ("e3", 0, 1, 0, 0),
+]
+
+#
+# a barrier at B (at the start of e2 and the end of e0), a gradient 
+# barrier at D, stocking of bt on e1 and a survey of rb on e3
+#
+attached = [
+    ("barrier", "up", "b1", "e2"),
+    ("barrier", "down", "b1", "e0"),
+    ("gradient", "up", "g1", "e3"),
+    ("stock", None, "bt", "e1"),
+    ("survey", None, "rb", "e3"),
+    #streams that are not in the network are ignored
+    ("barrier", "up", "b2", "x"),
+]
+
+def createNetwork():
+    connection = FakeConnection([("st_x(st_startpoint", streams), ("select 'barrier'", attached)])
+    context = types.SimpleNamespace(targetSchema = "ws")
+    return updown.createNetwork(connection, context)
+
+def edgeValues(network, name, slots):
+    return [sorted(slots.toList(bits)) for bits in network.attributes[name]]
+
+
+def test_bit_slots():
+    slots = updown.BitSlots()
+    
+    bits = slots.bit("b1") | slots.bit("b2") | slots.bit("b1")
+    
+    assert slots.bit("b1") == 1
+    assert slots.bit("b2") == 2
+    assert sorted(slots.toList(bits)) == ["b1", "b2"]
+    assert slots.toList(0) == []
+    assert updown.bitCount(bits) == 2
+
+def test_attach():
+    network = createNetwork()
+    
+    b = network.fromnode[2]
+    d = network.fromnode[3]
+    barrierids = network.nodeattributes['barrierids']
+    gradientids = network.nodeattributes['gradientbarrierids']
+    
+    #the barrier at the start of e2 and the end of e0 is one node barrier
+    assert network.barrierslots.toList(barrierids[b]) == ["b1"]
+    assert [node for node in range(network.nodecount) if barrierids[node]] == [b]
+    assert network.gradientslots.toList(gradientids[d]) == ["g1"]
+    assert edgeValues(network, 'stockedge', network.speciesslots) == [[], ["bt"], [], []]
+    assert edgeValues(network, 'surveyedge', network.speciesslots) == [[], [], [], ["rb"]]
+
+def test_barriers():
+    network = createNetwork()
+    updown.processNodes(network)
+    
+    assert edgeValues(network, 'upbarriers', network.barrierslots) == [[], [], ["b1"], ["b1"]]
+    assert edgeValues(network, 'downbarriers', network.barrierslots) == [["b1"], ["b1"], [], []]
+    assert edgeValues(network, 'upgradient', network.gradientslots) == [[], [], [], ["g1"]]
+    assert edgeValues(network, 'downgradient', network.gradientslots) == [["g1"], ["g1"], ["g1"], []]
+
+def test_species():
+    network = createNetwork()
+    updown.processNodes(network)
+    
+    slots = network.speciesslots
+    #the observations on an edge are up or downstream of the edges below
+    #or above it but not of the edge itself
+    assert edgeValues(network, 'stockup', slots) == [[], [], ["bt"], ["bt"]]
+    assert edgeValues(network, 'stockdown', slots) == [[], [], [], []]
+    assert edgeValues(network, 'surveyup', slots) == [[], [], [], []]
+    assert edgeValues(network, 'surveydown', slots) == [["rb"], ["rb"], ["rb"], []]
@@ -0,0 +1,63 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+
+#
+# tests for locating points along a mainstem by their distance from
+# the mouth
+#
+import numpy
+
+import compute_vertex_gradient
+
+#
+# a mainstem along the y axis with its mouth at (0,0) and the elevation
+# increasing 0.1 per meter; the segments run downstream and are added
+# out of order
+#
+def createMainstem():
+    mainstem = compute_vertex_gradient.Mainstem(1)
+    mainstem.addSegment(10, 20, numpy.array([(0, 20, 3.0), (0, 10, 2.0)]))
+    mainstem.addSegment(0, 10, numpy.array([(0, 10, 2.0), (0, 4, 1.4), (0, 0, 1.0)]))
+    mainstem.build()
+    return mainstem
+
+
+def test_locate():
+    mainstem = createMainstem()
+    
+    measures = numpy.array([0, 2, 4, 7, 10, 15, 19.5])
+    xyz, valid = mainstem.locate(measures)
+    
+    assert valid.all()
+    numpy.testing.assert_allclose(xyz[:, 0], 0)
+    numpy.testing.assert_allclose(xyz[:, 1], measures)
+    numpy.testing.assert_allclose(xyz[:, 2], 1.0 + 0.1 * measures)
+
+def test_off_mainstem():
+    mainstem = createMainstem()
+    
+    xyz, valid = mainstem.locate(numpy.array([-1, 5, 20, 25]))
+    
+    assert list(valid) == [False, True, False, False]
+
+def test_vertices():
+    mainstem = createMainstem()
+    
+    numpy.testing.assert_allclose(mainstem.measure, [0, 4, 10, 10, 20])
+    assert list(mainstem.isvertex) == [False, True, True, False, True]
@@ -0,0 +1,130 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+
+#
+# tests for reading DEM cells from tiled, stripped and uncompressed
+# GeoTIFF files
+#
+import numpy
+import pytest
+import tifffile
+
+import appconfig
+import dem_raster
+
+#
+# writes a dem with a size that is not a multiple of the tile or strip
+# size so the partial blocks at the edges are read as well
+#
+@pytest.fixture
+def dem():
+    return (numpy.arange(45 * 53, dtype=numpy.float32).reshape(45, 53) / 10.0) - 20.0
+
+@pytest.fixture
+def cells(dem):
+    rng = numpy.random.default_rng(0)
+    rows = rng.integers(0, dem.shape[0], 500)
+    cols = rng.integers(0, dem.shape[1], 500)
+    #corners
+    rows = numpy.append(rows, [0, 0, dem.shape[0] - 1, dem.shape[0] - 1])
+    cols = numpy.append(cols, [0, dem.shape[1] - 1, 0, dem.shape[1] - 1])
+    return rows, cols
+
+@pytest.mark.parametrize("options", [
+    {'tile': (16, 16), 'compression': 'zlib'},
+    {'rowsperstrip': 7, 'compression': 'zlib'},
+], ids=["tiled", "stripped"])
+def test_read_blocks(tmp_path, dem, cells, options):
+    filename = str(tmp_path / "dem.tif")
+    tifffile.imwrite(filename, dem, **options)
+    
+    rows, cols = cells
+    with dem_raster.DemRaster(filename) as raster:
+        assert raster.memmap is None
+        assert raster.page.is_tiled == ('tile' in options)
+        
+        values = raster.readCells(rows, cols)
+        
+        assert values.dtype == numpy.float64
+        numpy.testing.assert_array_equal(values, dem[rows, cols])
+        assert len(raster.readCells([], [])) == 0
+
+def test_read_memmap(tmp_path, dem, cells):
+    filename = str(tmp_path / "dem.tif")
+    tifffile.imwrite(filename, dem)
+    
+    rows, cols = cells
+    with dem_raster.DemRaster(filename) as raster:
+        assert raster.memmap is not None
+        numpy.testing.assert_array_equal(raster.readCells(rows, cols), dem[rows, cols])
+
+#
+# removes blocks from the file as sparse files do (an offset and byte 
+# count of zero); returns the mask of the cells in the removed blocks
+#
+def removeBlocks(filename, blockids):
+    with tifffile.TiffFile(filename, mode='r+b') as tiff:
+        page = tiff.pages[0]
+        offsets = list(page.dataoffsets)
+        counts = list(page.databytecounts)
+        for blockid in blockids:
+            offsets[blockid] = 0
+            counts[blockid] = 0
+        
+        name = "Tile" if page.is_tiled else "Strip"
+        page.tags[name + "Offsets"].overwrite(offsets)
+        page.tags[name + "ByteCounts"].overwrite(counts)
+        
+        mask = numpy.zeros(page.shape, dtype=bool)
+        for blockid in blockids:
+            if page.is_tiled:
+                across = -(-page.imagewidth // page.tilewidth)
+                row = (blockid // across) * page.tilelength
+                col = (blockid % across) * page.tilewidth
+                mask[row:row + page.tilelength, col:col + page.tilewidth] = True
+            else:
+                mask[blockid * page.rowsperstrip:(blockid + 1) * page.rowsperstrip, :] = True
+        return mask
+
+@pytest.mark.parametrize("options, nodata", [
+    ({'tile': (16, 16), 'compression': 'zlib', 'extratags': [(42113, 's', 0, '-9999', True)]}, -9999),
+    ({'rowsperstrip': 7, 'compression': 'zlib'}, appconfig.NODATA),
+], ids=["tiled", "stripped"])
+def test_read_sparse(tmp_path, dem, cells, options, nodata):
+    filename = str(tmp_path / "dem.tif")
+    tifffile.imwrite(filename, dem, **options)
+    #block 6 is the partial last block of the stripped file
+    mask = removeBlocks(filename, [4, 6])
+    
+    rows, cols = cells
+    expected = numpy.where(mask, nodata, dem)[rows, cols]
+    
+    with dem_raster.DemRaster(filename) as raster:
+        values = raster.readCells(rows, cols)
+    
+    assert mask[rows, cols].any()
+    numpy.testing.assert_array_equal(values, expected)
+
+def test_multiple_bands(tmp_path):
+
+    filename = str(tmp_path / "rgb.tif")
+    tifffile.imwrite(filename, numpy.zeros((8, 8, 3), dtype=numpy.uint8), photometric='rgb')
+    
+    with pytest.raises(ValueError):
+        dem_raster.DemRaster(filename)
@@ -0,0 +1,118 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+
+#
+# tests for choosing how a processed watershed is updated after the
+# fish species parameters change
+#
+import pytest
+
+import refresh_parameters
+import stage_context
+from fake_database import FakeConnection
+
+#
+# replaces the functions refresh_parameters calls to update the watershed,
+# recording the calls
+#
+@pytest.fixture
+def calls(monkeypatch):
+    calls = []
+    
+    def record(name, result = None):
+        def call(*args, **kwargs):
+            calls.append((name,) + args[1:])
+            return result
+        return call
+    
+    monkeypatch.setattr(refresh_parameters.process_watershed, "processWatershed", record("processWatershed"))
+    for module in [refresh_parameters.compute_gradient_accessibility, 
+                   refresh_parameters.compute_habitat_models, 
+                   refresh_parameters.compute_barriers_upstream_values]:
+        monkeypatch.setattr(module, "runSpecies", record(module.__name__.rsplit(".", 1)[-1]))
+    monkeypatch.setattr(refresh_parameters.species_parameters, "run", record("species_parameters"))
+    monkeypatch.setattr(refresh_parameters.species_parameters, "dropColumns", 
+        lambda connection, table, columns: calls.append(("dropColumns", table, columns)))
+    monkeypatch.setattr(refresh_parameters.break_streams_at_barriers, "restoreUnbroken", record("restoreUnbroken"))
+    monkeypatch.setattr(refresh_parameters.stage_scheduler, "runStages", 
+        lambda stages, workers = 1: calls.append(("runStages", [stage.name for stage in stages])))
+    return calls
+
+def refresh(monkeypatch, changes, unbroken = True):
+    monkeypatch.setattr(refresh_parameters.species_parameters, "findChanges", lambda connection, context: changes)
+    monkeypatch.setattr(refresh_parameters.break_streams_at_barriers, "hasUnbroken", lambda connection, context: unbroken)
+    context = stage_context.StageContext("17010301", FakeConnection())
+    refresh_parameters.refreshParameters(context)
+
+def changes(changed, removed, gradientchanged = False):
+    return refresh_parameters.species_parameters.SpeciesChanges(changed, removed, gradientchanged)
+
+
+def test_not_recorded(monkeypatch, calls):
+    refresh(monkeypatch, None)
+    
+    assert calls == [("processWatershed",)]
+
+def test_unchanged(monkeypatch, calls):
+    refresh(monkeypatch, changes([], []))
+    
+    assert calls == []
+
+def test_species_changed(monkeypatch, calls):
+    refresh(monkeypatch, changes(["bt"], ["lt"]))
+    
+    assert calls == [
+        ("compute_gradient_accessibility", ["bt"], ["lt"]),
+        ("compute_habitat_models", ["bt"], ["lt"]),
+        ("compute_barriers_upstream_values", ["bt"], ["lt"]),
+        ("species_parameters",),
+    ]
+
+def test_gradient_changed(monkeypatch, calls):
+    refresh(monkeypatch, changes(["bt"], ["lt"], gradientchanged = True))
+    
+    assert calls[0][0] == "restoreUnbroken"
+    #the scripts from break_streams_at_barriers on are run again
+    assert calls[1][0] == "runStages"
+    assert calls[1][1][0] == "break_streams_at_barriers"
+    assert "compute_habitat_models" in calls[1][1]
+    assert "preprocess_watershed" not in calls[1][1]
+    assert "load_and_snap_barriers_cabd" not in calls[1][1]
+    #the barrier columns of removed species are dropped
+    assert calls[2][0] == "dropColumns"
+    assert "total_upstr_hab_lt" in calls[2][2]
+    assert len(calls) == 3
+
+def test_gradient_changed_not_saved(monkeypatch, calls):
+    refresh(monkeypatch, changes(["bt"], [], gradientchanged = True), unbroken = False)
+    
+    assert calls == [("processWatershed",)]
+
+def test_gradient_changed_checkpoints(monkeypatch, calls):
+    monkeypatch.setattr(refresh_parameters.process_watershed, "stageCheckpoints", True)
+    
+    def rerunStages(stages, first, context):
+        calls.append(("rerunStages", stages[first].name))
+        return stages[first:]
+    monkeypatch.setattr(refresh_parameters.stage_checkpoint, "rerunStages", rerunStages)
+    
+    refresh(monkeypatch, changes(["bt"], [], gradientchanged = True))
+    
+    assert calls[1] == ("rerunStages", "break_streams_at_barriers")
+    assert calls[2][0] == "runStages"
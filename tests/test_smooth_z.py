@@ -0,0 +1,101 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+
+#
+# tests for the smoothing of the elevations at the stream network nodes
+# and along the edges
+#
+import numpy
+
+import appconfig
+import smooth_z
+
+NODATA = appconfig.NODATA
+
+#
+#  (0,5) z=20
+#     |
+#  (1,5)         (0,0) z=10
+#     \          /
+#      (1,0) z=12       (3,3) no elevation
+#         |               /
+#      (2,0) z=5 --------
+#
+# the confluence at (1,0) is higher than the stream above it, and the
+# stream from (3,3) has no elevation at its upstream end
+#
+coords = [
+    [(0, 0, 10), (0.5, 0, 11), (1, 0, 12)],
+    [(1, 0, 12), (1.5, 0, 9), (2, 0, 5)],
+    [(0, 5, 20), (1, 5, 18), (1, 0, 12)],
+    [(3, 3, NODATA), (2, 0, 5)],
+]
+
+def createNetwork():
+    return smooth_z.buildNetwork([1, 2, 3, 4], [numpy.array(c, dtype=numpy.float64) for c in coords])
+
+
+def test_node_elevations():
+    network = createNetwork()
+    smooth_z.processNodes(network)
+    
+    newz = network.attributes['newz']
+    
+    #(0,0): max(12, 10) and min 10
+    assert newz[0][0] == 11
+    #(1,0): max(5, 12) and min(12, 10, 20)
+    assert newz[0][-1] == 11
+    assert newz[1][0] == 11
+    assert newz[2][-1] == 11
+    #(2,0): the outlet keeps its elevation
+    assert newz[1][-1] == 5
+    assert newz[3][-1] == 5
+    #(0,5): the headwater above the confluence keeps its elevation
+    assert newz[2][0] == 20
+    #(3,3): no elevation to smooth
+    assert newz[3][0] == NODATA
+
+def test_flows_downhill():
+    network = createNetwork()
+    smooth_z.processNodes(network)
+    
+    for z in network.attributes['newz']:
+        if z[0] != NODATA and z[-1] != NODATA:
+            assert z[0] >= z[-1]
+
+def test_vertices_not_set():
+    network = createNetwork()
+    smooth_z.processNodes(network)
+    
+    newz = network.attributes['newz']
+    
+    assert [len(z) for z in newz] == [3, 3, 3, 2]
+    assert [z[1] for z in newz[0:3]] == [NODATA] * 3
+
+def test_edge_vertices():
+    network = createNetwork()
+    smooth_z.processNodes(network)
+    smooth_z.processEdges(network)
+    
+    newz = network.attributes['newz']
+    
+    assert list(newz[0]) == [11, 11, 11]
+    assert list(newz[1]) == [11, 9, 5]
+    #vertices never rise walking down the edge
+    assert (numpy.diff(newz[2]) <= 0).all()
@@ -0,0 +1,65 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+
+#
+# tests for finding the species whose parameters changed since a
+# watershed was processed
+#
+import stage_context
+import species_parameters
+from fake_database import FakeConnection
+
+def findChanges(rows, gradients, recorded = True):
+    connection = FakeConnection([
+        ("to_regclass", [(recorded,)]),
+        ("FULL OUTER JOIN", rows),
+        ("min(accessibility_gradient)", [gradients]),
+    ])
+    context = stage_context.StageContext("17010301", connection)
+    return species_parameters.findChanges(connection, context)
+
+
+def test_not_recorded():
+    assert findChanges([], (0.1, 0.1), recorded = False) is None
+
+def test_unchanged():
+    changes = findChanges([], (0.1, 0.1))
+    
+    assert changes.changed == []
+    assert changes.removed == []
+    assert not changes.gradientchanged
+
+def test_changed():
+    #species in the parameters are changed, species only recorded are removed
+    changes = findChanges([("bt", False), ("lt", True), ("rb", False)], (0.1, 0.1))
+    
+    assert changes.changed == ["bt", "rb"]
+    assert changes.removed == ["lt"]
+    assert not changes.gradientchanged
+
+def test_gradient_changed():
+    changes = findChanges([("bt", False)], (0.15, 0.1))
+    
+    assert changes.changed == ["bt"]
+    assert changes.gradientchanged
+
+def test_species_filter():
+    assert species_parameters.speciesFilter(None) == "true"
+    assert species_parameters.speciesFilter([]) == "false"
+    assert species_parameters.speciesFilter(["bt", "rb"]) == "code IN ('bt','rb')"
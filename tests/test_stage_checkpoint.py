@@ -0,0 +1,210 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+
+#
+# tests for planning which stages have to be run from their checkpoints
+#
+import configparser
+import types
+
+import appconfig
+import stage_checkpoint
+import stage_context
+import stage_scheduler
+from fake_database import FakeConnection
+
+def createConfig():
+    config = configparser.ConfigParser()
+    config.read_dict(appconfig.config)
+    return config
+
+#
+# database holding the recorded checkpoints and the checksums of the
+# source tables
+#
+class Database:
+    
+    def __init__(self):
+        self.checkpoints = {}
+        self.checksums = {"hydro.streams": "a", "hydro.roads": "a"}
+        self.connection = FakeConnection([
+            ("SELECT stage, fingerprint", lambda query, params: list(self.checkpoints.items())),
+            ("to_regclass", [(True,)]),
+            ("md5(string_agg", self.checksum),
+            ("INSERT INTO", self.save),
+            ("DELETE FROM", self.delete),
+        ])
+    
+    def checksum(self, query, params):
+        table = [table for table in self.checksums if table in query][0]
+        return [(10, self.checksums[table])]
+    
+    def save(self, query, params):
+        self.checkpoints[params[0]] = params[1]
+        return []
+    
+    def delete(self, query, params):
+        for name in params[0]:
+            self.checkpoints.pop(name, None)
+        return []
+
+#
+# plans and runs the stages returning the names of the stages run
+#
+def runPlan(database, config = None):
+    if config is None:
+        config = createConfig()
+    context = stage_context.StageContext("17010301", database.connection, config)
+    
+    ran = []
+    stages = planStages(ran.append)
+    stage_scheduler.runStages(stage_checkpoint.checkpointStages(stages, context))
+    return ran
+
+#the stages planned by runPlan with the given run function
+def planStages(run):
+    return [
+        stage_scheduler.Stage("preprocess", lambda: run("preprocess"), ["hydro.streams"], ["ws.streams"]),
+        stage_scheduler.Stage("mainstems", lambda: run("mainstems"), ["ws.streams"], ["ws.streams"]),
+        stage_scheduler.Stage("crossings", lambda: run("crossings"), ["hydro.roads"], ["ws.crossings"]),
+        stage_scheduler.Stage("stats", lambda: run("stats"), ["ws.streams"], ["ws.stats"]),
+    ]
+
+def hookStage(name, inputs, outputs, **hooks):
+    return stage_scheduler.Stage(name, None, inputs, outputs, types.SimpleNamespace(**hooks), None)
+
+
+def test_first_run():
+    database = Database()
+    
+    assert runPlan(database) == ["preprocess", "mainstems", "crossings", "stats"]
+    assert set(database.checkpoints) == {"preprocess", "mainstems", "crossings", "stats"}
+
+def test_unchanged():
+    database = Database()
+    runPlan(database)
+    
+    assert runPlan(database) == []
+
+def test_source_table_changed():
+    database = Database()
+    runPlan(database)
+    
+    database.checksums["hydro.streams"] = "b"
+    
+    assert runPlan(database) == ["preprocess", "mainstems", "stats"]
+
+def test_checkpoint_removed():
+    database = Database()
+    runPlan(database)
+    
+    del database.checkpoints["mainstems"]
+    
+    #stats reads the streams mainstems writes
+    assert runPlan(database) == ["mainstems", "stats"]
+
+def test_config_changed():
+    database = Database()
+    runPlan(database)
+    
+    config = createConfig()
+    config["17010302"]["output_schema"] = "other"
+    assert runPlan(database, config) == []
+    
+    config["PROCESSING"]["stage_workers"] = "4"
+    assert runPlan(database, config) == []
+    
+    config["17010301"]["output_schema"] = "other"
+    assert runPlan(database, config) == ["preprocess", "mainstems", "crossings", "stats"]
+
+def test_failed_stage():
+    database = Database()
+    runPlan(database)
+    database.checksums["hydro.streams"] = "b"
+    
+    context = stage_context.StageContext("17010301", database.connection, createConfig())
+    
+    def run(name):
+        if name == "preprocess":
+            raise RuntimeError("failed")
+    
+    stages = planStages(run)
+    try:
+        stage_scheduler.runStages(stage_checkpoint.checkpointStages(stages, context))
+    except RuntimeError:
+        pass
+    
+    #the checkpoints of the stages that had to run are removed before
+    #any are run
+    assert set(database.checkpoints) == {"crossings"}
+
+def test_forced():
+    stages = [
+        hookStage("preprocess", [], ["ws.streams"]),
+        hookStage("parameters", [], ["hydro.species"]),
+        hookStage("break", ["ws.streams", "hydro.species"], ["ws.streams"], 
+            stageQueries = lambda context: {"hydro.species": "SELECT min(gradient)"}),
+        hookStage("access", ["ws.streams", "hydro.species"], ["ws.streams"]),
+    ]
+    plan = stage_checkpoint.CheckpointPlan(stages, types.SimpleNamespace(config = createConfig(), section = "17010301"))
+    
+    #the species table is only used through the query by break
+    assert not plan.forced(2, {1})
+    assert plan.forced(3, {1})
+    assert plan.forced(2, {0})
+    assert not plan.forced(0, {1, 2, 3})
+
+def test_rebuilds():
+    stages = [
+        hookStage("preprocess", [], ["ws.streams"]),
+        hookStage("mainstems", ["ws.streams"], ["ws.streams"]),
+        hookStage("crossings", ["ws.streams"], ["ws.crossings"]),
+        hookStage("barriers", ["ws.crossings"], ["ws.barriers"]),
+        hookStage("parameters", [], ["hydro.species"]),
+        hookStage("break", ["ws.streams", "ws.barriers"], ["ws.streams"], 
+            stageRebuilds = lambda context: ["ws.streams"]),
+        hookStage("updown", ["ws.streams"], ["ws.streams"]),
+    ]
+    plan = stage_checkpoint.CheckpointPlan(stages, types.SimpleNamespace(config = createConfig(), section = "17010301"))
+    
+    #break rebuilds the streams: every earlier stage using the streams is
+    #run again and so are the stages depending on those
+    assert plan.rebuilds({5}) == {0, 1, 2, 3, 5, 6}
+    #running break because of its barriers input is the same
+    assert plan.rebuilds({3}) == {0, 1, 2, 3, 5, 6}
+    #nothing is rebuilt when break isn't run
+    assert plan.rebuilds({4}) == {4}
+    assert plan.rebuilds({6}) == {6}
+
+def test_rerun():
+    database = Database()
+    runPlan(database)
+    context = stage_context.StageContext("17010301", database.connection, createConfig())
+    
+    ran = []
+    stages = stage_checkpoint.rerunStages(planStages(ran.append), 1, context)
+    
+    assert [stage.name for stage in stages] == ["mainstems", "crossings", "stats"]
+    assert set(database.checkpoints) == {"preprocess"}
+    
+    stage_scheduler.runStages(stages)
+    
+    assert ran == ["mainstems", "crossings", "stats"]
+    #the checkpoints recorded are the ones a full run records
+    assert runPlan(database) == []
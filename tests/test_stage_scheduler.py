@@ -0,0 +1,129 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+
+#
+# tests for ordering and running stages as a dependency graph
+#
+import threading
+
+import pytest
+
+import stage_scheduler
+
+def createStages(tables, run = None):
+    stages = []
+    for name, inputs, outputs in tables:
+        stages.append(stage_scheduler.Stage(name, (lambda name = name: run(name)) if run else None, inputs, outputs))
+    return stages
+
+#
+# stream table written by two stages in order, two independent loaders
+# and stages reading their results
+#
+tables = [
+    ("preprocess", [], ["streams"]),
+    ("barriers", ["streams"], ["barriers"]),
+    ("observations", ["streams"], ["observations"]),
+    ("break", ["streams", "barriers"], ["streams"]),
+    ("updown", ["streams", "barriers", "observations"], ["streams"]),
+    ("stats", ["barriers"], ["stats"]),
+]
+
+#
+# runs the stages recording when each starts and ends; the independent
+# stages given wait for each other so they only complete if they are 
+# run at the same time
+#
+class Recorder:
+    
+    def __init__(self, together = ()):
+        self.events = []
+        self.lock = threading.Lock()
+        self.together = set(together)
+        self.barrier = threading.Barrier(len(self.together), timeout = 10) if together else None
+    
+    def run(self, name):
+        with self.lock:
+            self.events.append(("start", name))
+        if name in self.together:
+            self.barrier.wait()
+        with self.lock:
+            self.events.append(("end", name))
+    
+    def position(self, event, name):
+        return self.events.index((event, name))
+
+
+def test_dependencies():
+    stages = createStages(tables)
+    
+    assert stage_scheduler.dependencies(stages) == [
+        set(),
+        #reads the streams written by preprocess
+        {0},
+        {0},
+        #writes the streams the loaders read
+        {0, 1, 2},
+        {0, 1, 2, 3},
+        #only reads the barriers
+        {1},
+    ]
+
+def test_readers_independent():
+    stages = createStages([("a", [], ["t"]), ("b", ["t"], ["u"]), ("c", ["t"], ["v"])])
+    
+    assert stage_scheduler.dependencies(stages) == [set(), {0}, {0}]
+
+def test_serial():
+    recorder = Recorder()
+    stages = createStages(tables, recorder.run)
+    
+    stage_scheduler.runStages(stages, 1)
+    
+    assert [name for event, name in recorder.events if event == "start"] == [t[0] for t in tables]
+
+def test_parallel():
+    recorder = Recorder(together = ["barriers", "observations"])
+    stages = createStages(tables, recorder.run)
+    
+    stage_scheduler.runStages(stages, 3)
+    
+    assert len(recorder.events) == 2 * len(tables)
+    for j, depends in enumerate(stage_scheduler.dependencies(stages)):
+        for i in depends:
+            assert recorder.position("end", tables[i][0]) < recorder.position("start", tables[j][0])
+
+def test_failure():
+    recorder = Recorder()
+    
+    def run(name):
+        recorder.run(name)
+        if name == "barriers":
+            raise RuntimeError("failed")
+    
+    stages = createStages(tables, run)
+    
+    with pytest.raises(RuntimeError):
+        stage_scheduler.runStages(stages, 2)
+    
+    started = {name for event, name in recorder.events if event == "start"}
+    #no stage depending on the failed stage is started
+    assert "break" not in started
+    assert "updown" not in started
+    assert "stats" not in started
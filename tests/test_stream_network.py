@@ -0,0 +1,100 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2022 by Canadian Wildlife Federation, Alberta Environment and Parks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+
+#
+# tests for the stream network topology (levels, sources and sinks)
+#
+import numpy
+import pytest
+
+import stream_network
+
+#
+# two headwater edges joining and flowing to an outlet plus a separate
+# single edge network:
+#
+#   (0,2)   (2,2)      (5,5)
+#      \     /           |
+#       (1,1)          (5,4)
+#         |
+#       (1,0)
+#
+edges = [
+    ((0, 2), (1, 1)),
+    ((2, 2), (1, 1)),
+    ((1, 1), (1, 0)),
+    ((5, 5), (5, 4)),
+]
+
+def createNetwork():
+    return stream_network.StreamNetwork(
+        [10, 11, 12, 13], [e[0] for e in edges], [e[1] for e in edges])
+
+def nodeAt(network, x, y):
+    return int(numpy.flatnonzero((network.nodex == x) & (network.nodey == y))[0])
+
+def nodesAt(network, coords):
+    return sorted(nodeAt(network, x, y) for x, y in coords)
+
+
+def test_nodes():
+    network = createNetwork()
+    
+    assert network.edgecount == 4
+    assert network.nodecount == 6
+    
+    assert network.fromnode[2] == nodeAt(network, 1, 1)
+    assert network.tonode[2] == nodeAt(network, 1, 0)
+    assert sorted(network.inEdges(nodeAt(network, 1, 1))) == [0, 1]
+    assert list(network.outEdges(nodeAt(network, 1, 1))) == [2]
+    assert network.getEdge(12) == 2
+    assert network.getEdge(99) is None
+
+def test_sources_and_sinks():
+    network = createNetwork()
+    
+    assert sorted(network.sources()) == nodesAt(network, [(0, 2), (2, 2), (5, 5)])
+    assert sorted(network.sinks()) == nodesAt(network, [(1, 0), (5, 4)])
+
+def test_levels():
+    network = createNetwork()
+    
+    levels = [sorted(level) for level in network.topologicalLevels()]
+    assert levels == [
+        nodesAt(network, [(0, 2), (2, 2), (5, 5)]),
+        nodesAt(network, [(1, 1), (5, 4)]),
+        nodesAt(network, [(1, 0)]),
+    ]
+    
+    #every edge goes from an earlier to a later position
+    position = numpy.empty(network.nodecount, dtype=numpy.int64)
+    position[network.topologicalOrder()] = numpy.arange(network.nodecount)
+    assert (position[network.fromnode] < position[network.tonode]).all()
+
+def test_edge_levels():
+    network = createNetwork()
+    
+    assert [sorted(edges) for edges in network.edgeLevels()] == [[0, 1, 3], [2]]
+
+def test_cycle():
+    network = stream_network.StreamNetwork(
+        [1, 2, 3], [(0, 0), (1, 0), (1, 1)], [(1, 0), (1, 1), (0, 0)])
+    
+    with pytest.raises(ValueError):
+        network.topologicalLevels()